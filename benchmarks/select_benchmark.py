@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+##############################################################################
+
+"""
+Measure the throughput of database select requests in rows per second for
+each output format and each database file.
+
+For example:
+
+    python benchmarks/select_benchmark.py --api-key <key> <file id> ...
+
+Each file should be a database file of a different connector type to compare
+connectors.  Run the benchmark with the database_assetstore.fast_json setting
+on and off (with orjson installed on the server) to compare the JSON
+backends.
+"""
+
+import argparse
+import requests
+import time
+
+
+Formats = ['list', 'dict', 'json', 'jsonlines', 'csv', 'geojson']
+
+
+def timeSelect(session, apiUrl, fileId, params, repeat):
+    """
+    Time a select request, reading the entire response.
+
+    :param session: a requests session with authentication.
+    :param apiUrl: the base url of the Girder api.
+    :param fileId: the id of the database file.
+    :param params: the select parameters.
+    :param repeat: the number of times to perform the request.
+    :returns: the fastest time in seconds and the response length in bytes.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        resp = session.get('%s/file/%s/database/select' % (apiUrl, fileId),
+                           params=params, stream=True)
+        resp.raise_for_status()
+        length = 0
+        for chunk in resp.iter_content(65536):
+            length += len(chunk)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, length
+
+
+def connectorType(session, apiUrl, fileId):
+    """
+    Get the type of database of a file.  This is the scheme of the database
+    uri of the file's link (for user databases) or of its assetstore, or the
+    assetstore's dbtype.  Reading the assetstore requires an administrator.
+
+    :param session: a requests session with authentication.
+    :param apiUrl: the base url of the Girder api.
+    :param fileId: the id of the database file.
+    :returns: the database type or 'unknown'.
+    """
+    info = session.get('%s/file/%s/database' % (apiUrl, fileId)).json()
+    if isinstance(info, dict) and info.get('uri'):
+        return info['uri'].split(':', 1)[0]
+    file = session.get('%s/file/%s' % (apiUrl, fileId)).json()
+    resp = session.get('%s/assetstore/%s' % (apiUrl, file.get('assetstoreId')))
+    if resp.ok:
+        database = resp.json().get('database') or {}
+        if database.get('uri'):
+            return database['uri'].split(':', 1)[0]
+        if database.get('dbtype'):
+            return database['dbtype']
+    return 'unknown'
+
+
+def benchmarkFile(session, apiUrl, fileId, formats, limit, repeat):
+    """
+    Benchmark select requests for one database file.
+
+    :param session: a requests session with authentication.
+    :param apiUrl: the base url of the Girder api.
+    :param fileId: the id of the database file.
+    :param formats: a list of formats to test.
+    :param limit: the limit parameter for the select requests.
+    :param repeat: the number of times to perform each request.
+    :returns: a list of result rows: connector type, file id, format, number
+        of rows, bytes, seconds, and rows per second.
+    """
+    connector = connectorType(session, apiUrl, fileId)
+    params = {'limit': limit, 'format': 'list'}
+    resp = session.get('%s/file/%s/database/select' % (apiUrl, fileId),
+                       params=params)
+    resp.raise_for_status()
+    rows = resp.json()['datacount']
+    results = []
+    for format in formats:
+        params['format'] = format
+        seconds, length = timeSelect(session, apiUrl, fileId, params, repeat)
+        results.append((connector, fileId, format, rows, length, seconds,
+                        float(rows) / seconds if seconds else 0))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('fileIds', nargs='+', metavar='file-id',
+                        help='The ids of database files to select from.')
+    parser.add_argument('--api-url', default='http://localhost:8080/api/v1',
+                        help='The Girder api url.  Default %(default)s.')
+    parser.add_argument('--api-key', help='A Girder api key.')
+    parser.add_argument('--token', help='A Girder authentication token.')
+    parser.add_argument('--formats', default=','.join(Formats),
+                        help='A comma-separated list of formats to test.  '
+                        'Default %(default)s.')
+    parser.add_argument('--limit', default='10000',
+                        help='The number of rows to select, or "none".  '
+                        'Default %(default)s.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='The number of times to repeat each request; '
+                        'the fastest is reported.  Default %(default)s.')
+    args = parser.parse_args()
+
+    apiUrl = args.api_url.rstrip('/')
+    session = requests.Session()
+    token = args.token
+    if args.api_key:
+        token = session.post('%s/api_key/token' % apiUrl, params={
+            'key': args.api_key}).json()['authToken']['token']
+    if token:
+        session.headers['Girder-Token'] = token
+    formats = [format.strip() for format in args.formats.split(',') if format.strip()]
+
+    print('%-20s %-24s %-10s %10s %12s %9s %12s' % (
+        'connector', 'file', 'format', 'rows', 'bytes', 'seconds', 'rows/s'))
+    for fileId in args.fileIds:
+        for result in benchmarkFile(
+                session, apiUrl, fileId, formats, args.limit, args.repeat):
+            print('%-20s %-24s %-10s %10d %12d %9.3f %12.0f' % result)
+
+
+if __name__ == '__main__':
+    main()
@@ -20,6 +20,8 @@
 import json
 import os
 import six
+import threading
+import zlib
 from six.moves import urllib
 
 from girder import config
@@ -450,6 +452,32 @@ class AssetstoreTest(base.TestCase):
                 isJson=False, additionalHeaders=[('Range', 'bytes=5000-')])
             self.assertStatus(resp, 206)
             self.assertEqual(self.getBody(resp), '')
+            # Test compressed downloads.  Range requests are not compressed.
+            resp = self.request(
+                method='PUT', path='/system/setting', user=self.admin, params={
+                    'key': 'database_assetstore.compression_level', 'value': 6})
+            self.assertStatusOk(resp)
+            resp = self.request(
+                path='/item/%s/download' % str(townItem['_id']), params=params,
+                isJson=False, additionalHeaders=[('Accept-Encoding', 'gzip')])
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            compressed = self.getBody(resp, text=False)
+            self.assertEqual(zlib.decompress(
+                compressed, 16 + zlib.MAX_WBITS).decode('utf8'), data)
+            resp = self.request(
+                path='/item/%s/download' % str(townItem['_id']), params=params,
+                isJson=False, additionalHeaders=[
+                    ('Accept-Encoding', 'gzip'), ('Range', 'bytes=10-19')])
+            self.assertStatus(resp, 206)
+            self.assertNotIn('Content-Encoding', resp.headers)
+            self.assertEqual(resp.headers['Content-Range'],
+                             'bytes 10-19/%d' % len(data.encode('utf8')))
+            self.assertEqual(self.getBody(resp), data[10:20])
+            resp = self.request(
+                method='PUT', path='/system/setting', user=self.admin, params={
+                    'key': 'database_assetstore.compression_level', 'value': 0})
+            self.assertStatusOk(resp)
             # Test more complex extraParameters
             extra = {
                 'format': 'list',
@@ -624,6 +652,47 @@ class AssetstoreTest(base.TestCase):
             self.assertEqual(len(dataend), 100)
             self.assertNotEqual(dataend, data[:100])
 
+    def testAssetstoreOpenQueriesOnce(self):
+        from girder.plugins.database_assetstore import assetstore
+
+        townItem, townFile, assetstore1 = self._createTownItem()
+        adapter = File().getAssetstoreAdapter(townFile)
+        queries = []
+        queryDatabase = assetstore.queryDatabase
+
+        def countingQueryDatabase(*args, **kwargs):
+            queries.append(True)
+            return queryDatabase(*args, **kwargs)
+
+        assetstore.queryDatabase = countingQueryDatabase
+        try:
+            assetstore.renderCache.invalidate(townFile['_id'])
+            # Getting the size and mime type and reading the file all use one
+            # rendering of the output
+            handle = adapter.open(townFile)
+            file = handle._file
+            self.assertGreater(file['size'], 300)
+            self.assertEqual(file['mimeType'], 'application/json')
+            data = handle.read(200)
+            handle.seek(-100, os.SEEK_END)
+            dataend = handle.read(200)
+            self.assertEqual(len(queries), 1)
+            self.assertEqual(data[:2], b'{"')
+            self.assertEqual(len(dataend), 100)
+            # Another handle reuses the rendered output
+            handle = adapter.open(townFile)
+            self.assertEqual(handle.read(200), data)
+            self.assertEqual(len(queries), 1)
+            # Until the file is refreshed
+            resp = self.request(method='PUT', path='/file/%s/database/refresh' % (
+                townFile['_id'], ), user=self.admin)
+            self.assertStatusOk(resp)
+            handle = adapter.open(townFile)
+            self.assertEqual(handle.read(200), data)
+            self.assertEqual(len(queries), 2)
+        finally:
+            assetstore.queryDatabase = queryDatabase
+
     def testAssetstoreFileCopy(self):
         for userAssetstore in (False, True):
             townItem, townFile, assetstore1 = self._createTownItem(userAssetstore=userAssetstore)
@@ -730,6 +799,98 @@ class AssetstoreTest(base.TestCase):
         self.assertEqual(file['size'], 25)
         self.assertEqual(end, 6)
 
+    def testRenderCache(self):
+        from girder.plugins.database_assetstore import assetstore
+
+        resp = self.request(path='/assetstore', method='POST', user=self.admin,
+                            params=self.dbParams)
+        self.assertStatusOk(resp)
+        adapter = assetstore_utilities.getAssetstoreAdapter(resp.json)
+        calls = []
+
+        def genDownload():
+            calls.append(True)
+            for idx in range(1000):
+                yield u'%d,\u0441\n' % idx
+
+        cache = assetstore.RenderCache(maxEntries=2, maxMemory=1000)
+        renderCache = assetstore.renderCache
+        assetstore.renderCache = cache
+        try:
+            file = {'mimeType': 'text/csv'}
+            newFunc, end = adapter._getDownloadSize(
+                file, genDownload, 10, 20, ('fileid', 'query'))
+            full = u''.join(genDownload()).encode('utf8')
+            self.assertEqual(b''.join(newFunc()), full[10:20])
+            self.assertEqual(file['size'], len(full))
+            self.assertEqual(end, 20)
+            # The output is spooled to disk when it is large
+            output = cache.get(('fileid', 'query'))
+            self.assertTrue(output._file._rolled)
+            self.assertEqual(output.mimeType, 'text/csv')
+            self.assertEqual(b''.join(output.readFunc(6000)()), full[6000:])
+            self.assertEqual(b''.join(output.readFunc()()), full)
+            # Other reads don't rerender the output
+            newFunc, end = adapter._getDownloadSize(
+                file, None, 5, None, output=output)
+            self.assertEqual(b''.join(newFunc()), full[5:])
+            self.assertEqual(end, len(full))
+            self.assertEqual(len(calls), 2)
+            output.release()
+            # Entries are limited in number, expire, and can be invalidated.
+            # Discarded outputs are closed once they are no longer read.
+            adapter._getDownloadSize(file, genDownload, 0, 1, ('fileid', 'q2'))
+            adapter._getDownloadSize(file, genDownload, 0, 1, ('other', 'q3'))
+            self.assertIsNone(cache.get(('fileid', 'query')))
+            self.assertFalse(output.closed)
+            self.assertEqual(b''.join(newFunc()), full[5:])
+            self.assertTrue(output.closed)
+            output = cache.get(('fileid', 'q2'))
+            self.assertIsNotNone(output)
+            cache.invalidate('fileid')
+            self.assertIsNone(cache.get(('fileid', 'q2')))
+            self.assertFalse(output.closed)
+            output.release()
+            self.assertTrue(output.closed)
+            cache.get(('other', 'q3')).release()
+            cache.ttl = -1
+            adapter._getDownloadSize(file, genDownload, 0, 1, ('other', 'q4'))
+            self.assertIsNone(cache.get(('other', 'q4')))
+            # Outputs larger than the size budget are not cached
+            cache.ttl = 300
+            cache.maxSize = 1000
+            newFunc, end = adapter._getDownloadSize(
+                file, genDownload, 0, 1, ('other', 'q5'))
+            self.assertIsNone(cache.get(('other', 'q5')))
+            self.assertEqual(b''.join(newFunc()), full[:1])
+            self.assertEqual(len(cache._entries), 0)
+            # Concurrent requests for the same output share one render
+            cache.maxSize = len(full) * 4
+            del calls[:]
+            rendering = threading.Event()
+            proceed = threading.Event()
+
+            def slowDownload():
+                rendering.set()
+                proceed.wait(10)
+                return genDownload()
+
+            outputs = []
+            thread = threading.Thread(target=lambda: outputs.append(
+                cache.add(('other', 'q6'), slowDownload)))
+            thread.start()
+            rendering.wait(10)
+            follower = threading.Thread(target=lambda: outputs.append(
+                cache.add(('other', 'q6'), genDownload)))
+            follower.start()
+            proceed.set()
+            thread.join(10)
+            follower.join(10)
+            self.assertEqual(len(calls), 1)
+            self.assertIs(outputs[0], outputs[1])
+        finally:
+            assetstore.renderCache = renderCache
+
     def testAdapterGetTableList(self):
         # Create assetstore
         resp = self.request(path='/assetstore', method='POST', user=self.admin,
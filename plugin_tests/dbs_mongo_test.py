@@ -139,6 +139,121 @@ class DbsMongoTest(base.TestCase):
             resp.json['data'][0][resp.json['columns']['issued_date']]['$date'],
             lastData['data'][0][lastData['columns']['issued_date']]['$date'])
 
+    def testMongoDatabaseSelectAfter(self):
+        sort = json.dumps([['issued_date', -1], ['_id', 1]])
+        params = {'sort': sort, 'limit': 60, 'fields': '_id,issued_date,zip'}
+        resp = self.request(path='/file/%s/database/select' % (
+            self.dbFileId, ), user=self.admin, params=params)
+        self.assertStatusOk(resp)
+        fullData = resp.json['data']
+        self.assertEqual(len(fullData), 60)
+        # Page through the same rows with continuation tokens
+        params = {'sort': sort, 'limit': 20, 'fields': '_id,issued_date,zip',
+                  'after': ''}
+        data = []
+        for page in range(3):
+            resp = self.request(path='/file/%s/database/select' % (
+                self.dbFileId, ), user=self.admin, params=params)
+            self.assertStatusOk(resp)
+            data.extend(resp.json['data'])
+            params['after'] = resp.json['next']
+        self.assertEqual(data, fullData)
+
+    def testMongoDatabaseCount(self):
+        params = {'limit': 'none', 'fields': 'zip', 'zip': '02133'}
+        resp = self.request(path='/file/%s/database/select' % (
+            self.dbFileId, ), user=self.admin, params=params)
+        self.assertStatusOk(resp)
+        total = resp.json['datacount']
+        params = {'zip': '02133'}
+        resp = self.request(path='/file/%s/database/count' % (
+            self.dbFileId, ), user=self.admin, params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json, {'count': total, 'mode': 'exact'})
+        # Filtered estimates are exact
+        params['count'] = 'estimate'
+        resp = self.request(path='/file/%s/database/count' % (
+            self.dbFileId, ), user=self.admin, params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json, {'count': total, 'mode': 'exact'})
+        resp = self.request(path='/file/%s/database/count' % (
+            self.dbFileId, ), user=self.admin, params={'count': 'estimate'})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['mode'], 'estimate')
+        self.assertGreater(resp.json['count'], total)
+        resp = self.request(path='/file/%s/database/count' % (
+            self.dbFileId, ), user=self.admin, params={
+                'count': 'capped', 'countcap': 3})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json, {'count': 3, 'mode': 'capped'})
+
+    def testMongoDatabaseSelectPartitions(self):
+        params = {'limit': 'none', 'fields': '_id,zip', 'zip': '02133',
+                  'sort': '_id'}
+        resp = self.request(path='/file/%s/database/select' % (
+            self.dbFileId, ), user=self.admin, params=params)
+        self.assertStatusOk(resp)
+        expected = resp.json['data']
+        self.assertEqual(len(expected), 7)
+        params['partitions'] = 3
+        resp = self.request(path='/file/%s/database/select' % (
+            self.dbFileId, ), user=self.admin, params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['data'], expected)
+        del params['sort']
+        params['ordered'] = 'false'
+        resp = self.request(path='/file/%s/database/select' % (
+            self.dbFileId, ), user=self.admin, params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(sorted(json.dumps(row) for row in resp.json['data']),
+                         sorted(json.dumps(row) for row in expected))
+
+    def testMongoDatabaseSelectWait(self):
+        from girder.plugins.database_assetstore import assetstore, dbs
+
+        conn = dbs.getDBConnector(
+            self.dbFileId, assetstore.getDbInfoForFile(self.dbFile))
+        filters = [{'field': 'worktype', 'operator': 'eq', 'value': 'New'}]
+        self.assertEqual(conn._changeStreamPipeline(filters), [{'$match': {
+            'operationType': {'$in': ['insert', 'replace', 'update']},
+            '$and': [{'fullDocument.worktype': {'$eq': 'New'}}],
+        }}])
+        # Change streams need a replica set; without one, waiting selects
+        # poll instead
+        unsubscribe = conn.subscribeToChanges(lambda listening: None, filters)
+        if unsubscribe is not None:
+            # Waits with the same filters share one stream
+            unsubscribe2 = conn.subscribeToChanges(lambda listening: None, filters)
+            self.assertIsNotNone(unsubscribe2)
+            self.assertIs(unsubscribe.func.__self__, unsubscribe2.func.__self__)
+            unsubscribe()
+            unsubscribe2()
+        params = {'worktype': 'NOT A TYPE', 'wait': 0.5, 'poll': 0.1}
+        resp = self.request(path='/file/%s/database/select' % (
+            self.dbFileId, ), user=self.admin, params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['data'], [])
+
+    def testMongoDatabaseEstimateCost(self):
+        from girder.plugins.database_assetstore import assetstore, dbs
+        from girder.plugins.database_assetstore.dbs.mongo import planScansAll
+
+        self.assertTrue(planScansAll({'stage': 'COLLSCAN'}))
+        self.assertTrue(planScansAll({'stage': 'FETCH', 'inputStage': {
+            'stage': 'IXSCAN', 'indexBounds': {'town': ['[MinKey, MaxKey]']}}}))
+        self.assertFalse(planScansAll({'stage': 'FETCH', 'inputStage': {
+            'stage': 'IXSCAN', 'indexBounds': {'town': ['["A", "A"]']}}}))
+        self.assertTrue(planScansAll({'stage': 'OR', 'inputStages': [
+            {'stage': 'IXSCAN', 'indexBounds': {'town': ['["A", "A"]']}},
+            {'stage': 'COLLSCAN'}]}))
+        conn = dbs.getDBConnector(
+            self.dbFileId, assetstore.getDbInfoForFile(self.dbFile))
+        estimate = conn.estimateCost(conn.getFieldInfo(), {'limit': 5}, [])
+        self.assertEqual(estimate['cost'], 5)
+        filters = [{'field': 'worktype', 'operator': 'eq', 'value': 'New'}]
+        estimate = conn.estimateCost(conn.getFieldInfo(), {'limit': 5}, filters)
+        self.assertGreater(estimate['cost'], 5)
+
     def testMongoDatabaseSelectFields(self):
         # Unknown fields aren't allowed
         params = {'fields': 'unknown,zip', 'limit': 5}
@@ -270,3 +385,37 @@ class DbsMongoTest(base.TestCase):
                                    'Group unsupported by this database'):
             resp = self.request(path='/file/%s/database/select' % (
                 self.dbFileId, ), user=self.admin, params=params)
+
+    def testMongoDatabaseSelectFormats(self):
+        params = {
+            'limit': 5,
+            'sort': 'zip',
+            'fields': 'zip,comments'
+        }
+        resp = self.request(path='/file/%s/database/select' % (
+            self.dbFileId, ), user=self.admin, params=params)
+        self.assertStatusOk(resp)
+        listData = resp.json['data']
+        self.assertEqual(len(listData), 5)
+        # Each format should produce the same rows from the documents
+        params['format'] = 'jsonlines'
+        resp = self.request(path='/file/%s/database/select' % (
+            self.dbFileId, ), user=self.admin, params=params, isJson=False)
+        self.assertStatusOk(resp)
+        lines = self.getBody(resp).strip().split('\n')
+        self.assertEqual(len(lines), 5)
+        self.assertEqual([[json.loads(line).get('zip'),
+                           json.loads(line).get('comments')]
+                          for line in lines], listData)
+        params['format'] = 'csv'
+        resp = self.request(path='/file/%s/database/select' % (
+            self.dbFileId, ), user=self.admin, params=params, isJson=False)
+        self.assertStatusOk(resp)
+        lines = self.getBody(resp).split('\r\n')
+        self.assertEqual(lines[0], 'zip,comments')
+        self.assertEqual(lines[1].split(',')[0], listData[0][0])
+        params['format'] = 'rawlist'
+        from girder.plugins.database_assetstore import assetstore, query
+        resultFunc, mimeType = query.queryDatabase(
+            self.dbFileId, assetstore.getDbInfoForFile(self.dbFile), params)
+        self.assertEqual([list(row) for row in resultFunc()], listData)
@@ -17,10 +17,13 @@
 #  limitations under the License.
 ##############################################################################
 
+import base64
+import io
 import json
 import os
 import threading
 import time
+import zlib
 
 from girder import config
 from girder.models.file import File
@@ -433,6 +436,146 @@ class FileTest(base.TestCase):
         self.assertStatus(resp, 400)
         self.assertIn('must use known fields', resp.json['message'])
 
+    def testFileDatabaseSelectAfter(self):
+        fileId, fileId2, fileId3 = self._setupDbFiles()
+        # Page through the results with continuation tokens.  file1 uses row
+        # value comparisons and file2 uses a filter group.
+        for sort in (json.dumps([['type', 1], ['town', 1]]),
+                     json.dumps([['type', -1], ['town', 1]])):
+            params = {'sort': sort, 'limit': 'none', 'fields': 'town,type'}
+            resp = self.request(path='/file/%s/database/select' % (
+                fileId, ), user=self.user, params=params)
+            self.assertStatusOk(resp)
+            fullData = resp.json['data']
+            self.assertNotIn('next', resp.json)
+            for fid in (fileId, fileId2):
+                for format in ('list', 'dict'):
+                    params = {'sort': sort, 'limit': 50, 'fields': 'town,type',
+                              'format': format, 'after': ''}
+                    data = []
+                    while params['after'] is not None:
+                        resp = self.request(path='/file/%s/database/select' % (
+                            fid, ), user=self.user, params=params)
+                        self.assertStatusOk(resp)
+                        data.extend([
+                            [row['town'], row['type']] if format == 'dict' else
+                            row for row in resp.json['data']])
+                        params['after'] = resp.json['next']
+                    self.assertEqual(data, fullData)
+        # The token must match the sort
+        params = {'sort': 'town', 'limit': 5, 'after': ''}
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatusOk(resp)
+        lastData = resp.json
+        token = resp.json['next']
+        params = {'sort': 'town', 'limit': 5, 'after': token}
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatusOk(resp)
+        self.assertGreater(resp.json['data'][0][resp.json['columns']['town']],
+                           lastData['data'][-1][lastData['columns']['town']])
+        params['sortdir'] = -1
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatus(resp, 400)
+        self.assertIn('does not match the sort', resp.json['message'])
+        params = {'sort': 'town', 'after': 'not a token'}
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatus(resp, 400)
+        self.assertIn('Invalid after', resp.json['message'])
+        # Tokens with values that aren't simple values are rejected
+        for value in ({'field': 'type'}, {'func': 'lower', 'param': 'type'},
+                      ['a', 'b']):
+            token = base64.urlsafe_b64encode(json.dumps({
+                'sort': [['town', 1]], 'values': [value]}).encode('utf8'))
+            params = {'sort': 'town', 'after': token.decode('ascii')}
+            resp = self.request(path='/file/%s/database/select' % (
+                fileId, ), user=self.user, params=params)
+            self.assertStatus(resp, 400)
+            self.assertIn('Invalid after', resp.json['message'])
+        params = {'after': ''}
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatus(resp, 400)
+        self.assertIn('requires sorting', resp.json['message'])
+        params = {'sort': 'town', 'fields': 'type', 'after': ''}
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatus(resp, 400)
+        self.assertIn('sort fields to be returned', resp.json['message'])
+
+    def testFileDatabaseCount(self):
+        fileId, fileId2, fileId3 = self._setupDbFiles()
+        params = {'limit': 'none', 'fields': 'town', 'pop2010_gt': 10000}
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatusOk(resp)
+        total = resp.json['datacount']
+        self.assertGreater(total, 20)
+        # Exact counts use the same filters as select
+        for fid in (fileId, fileId2):
+            resp = self.request(path='/file/%s/database/count' % (
+                fid, ), user=self.user, params={'pop2010_gt': 10000})
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.json, {'count': total, 'mode': 'exact'})
+        resp = self.request(path='/file/%s/database/count' % (
+            fileId, ), user=self.user, params={'filters': json.dumps([
+                ['pop2010', '>', 10000]])})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['count'], total)
+        # Capped counts
+        params = {'pop2010_gt': 10000, 'count': 'capped', 'countcap': 20}
+        resp = self.request(path='/file/%s/database/count' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json, {'count': 20, 'mode': 'capped'})
+        params['countcap'] = total + 1
+        resp = self.request(path='/file/%s/database/count' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json, {'count': total, 'mode': 'exact'})
+        # Estimates use the planner on Postgres; the generic connector counts
+        params = {'count': 'estimate'}
+        resp = self.request(path='/file/%s/database/count' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['mode'], 'estimate')
+        self.assertGreater(resp.json['count'], 0)
+        resp = self.request(path='/file/%s/database/count' % (
+            fileId2, ), user=self.user, params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['mode'], 'exact')
+        # Groups are counted
+        resp = self.request(path='/file/%s/database/count' % (
+            fileId, ), user=self.user, params={'group': 'type'})
+        self.assertStatusOk(resp)
+        self.assertGreater(resp.json['count'], 1)
+        self.assertLess(resp.json['count'], total)
+        # Select can report the count in a header
+        params = {'limit': 5, 'pop2010_gt': 10000, 'count': 'exact'}
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json['data']), 5)
+        self.assertEqual(resp.headers['Girder-Total-Count'], str(total))
+        self.assertEqual(resp.headers['Girder-Total-Count-Mode'], 'exact')
+        # Bad parameters
+        resp = self.request(path='/file/%s/database/count' % (
+            fileId, ), user=self.user, params={'count': 'unknown'})
+        self.assertStatus(resp, 400)
+        self.assertIn('count parameter must be', resp.json['message'])
+        resp = self.request(path='/file/%s/database/count' % (
+            fileId, ), user=self.user, params={
+                'count': 'capped', 'countcap': 'none'})
+        self.assertStatus(resp, 400)
+        self.assertIn('countcap parameter must be', resp.json['message'])
+        resp = self.request(path='/file/%s/database/count' % (
+            fileId3, ), user=self.user)
+        self.assertStatus(resp, 400)
+        self.assertIn('not a database link', resp.json['message'])
+
     def testFileDatabaseSelectFields(self):
         fileId, fileId2, fileId3 = self._setupDbFiles()
         # Unknown fields aren't allowed
@@ -1095,6 +1238,330 @@ class FileTest(base.TestCase):
         self.assertStatusOk(resp)
         self.assertEqual(len(resp.json['geometries']), 0)
 
+    def testFileDatabaseSelectArrow(self):
+        try:
+            import pyarrow
+            import pyarrow.ipc
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+        fileId, fileId2, fileId3 = self._setupDbFiles()
+        params = {
+            'sort': 'town',
+            'limit': 5,
+            'fields': 'town,pop2010',
+        }
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatusOk(resp)
+        listData = resp.json
+        params['format'] = 'arrow'
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params, isJson=False)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.headers['Content-Type'],
+                         'application/vnd.apache.arrow.stream')
+        table = pyarrow.ipc.open_stream(self.getBody(
+            resp, text=False)).read_all()
+        self.assertEqual(table.schema.names, listData['fields'])
+        self.assertEqual(str(table.schema.field('town').type), 'string')
+        self.assertEqual(table.column('town').to_pylist(),
+                         [row[0] for row in listData['data']])
+        self.assertEqual([int(value) for value in table.column(
+            'pop2010').to_pylist()], [int(row[1]) for row in listData['data']])
+        # Empty results still have a schema
+        params['limit'] = 0
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params, isJson=False)
+        self.assertStatusOk(resp)
+        table = pyarrow.ipc.open_stream(self.getBody(
+            resp, text=False)).read_all()
+        self.assertEqual(table.num_rows, 0)
+        self.assertEqual(table.schema.names, listData['fields'])
+
+    def testFileDatabaseSelectBatch(self):
+        from girder.plugins.database_assetstore import query
+
+        fileId, fileId2, fileId3 = self._setupDbFiles()
+        queries = [
+            {'id': fileId, 'params': {'sort': 'town', 'limit': 5}},
+            [fileId2, {'sort': 'town', 'limit': 3, 'format': 'csv',
+                       'fields': 'town,pop2010'}],
+            {'id': fileId, 'params': {
+                'fields': ['town'], 'limit': 2, 'format': 'dict',
+                'filters': [['town', 'BOSTON']]}},
+            [fileId],
+        ]
+        resp = self.request(
+            method='POST', path='/database_assetstore/select/batch',
+            user=self.user, type='application/json', body=json.dumps(queries))
+        self.assertStatusOk(resp)
+        results = resp.json
+        self.assertEqual(len(results), 4)
+        self.assertEqual([entry['id'] for entry in results],
+                         [fileId, fileId2, fileId, fileId])
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params={'sort': 'town', 'limit': 5})
+        self.assertEqual(results[0]['mimeType'], 'application/json')
+        self.assertEqual(results[0]['data'], resp.json)
+        self.assertEqual(results[1]['mimeType'], 'text/csv')
+        self.assertEqual(len(results[1]['data'].split('\r\n')), 5)
+        self.assertEqual(results[1]['data'].split('\r\n', 1)[0], 'town,pop2010')
+        self.assertEqual(results[2]['data']['data'], [{'town': 'BOSTON'}])
+        self.assertEqual(results[3]['data']['datacount'], 50)
+        # Output that is too large is an error
+        maxSize = query.MAX_BATCH_ENTRY_SIZE
+        query.MAX_BATCH_ENTRY_SIZE = len(results[1]['data']) + 10
+        try:
+            resp = self.request(
+                method='POST', path='/database_assetstore/select/batch',
+                user=self.user, type='application/json', body=json.dumps(queries))
+        finally:
+            query.MAX_BATCH_ENTRY_SIZE = maxSize
+        self.assertStatusOk(resp)
+        self.assertIn('larger than', resp.json[0]['error'])
+        self.assertEqual(resp.json[1], results[1])
+        # Invalid queries fail the whole batch
+        for badQueries, status, message in [
+                ({}, 400, 'non-empty JSON list'),
+                ([5], 400, 'Query 0 must be an object'),
+                ([{'id': fileId, 'params': 5}], 400, 'params must be an object'),
+                (queries + [[fileId3]], 400, 'Query 4: file is not a database'),
+                ([[fileId, {'sort': 'notafield'}]], 400, 'Query 0: Sort must use'),
+                ([[fileId, {'format': 'arrow'}]], 400, 'can\'t be used in a batch'),
+                ([[fileId, {'limit': 'none'}]], 400, 'must have a limit'),
+                ([[fileId, {'wait': 1}]], 400, 'must have a limit and can\'t wait'),
+                ([[fileId]] * 101, 400, 'at most 100 queries')]:
+            resp = self.request(
+                method='POST', path='/database_assetstore/select/batch',
+                user=self.user, type='application/json',
+                body=json.dumps(badQueries))
+            self.assertStatus(resp, status)
+            self.assertIn(message, resp.json['message'])
+        # Files must be readable
+        privateFolder = next(
+            folder for folder in Folder().childFolders(
+                self.admin, 'user', user=self.admin)
+            if folder['name'] == 'Private')
+        Item().move(self.item2, privateFolder)
+        resp = self.request(
+            method='POST', path='/database_assetstore/select/batch',
+            user=self.user, type='application/json', body=json.dumps(queries))
+        self.assertStatus(resp, 403)
+
+    def testFileDatabaseSelectPartitions(self):
+        fileId, fileId2, fileId3 = self._setupDbFiles()
+        params = {'limit': 'none', 'fields': 'town,pop2010', 'pop2010_gt': 10000}
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatusOk(resp)
+        expected = sorted(resp.json['data'])
+        self.assertGreater(len(expected), 20)
+        for fid in (fileId, fileId2):
+            for ordered in ('true', 'false'):
+                params.update({'partitions': 4, 'ordered': ordered})
+                resp = self.request(path='/file/%s/database/select' % (
+                    fid, ), user=self.user, params=params)
+                self.assertStatusOk(resp)
+                self.assertEqual(resp.json['datacount'], len(expected))
+                self.assertEqual(sorted(resp.json['data']), expected)
+            params['format'] = 'csv'
+            resp = self.request(path='/file/%s/database/select' % (
+                fid, ), user=self.user, params=params, isJson=False)
+            self.assertStatusOk(resp)
+            self.assertEqual(len(self.getBody(resp).split('\r\n')), len(expected) + 2)
+            del params['format']
+        # Invalid parameters
+        for extra, message in [
+                ({'partitions': 'x'}, 'partitions must be an integer'),
+                ({'partitions': 9}, 'partitions must be an integer'),
+                ({'partitions': 4, 'limit': 10}, 'require a limit of none'),
+                ({'partitions': 4, 'offset': 10}, 'require a limit of none'),
+                ({'partitions': 4, 'clientid': 'a'}, 'or clientid'),
+                ({'partitions': 4, 'sort': 'town'}, 'can only be sorted by')]:
+            resp = self.request(path='/file/%s/database/select' % (
+                fileId, ), user=self.user, params=dict(params, **extra))
+            self.assertStatus(resp, 400)
+            self.assertIn(message, resp.json['message'])
+        # If the shared partition pool is busy, a single query is run.
+        # Partition threads are reserved until the output is read or
+        # discarded.
+        from girder.plugins.database_assetstore import assetstore, query
+
+        params['partitions'] = 4
+        query._partitionWorkers['reserved'] = query.DEFAULT_PARTITION_WORKERS - 1
+        try:
+            resp = self.request(path='/file/%s/database/select' % (
+                fileId, ), user=self.user, params=params)
+        finally:
+            query._partitionWorkers['reserved'] = 0
+        self.assertStatusOk(resp)
+        self.assertEqual(sorted(resp.json['data']), expected)
+        resultFunc, mimeType = query.queryDatabase(
+            fileId, assetstore.getDbInfoForFile(File().load(fileId, force=True)),
+            dict(params, pop2010_gt=10001))
+        self.assertEqual(query._partitionWorkers['reserved'], 4)
+        del resultFunc
+        self.assertEqual(query._partitionWorkers['reserved'], 0)
+
+    def testFileDatabaseSelectParquet(self):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+        fileId, fileId2, fileId3 = self._setupDbFiles()
+        params = {
+            'sort': 'town',
+            'limit': 25,
+            'fields': 'town,pop2010',
+        }
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatusOk(resp)
+        listData = resp.json
+        params['format'] = 'parquet'
+        params['rowgroupsize'] = 10
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params, isJson=False)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.headers['Content-Type'],
+                         'application/vnd.apache.parquet')
+        parquetFile = pyarrow.parquet.ParquetFile(io.BytesIO(self.getBody(
+            resp, text=False)))
+        self.assertEqual(parquetFile.metadata.num_row_groups, 3)
+        self.assertEqual(parquetFile.metadata.row_group(0).column(
+            0).compression.lower(), 'snappy')
+        table = parquetFile.read()
+        self.assertEqual(table.schema.names, listData['fields'])
+        self.assertEqual(table.column('town').to_pylist(),
+                         [row[0] for row in listData['data']])
+        self.assertEqual([int(value) for value in table.column(
+            'pop2010').to_pylist()], [int(row[1]) for row in listData['data']])
+        params['compression'] = 'none'
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params, isJson=False)
+        self.assertStatusOk(resp)
+        parquetFile = pyarrow.parquet.ParquetFile(io.BytesIO(self.getBody(
+            resp, text=False)))
+        self.assertEqual(parquetFile.metadata.row_group(0).column(
+            0).compression.lower(), 'uncompressed')
+        # Bad parameters
+        params['compression'] = 'unknown'
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatus(resp, 400)
+        self.assertIn('compression must be one of', resp.json['message'])
+        params['compression'] = 'zstd'
+        params['rowgroupsize'] = 0
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatus(resp, 400)
+        self.assertIn('rowgroupsize must be', resp.json['message'])
+
+    def testFileDatabaseSelectCompression(self):
+        from girder.plugins.database_assetstore import query
+
+        fileId, fileId2, fileId3 = self._setupDbFiles()
+        params = {'sort': 'town', 'limit': 100, 'format': 'csv'}
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params, isJson=False)
+        self.assertStatusOk(resp)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        data = self.getBody(resp)
+        # Compression is off by default
+        self.assertEqual(query.compressionLevel, 0)
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params, isJson=False,
+            additionalHeaders=[('Accept-Encoding', 'gzip')])
+        self.assertStatusOk(resp)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(self.getBody(resp), data)
+        resp = self.request(
+            method='PUT', path='/system/setting', user=self.admin, params={
+                'key': 'database_assetstore.compression_level', 'value': 6})
+        self.assertStatusOk(resp)
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params, isJson=False,
+            additionalHeaders=[('Accept-Encoding', 'gzip, deflate')])
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        compressed = self.getBody(resp, text=False)
+        self.assertLess(len(compressed), len(data))
+        self.assertEqual(zlib.decompress(
+            compressed, 16 + zlib.MAX_WBITS).decode('utf8'), data)
+        if query.zstandard is not None:
+            resp = self.request(path='/file/%s/database/select' % (
+                fileId, ), user=self.user, params=params, isJson=False,
+                additionalHeaders=[('Accept-Encoding', 'gzip;q=0.5, zstd')])
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.headers['Content-Encoding'], 'zstd')
+            self.assertEqual(query.zstandard.ZstdDecompressor().decompressobj(
+            ).decompress(self.getBody(resp, text=False)).decode('utf8'), data)
+        # A compression level of 0 disables compression
+        resp = self.request(
+            method='PUT', path='/system/setting', user=self.admin, params={
+                'key': 'database_assetstore.compression_level', 'value': 0})
+        self.assertStatusOk(resp)
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params, isJson=False,
+            additionalHeaders=[('Accept-Encoding', 'gzip')])
+        self.assertStatusOk(resp)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(self.getBody(resp), data)
+        resp = self.request(
+            method='PUT', path='/system/setting', user=self.admin, params={
+                'key': 'database_assetstore.compression_level', 'value': 10})
+        self.assertStatus(resp, 400)
+        self.assertIn('Compression level must be', resp.json['message'])
+        resp = self.request(
+            method='PUT', path='/system/setting', user=self.admin, params={
+                'key': 'database_assetstore.compression_level',
+                'value': query.DEFAULT_COMPRESSION_LEVEL})
+        self.assertStatusOk(resp)
+
+    def testFileDatabaseSelectCost(self):
+        from girder.plugins.database_assetstore import assetstore, dbs, query
+
+        fileId, fileId2, fileId3 = self._setupDbFiles({'dbmaxcost': 0.001})
+        self.assertEqual(self.assetstore1['database']['maxcost'], 0.001)
+        conn = dbs.getDBConnector(
+            fileId, assetstore.getDbInfoForFile(self.file1))
+        estimate = conn.estimateCost(conn.getFieldInfo(), {}, [])
+        self.assertGreater(estimate['cost'], 0.001)
+        self.assertGreater(estimate['rows'], 0)
+        params = {'limit': 5}
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatus(resp, 400)
+        self.assertIn('estimated cost of the query is', resp.json['message'])
+        self.assertIn('more than the limit of 0.001', resp.json['message'])
+        # The generic connector can't estimate costs, so it isn't limited
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId2, ), user=self.user, params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json['data']), 5)
+        # Queued queries run one at a time
+        conn.costAction = 'queue'
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json['data']), 5)
+        self.assertEqual(query._costQueueRunning, {})
+        # A query that has held the queue for too long is no longer waited for
+        stale = (time.time() - query.COST_QUEUE_TIMEOUT - 1, object())
+        query._costQueueRunning[conn.databaseUri] = stale
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json['data']), 5)
+        self.assertEqual(query._costQueueRunning, {})
+        # Unknown cost actions are rejected
+        resp = self.request(method='POST', path='/assetstore', user=self.admin,
+                            params=dict(self.dbParams, name='Assetstore 3',
+                                        dbcostaction='unknown'))
+        self.assertStatus(resp, 400)
+        self.assertIn('Invalid costaction value', resp.json['message'])
+
     def testFileDatabaseSelectClient(self):
         fileId, fileId2, fileId3 = self._setupDbFiles()
         params = {'sort': 'town', 'limit': 1, 'clientid': 'test'}
@@ -1106,6 +1573,11 @@ class FileTest(base.TestCase):
         # We should be tracking the a session for 'test'
         self.assertIn('test', sessions)
         self.assertFalse(sessions['test']['used'])
+        resp = self.request(path='/database_assetstore/sessions', user=self.user)
+        self.assertStatus(resp, 403)
+        resp = self.request(path='/database_assetstore/sessions', user=self.admin)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json[fileId], {'live': 1, 'idle': 1, 'inUse': 0})
         last = sessions['test'].copy()
         # A new request should update the last used time
         resp = self.request(path='/file/%s/database/select' % (
@@ -1120,6 +1592,41 @@ class FileTest(base.TestCase):
             fileId, ), user=self.user, params=params)
         self.assertStatusOk(resp)
         self.assertNotEqual(sessions['test']['session'], last['session'])
+        self.assertEqual(len(sessions), 1)
+        # Expired sessions are closed in the background, and sessions held
+        # too long are dropped without being closed from another thread
+        from girder.plugins.database_assetstore.dbs import sqlalchemydb
+        registry = sqlalchemydb.SessionRegistry(0.1, 0.5)
+        closed = []
+
+        class Session(object):
+            def close(self):
+                closed.append(self)
+
+        held = Session()
+        registry.add('idle', Session())
+        registry.add('held', held)
+        self.assertTrue(registry.release('idle', registry['idle']['session']))
+        self.assertEqual(registry.counts(), {'live': 2, 'idle': 1, 'inUse': 1})
+        time.sleep(0.3)
+        self.assertEqual(list(registry), ['held'])
+        time.sleep(0.5)
+        self.assertEqual(len(registry), 0)
+        self.assertEqual(len(closed), 1)
+        self.assertNotIn(held, closed)
+        # The query using a dropped session closes it when it releases it
+        self.assertFalse(registry.release('held', held))
+        # Claiming a session that is in use drops it and returns its canceller
+        cancelled = []
+        registry.add('busy', held)
+        self.assertTrue(registry.setCanceller(
+            'busy', held, lambda: cancelled.append(True)))
+        sess, cancel = registry.claim('busy')
+        self.assertIsNone(sess)
+        cancel()
+        self.assertEqual(cancelled, [True])
+        self.assertNotIn('busy', registry)
+        self.assertFalse(registry.setCanceller('busy', held, None))
         # Send a slow query in a thread.  Use pg_sleep, as it produces more
         # consistent tests.  Before, we were using
         #   {'func': 'st_hausdorffdistance', 'param': [
@@ -1171,6 +1678,343 @@ class FileTest(base.TestCase):
             'Internal server error' in slowResults['exc'] or
             'InterruptedException' in slowResults['exc'])
 
+    def testFileDatabaseSelectClientOtherProcess(self):
+        fileId, fileId2, fileId3 = self._setupDbFiles()
+        from girder.plugins.database_assetstore import dbs, assetstore
+        from girder.plugins.database_assetstore.clientquery import ClientQuery
+        dbinfo = assetstore.getDbInfoForFile(self.file1)
+        connector = dbs.getDBConnector(fileId, dbinfo)
+        connector._allowedFunctions['pg_sleep'] = True
+        params = {'sort': 'town', 'limit': 1, 'clientid': 'cluster'}
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatusOk(resp)
+        # Finished queries are no longer recorded
+        self.assertIsNone(ClientQuery().findOne({'client': 'cluster'}))
+        slowParams = dict(params, limit=500, fields=json.dumps([
+            'town', {'func': 'pg_sleep', 'param': [40]}]))
+        slowResults = {}
+
+        def slowQuery():
+            try:
+                self.request(path='/file/%s/database/select' % (
+                    fileId, ), user=self.user, params=slowParams)
+            except Exception as exc:
+                slowResults['exc'] = repr(exc)
+
+        slow = threading.Thread(target=slowQuery)
+        slow.start()
+        while (ClientQuery().findOne({'client': 'cluster'}) is None and
+                slow.is_alive()):
+            time.sleep(0.05)
+        record = ClientQuery().findOne({'client': 'cluster'})
+        self.assertIsInstance(record['backend']['pid'], int)
+        self.assertGreater(record['expires'], record['created'])
+        # A record whose backend has moved on to another transaction doesn't
+        # cancel the backend's query
+        other = dbs.getDBConnector(None, dbinfo)
+        other.getFieldInfo()
+        other._cancelBackend(dict(
+            record['backend'], xactStart='2000-01-01 00:00:00+00'))
+        time.sleep(1)
+        self.assertTrue(slow.is_alive())
+        # Pretend that another process is running the slow query.  A
+        # connector that doesn't know about the query's session should
+        # cancel it.
+        ClientQuery().update({'_id': record['_id']}, {'$set': {'process': 'other'}})
+        result = other.performSelect(
+            other.getFieldInfo(), {'limit': 1, 'fields': ['town']}, [], 'cluster')
+        self.assertEqual(len(list(result['data'])), 1)
+        slow.join()
+        self.assertTrue(
+            'canceling statement due to user' in slowResults['exc'] or
+            'Internal server error' in slowResults['exc'])
+        # Expired records from other processes are ignored
+        ClientQuery().claim('scope', 'stale', {'pid': 1})
+        ClientQuery().update({'client': 'stale'}, {'$set': {'process': 'other'}})
+        self.assertEqual(ClientQuery().claim('scope', 'stale', {'pid': 2}, 1)[1], {'pid': 1})
+        ClientQuery().update({'client': 'stale'}, {'$set': {'process': 'other'}})
+        time.sleep(1.5)
+        self.assertIsNone(ClientQuery().claim('scope', 'stale', {'pid': 3})[1])
+
+    def testFileDatabaseSelectMaxTime(self):
+        fileId, fileId2, fileId3 = self._setupDbFiles()
+        for path in ('select', 'count'):
+            resp = self.request(path='/file/%s/database/%s' % (
+                fileId, path), user=self.user, params={'maxtime': 'bad'})
+            self.assertStatus(resp, 400)
+            self.assertIn('maxtime must be', resp.json['message'])
+        from girder.plugins.database_assetstore import dbs, assetstore, query
+        connector = dbs.getDBConnector(fileId, assetstore.getDbInfoForFile(
+            self.file1))
+        self.assertIsNone(query.getMaxTime(connector, {}))
+        self.assertEqual(query.getMaxTime(connector, {'maxtime': '5'}), 5)
+        # The assetstore's maximum time is the default and the limit
+        connector.maxTime = 2
+        try:
+            self.assertEqual(query.getMaxTime(connector, {}), 2)
+            self.assertEqual(query.getMaxTime(connector, {'maxtime': 5}), 2)
+            self.assertEqual(query.getMaxTime(connector, {'maxtime': 1}), 1)
+        finally:
+            connector.maxTime = None
+        # A slow query is cancelled by the database
+        connector._allowedFunctions['pg_sleep'] = True
+        params = {
+            'sort': 'town', 'limit': 5, 'maxtime': 0.5,
+            'fields': json.dumps(['town', {'func': 'pg_sleep', 'param': [40]}])}
+        starttime = time.time()
+        try:
+            resp = self.request(path='/file/%s/database/select' % (
+                fileId, ), user=self.user, params=params)
+            self.assertStatus(resp, 500)
+        except Exception as exc:
+            self.assertIn('statement timeout', repr(exc))
+        self.assertLess(time.time() - starttime, 20)
+
+    def testFileDatabaseSelectStreaming(self):
+        fileId, fileId2, fileId3 = self._setupDbFiles()
+        from girder.plugins.database_assetstore import dbs, assetstore
+        conn = dbs.getDBConnector(fileId, assetstore.getDbInfoForFile(
+            self.file1))
+        fields = conn.getFieldInfo()
+        queryProps = {
+            'sort': [('town', 1)], 'fields': ['town'], 'limit': 5,
+            'stream': True}
+        result = conn.performSelect(fields, queryProps, [], 'stream')
+        self.assertFalse(isinstance(result['data'], list))
+        # The session is in use until the results have been read
+        self.assertTrue(conn.sessions['stream']['used'])
+        data = list(result['data'])
+        self.assertEqual(len(data), 5)
+        self.assertEqual(data[0][0], 'ABINGTON')
+        self.assertFalse(conn.sessions['stream']['used'])
+        # Closing the results early also releases the session
+        result = conn.performSelect(fields, queryProps, [], 'stream')
+        self.assertEqual(next(result['data'])[0], 'ABINGTON')
+        self.assertTrue(conn.sessions['stream']['used'])
+        result['data'].close()
+        self.assertFalse(conn.sessions['stream']['used'])
+        # Streamed output should be the same as unstreamed output
+        params = {'sort': 'town', 'limit': 'none', 'format': 'csv'}
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params, isJson=False)
+        self.assertStatusOk(resp)
+        data = self.getBody(resp)
+        self.assertGreater(len(data.split('\r\n')), 100)
+        conn.batchSize = 7
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params, isJson=False)
+        self.assertStatusOk(resp)
+        self.assertEqual(self.getBody(resp), data)
+        # JSON output is encoded incrementally and should match the pretty
+        # output, which is rendered all at once.
+        for format in ('list', 'dict', 'json'):
+            params = {'sort': 'town', 'limit': 'none', 'format': format}
+            resp = self.request(path='/file/%s/database/select' % (
+                fileId, ), user=self.user, params=params, isJson=False)
+            self.assertStatusOk(resp)
+            data = json.loads(self.getBody(resp))
+            params['pretty'] = 'true'
+            resp = self.request(path='/file/%s/database/select' % (
+                fileId, ), user=self.user, params=params, isJson=False)
+            self.assertStatusOk(resp)
+            self.assertEqual(json.loads(self.getBody(resp)), data)
+            if format != 'json':
+                self.assertEqual(data['datacount'], len(data['data']))
+                self.assertGreater(data['datacount'], 100)
+
+    def testFileDatabaseSelectCache(self):
+        fileId, fileId2, fileId3 = self._setupDbFiles()
+        from girder.plugins.database_assetstore import query
+
+        query.resultCache.clear()
+        stats = query.resultCache.stats()
+        params = {'sort': 'town', 'limit': 5, 'format': 'csv'}
+        # Without a cache time-to-live, results aren't cached
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params, isJson=False)
+        self.assertStatusOk(resp)
+        data = self.getBody(resp)
+        self.assertEqual(query.resultCache.stats()['misses'], stats['misses'])
+        resp = self.request(
+            method='POST', path='/file/%s/database' % fileId, user=self.admin,
+            body=json.dumps({'cachettl': 'bad'}), type='application/json')
+        self.assertStatus(resp, 400)
+        self.assertIn('cachettl', resp.json['message'])
+        resp = self.request(
+            method='POST', path='/file/%s/database' % fileId, user=self.admin,
+            body=json.dumps({'cachettl': 60}), type='application/json')
+        self.assertStatusOk(resp)
+        for _ in range(3):
+            resp = self.request(path='/file/%s/database/select' % (
+                fileId, ), user=self.user, params=params, isJson=False)
+            self.assertStatusOk(resp)
+            self.assertEqual(self.getBody(resp), data)
+        resp = self.request(path='/database_assetstore/cache', user=self.user)
+        self.assertStatus(resp, 403)
+        resp = self.request(path='/database_assetstore/cache', user=self.admin)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['entries'], 1)
+        self.assertEqual(resp.json['misses'], stats['misses'] + 1)
+        self.assertEqual(resp.json['hits'], stats['hits'] + 2)
+        # Different queries are cached separately
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=dict(params, offset=1),
+            isJson=False)
+        self.assertStatusOk(resp)
+        self.assertNotEqual(self.getBody(resp), data)
+        self.assertEqual(query.resultCache.stats()['entries'], 2)
+        # Refreshing the file discards its entries
+        resp = self.request(method='PUT', path='/file/%s/database/refresh' % (
+            fileId, ), user=self.user)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['refreshed'], True)
+        self.assertEqual(query.resultCache.stats()['entries'], 0)
+        # The memory budget limits what is cached.  By default, one result
+        # can only use a small share of it.
+        resp = self.request(
+            method='PUT', path='/system/setting', user=self.admin, params={
+                'key': 'database_assetstore.result_cache_size',
+                'value': len(data) + 10})
+        self.assertStatusOk(resp)
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params, isJson=False)
+        self.assertEqual(query.resultCache.stats()['entries'], 0)
+        query.resultCache.entryShare = 1
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params, isJson=False)
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=dict(params, offset=1),
+            isJson=False)
+        stats = query.resultCache.stats()
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['evictions'], 1)
+        resp = self.request(
+            method='PUT', path='/system/setting', user=self.admin, params={
+                'key': 'database_assetstore.result_cache_size', 'value': 0})
+        self.assertStatusOk(resp)
+        self.assertEqual(query.resultCache.stats()['entries'], 0)
+        # Changing the database link discards its entries
+        query.resultCache.maxSize = query.DEFAULT_RESULT_CACHE_SIZE
+        query.resultCache.entryShare = query.RESULT_CACHE_ENTRY_SHARE
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params, isJson=False)
+        self.assertEqual(query.resultCache.stats()['entries'], 1)
+        resp = self.request(
+            method='POST', path='/file/%s/database' % fileId, user=self.admin,
+            body=json.dumps({'cachettl': None}), type='application/json')
+        self.assertStatusOk(resp)
+        self.assertEqual(query.resultCache.stats()['entries'], 0)
+
+    def testFileDatabaseConnectorCache(self):
+        from girder.plugins.database_assetstore import dbs
+
+        fileId, fileId2, fileId3 = self._setupDbFiles()
+        cache = dbs.base._connectorCache
+        params = {'sort': 'town', 'limit': 1, 'clientid': 'test'}
+        for id in (fileId2, fileId):
+            resp = self.request(path='/file/%s/database/select' % (
+                id, ), user=self.user, params=params)
+            self.assertStatusOk(resp)
+        resp = self.request(path='/database_assetstore/connectors', user=self.user)
+        self.assertStatus(resp, 403)
+        resp = self.request(path='/database_assetstore/connectors', user=self.admin)
+        self.assertStatusOk(resp)
+        stats = resp.json
+        self.assertEqual(stats['maxSize'], dbs.base.DEFAULT_CONNECTOR_CACHE_SIZE)
+        # A cached connector is reused
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(cache.stats()['hits'], stats['hits'] + 1)
+        self.assertEqual(cache.stats()['misses'], stats['misses'])
+        # Shrinking the cache discards the least recently used connectors
+        resp = self.request(
+            method='PUT', path='/system/setting', user=self.admin, params={
+                'key': 'database_assetstore.connector_cache_size', 'value': -1})
+        self.assertStatus(resp, 400)
+        self.assertIn('Connector cache size must be', resp.json['message'])
+        resp = self.request(
+            method='PUT', path='/system/setting', user=self.admin, params={
+                'key': 'database_assetstore.connector_cache_size', 'value': 1})
+        self.assertStatusOk(resp)
+        self.assertEqual(len(cache), 1)
+        self.assertIn(fileId, cache)
+        self.assertNotIn(fileId2, cache)
+        self.assertGreater(cache.stats()['evictions'], stats['evictions'])
+        # Unused connectors expire and close their idle sessions
+        conn = cache[fileId]
+        self.assertEqual(len(conn.sessions), 1)
+        resp = self.request(
+            method='PUT', path='/system/setting', user=self.admin, params={
+                'key': 'database_assetstore.connector_cache_ttl', 'value': 0.5})
+        self.assertStatusOk(resp)
+        time.sleep(0.6)
+        cache.prune()
+        self.assertNotIn(fileId, cache)
+        self.assertEqual(len(conn.sessions), 0)
+        # When caching is disabled, connectors aren't cached or closed
+        resp = self.request(
+            method='PUT', path='/system/setting', user=self.admin, params={
+                'key': 'database_assetstore.connector_cache_size', 'value': 0})
+        self.assertStatusOk(resp)
+        for _ in range(2):
+            resp = self.request(path='/file/%s/database/select' % (
+                fileId, ), user=self.user, params=params)
+            self.assertStatusOk(resp)
+            self.assertEqual(len(resp.json['data']), 1)
+        self.assertEqual(len(cache), 0)
+        for key, value in (
+                ('connector_cache_size', dbs.base.DEFAULT_CONNECTOR_CACHE_SIZE),
+                ('connector_cache_ttl', dbs.base.DEFAULT_CONNECTOR_CACHE_TTL)):
+            resp = self.request(
+                method='PUT', path='/system/setting', user=self.admin, params={
+                    'key': 'database_assetstore.' + key, 'value': value})
+            self.assertStatusOk(resp)
+
+    def testFileDatabaseEngines(self):
+        from girder.plugins.database_assetstore import assetstore, dbs
+
+        fileId, fileId2, fileId3 = self._setupDbFiles({
+            'dbpoolsize': 2, 'dbpoolpreping': 'true'})
+        self.assertEqual(self.assetstore1['database']['poolsize'], 2)
+        self.assertIs(self.assetstore1['database']['poolpreping'], True)
+        conn = dbs.getDBConnector(
+            fileId, assetstore.getDbInfoForFile(self.file1))
+        self.assertEqual(conn.engineParams, {'pool_size': 2, 'pool_pre_ping': True})
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params={'limit': 1})
+        self.assertStatusOk(resp)
+        resp = self.request(path='/database_assetstore/engines', user=self.user)
+        self.assertStatus(resp, 403)
+        resp = self.request(path='/database_assetstore/engines', user=self.admin)
+        self.assertStatusOk(resp)
+        pools = [pool for pool in resp.json['pools'] if pool.get('size') == 2]
+        self.assertEqual(len(pools), 1)
+        self.assertEqual(pools[0]['checkedOut'], 0)
+        self.assertGreaterEqual(pools[0]['checkedIn'], 1)
+        # The least recently used engines are disposed
+        registry = dbs.sqlalchemydb.EngineRegistry(1)
+        engine = registry.get(conn.databaseUri, pool_size=1)
+        engine.execute('SELECT 1')
+        self.assertEqual(engine.pool.checkedin(), 1)
+        self.assertIs(registry.get(conn.databaseUri, pool_size=1), engine)
+        registry.get(conn.databaseUri, pool_size=2)
+        self.assertEqual(len(registry), 1)
+        self.assertEqual(registry.stats()['evictions'], 1)
+        self.assertEqual(engine.pool.checkedin(), 0)
+        # Engines that a connector owns aren't disposed until it releases them
+        self.assertEqual(pools[0]['owners'], 1)
+        owned = registry.get(conn.databaseUri, conn, pool_size=3)
+        owned.execute('SELECT 1')
+        registry.get(conn.databaseUri, pool_size=4)
+        self.assertEqual(len(registry), 2)
+        self.assertEqual(owned.pool.checkedin(), 1)
+        registry.release(conn)
+        self.assertEqual(len(registry), 1)
+        self.assertEqual(owned.pool.checkedin(), 0)
+        registry.clear()
+
     def testFileDatabaseSelectPolling(self):
         # Create a test database connector so we can check polling
         from girder.plugins.database_assetstore import dbs
@@ -1247,6 +2091,28 @@ class FileTest(base.TestCase):
         self.assertGreater(dbInfo['queries'], lastCount + 3)
         self.assertLess(dbInfo['queries'], lastCount + 9)
         add.join()
+        # Polls are run by the shared scheduler, which has nothing left to do
+        self.assertEqual(dbs.base.pollScheduler.pending(), 0)
+        # If the scheduler's threads are busy, the request doesn't wait for
+        # them indefinitely
+        dbInfo['data'] = []
+        busy = threading.Event()
+        for _ in range(dbs.base.pollScheduler.maxWorkers):
+            dbs.base.pollScheduler.schedule(time.time(), lambda: busy.wait(30))
+        margin = dbs.base.POLL_TIMEOUT_MARGIN
+        dbs.base.POLL_TIMEOUT_MARGIN = 0.5
+        try:
+            starttime = time.time()
+            params = {'initwait': 0.2, 'poll': 0.5, 'wait': 1}
+            resp = self.request(path='/file/%s/database/select' % (
+                fileId, ), user=self.user, params=params)
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.json.get('data', []), [])
+            self.assertLess(time.time() - starttime, 10)
+        finally:
+            dbs.base.POLL_TIMEOUT_MARGIN = margin
+            busy.set()
+        dbInfo['data'] = [[2]]
 
         # Test if we have bad data we get an exception
         dbInfo['data'] = None
@@ -1284,3 +2150,240 @@ class FileTest(base.TestCase):
             fileId, ), user=self.user)
         self.assertStatus(resp, 400)
         self.assertIn('Unknown internal format', resp.json['message'])
+
+    def testFileDatabaseSelectNotify(self):
+        from girder.plugins.database_assetstore import assetstore, dbs
+
+        fileId, fileId2, fileId3 = self._setupDbFiles({
+            'dbnotifychannel': 'dbas_{table}'})
+        conn = dbs.getDBConnector(
+            fileId, assetstore.getDbInfoForFile(self.file1))
+        self.assertEqual(conn.notifyChannel, 'dbas_{table}')
+        notified = []
+        event = threading.Event()
+
+        def changed(listening):
+            notified.append(listening)
+            event.set()
+
+        unsubscribe = conn.subscribeToChanges(changed)
+        self.assertIsNotNone(unsubscribe)
+        engine = dbs.sqlalchemydb.getEngine(conn.databaseUri, **conn.dbparams)
+        engine.execute('NOTIFY dbas_towns')
+        self.assertTrue(event.wait(10))
+        self.assertEqual(notified, [True])
+        unsubscribe()
+        # The generic connector doesn't listen for notifications
+        conn2 = dbs.getDBConnector(
+            fileId2, assetstore.getDbInfoForFile(self.file2))
+        self.assertIsNone(conn2.subscribeToChanges(changed))
+
+        # A waiting select that is notified of a change queries again, and
+        # returns no data when the wait expires
+        def sendNotify(delay):
+            time.sleep(delay)
+            engine.execute('NOTIFY dbas_towns')
+
+        notify = threading.Thread(target=sendNotify, args=(0.5, ))
+        notify.start()
+        starttime = time.time()
+        params = {
+            'filters': json.dumps([['town', 'NOT A TOWN']]),
+            'wait': 1.5,
+            'poll': 100,
+        }
+        resp = self.request(path='/file/%s/database/select' % (
+            fileId, ), user=self.user, params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['data'], [])
+        self.assertGreater(time.time() - starttime, 1.4)
+        self.assertLess(time.time() - starttime, 10)
+        notify.join()
+
+    def testJsonEncoder(self):
+        import datetime
+        import decimal
+        from girder.plugins.database_assetstore.dbs import jsonencoder
+
+        kwargs = {'check_circular': False, 'separators': (',', ':'),
+                  'sort_keys': False, 'default': str, 'indent': None}
+        value = {'a': (1, 2.5, None), 'b': datetime.datetime(2017, 1, 2, 3, 4),
+                 'c': decimal.Decimal('1.50'), 'd': u'n\u0441\U0001f600', 3: [True]}
+        expected = json.dumps(value, **kwargs)
+        nonFinite = [float('nan'), float('inf')]
+        # orjson isn't used unless it is enabled
+        self.assertFalse(jsonencoder.useOrjson)
+        self.assertEqual(jsonencoder.jsonDumps(value, **kwargs), expected)
+        self.assertEqual(jsonencoder.jsonDumps(nonFinite, **kwargs), '[NaN,Infinity]')
+        resp = self.request(
+            method='PUT', path='/system/setting', user=self.admin, params={
+                'key': 'database_assetstore.fast_json', 'value': 'true'})
+        self.assertStatusOk(resp)
+        try:
+            self.assertTrue(jsonencoder.useOrjson)
+            self.assertEqual(jsonencoder.jsonDumps(value, **kwargs), expected)
+            self.assertEqual(
+                jsonencoder.jsonDumps(value, **dict(kwargs, ensure_ascii=False)),
+                json.dumps(value, **dict(kwargs, ensure_ascii=False)))
+            # A caller's default function is used
+            self.assertEqual(
+                jsonencoder.jsonDumps(value, **dict(kwargs, default=repr)),
+                json.dumps(value, **dict(kwargs, default=repr)))
+            # orjson writes non-finite floats as null
+            self.assertEqual(
+                jsonencoder.jsonDumps(nonFinite, **kwargs),
+                '[null,null]' if jsonencoder.orjson else '[NaN,Infinity]')
+            with self.assertRaises(ValueError):
+                jsonencoder.jsonDumps(nonFinite, **dict(kwargs, allow_nan=False))
+        finally:
+            resp = self.request(
+                method='PUT', path='/system/setting', user=self.admin, params={
+                    'key': 'database_assetstore.fast_json', 'value': 'false'})
+            self.assertStatusOk(resp)
+        # Pretty output is unchanged
+        self.assertEqual(
+            jsonencoder.jsonDumps(value, **dict(kwargs, indent=2)),
+            json.dumps(value, **dict(kwargs, indent=2)))
+        # Custom handlers can be registered
+        jsonencoder.registerJsonDefault(decimal.Decimal, float)
+        try:
+            self.assertEqual(jsonencoder.jsonDumps(
+                [decimal.Decimal('1.50')], **kwargs), '[1.5]')
+        finally:
+            jsonencoder.registerJsonDefault(decimal.Decimal, str)
+
+    def testCsvConversion(self):
+        import datetime
+        from girder.plugins.database_assetstore import query
+
+        result = {
+            'format': 'list',
+            'fields': ['a', 'b'],
+            'columns': {'a': 0, 'b': 1},
+            'data': [
+                [1, 'x'], [None, {'c': [1, 2]}], [True, None],
+                [datetime.datetime(2017, 1, 2), [3]], [2.5, 'z'], [3, 'y']],
+        }
+        expected = (
+            'a,b\r\n1,x\r\n,"{""c"":[1,2]}"\r\nTrue,\r\n'
+            '2017-01-02 00:00:00,[3]\r\n2.5,z\r\n3,y\r\n')
+        for batchSize in (1, 2, 100):
+            output = ''.join(query.convertSelectDataToCsv(
+                dict(result), batchSize=batchSize)())
+            self.assertEqual(output, expected)
+
+    def testSharedConcurrentQueries(self):
+        from girder.plugins.database_assetstore import dbs, query
+
+        dbInfo = {'queries': 0}
+
+        class SlowConnector(dbs.base.DatabaseConnector):
+            name = 'test_slow'
+
+            def __init__(self, *args, **kwargs):
+                super(SlowConnector, self).__init__(*args, **kwargs)
+                self.initialized = True
+
+            def getFieldInfo(self):
+                return [{'name': 'test', 'type': 'number'}]
+
+            def performSelect(self, fields, queryProps, *args, **kwargs):
+                dbInfo['queries'] += 1
+                time.sleep(0.5)
+                results = super(SlowConnector, self).performSelect(
+                    fields, queryProps, *args, **kwargs)
+                offset = queryProps['offset']
+                results['data'] = [[value] for value in range(offset, offset + 100)]
+                return results
+
+            @staticmethod
+            def validate(*args, **kwargs):
+                return True
+
+        dbs.base.registerConnectorClass(SlowConnector.name, SlowConnector, {})
+        dbinfo = {'uri': 'test_slow://nowhere/nowhere', 'table': 'slow'}
+        outputs = []
+
+        def select(params):
+            resultFunc, mimeType = query.queryDatabase(
+                'slowfile', dbinfo, params)
+            outputs.append(''.join(resultFunc()))
+
+        # Identical concurrent queries share one execution
+        shared = query.inFlightQueries.shared
+        threads = [threading.Thread(target=select, args=({'format': 'csv'}, ))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(dbInfo['queries'], 1)
+        self.assertEqual(query.inFlightQueries.shared, shared + 3)
+        self.assertEqual(len(outputs), 4)
+        self.assertEqual(len(set(outputs)), 1)
+        # Different queries are not shared
+        del outputs[:]
+        threads = [threading.Thread(target=select, args=(
+            {'format': 'csv', 'offset': offset}, )) for offset in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(dbInfo['queries'], 3)
+        self.assertEqual(len(set(outputs)), 2)
+        # Output that is too large to share is queried separately
+        maxSize = query.inFlightQueries.maxSize
+        query.inFlightQueries.maxSize = 10
+        try:
+            del outputs[:]
+            threads = [threading.Thread(target=select, args=(
+                {'format': 'csv'}, )) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(dbInfo['queries'], 5)
+            self.assertEqual(len(set(outputs)), 1)
+        finally:
+            query.inFlightQueries.maxSize = maxSize
+        # Output isn't buffered when no request is waiting for it
+        resultFunc, mimeType = query.queryDatabase('slowfile', dbinfo, {'format': 'csv'})
+        output = resultFunc()
+        next(output)
+        self.assertEqual(len(query.inFlightQueries._flights), 1)
+        self.assertIsNone(list(query.inFlightQueries._flights.values())[0]['chunks'])
+        list(output)
+        # Output that is discarded without being read releases the requests
+        # waiting for it
+        resultFunc, mimeType = query.queryDatabase(
+            'slowfile', dbinfo, {'format': 'csv', 'offset': 5})
+        follower = threading.Thread(target=select, args=(
+            {'format': 'csv', 'offset': 5}, ))
+        follower.start()
+        time.sleep(0.2)
+        resultFunc = None
+        follower.join(10)
+        self.assertFalse(follower.is_alive())
+        self.assertEqual(dbInfo['queries'], 8)
+        self.assertEqual(len(query.inFlightQueries._flights), 0)
+        # Sharing can be disabled
+        resp = self.request(
+            method='PUT', path='/system/setting', user=self.admin, params={
+                'key': 'database_assetstore.coalesce_size', 'value': 0})
+        self.assertStatusOk(resp)
+        try:
+            self.assertEqual(query.inFlightQueries.maxSize, 0)
+            del outputs[:]
+            threads = [threading.Thread(target=select, args=(
+                {'format': 'csv'}, )) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(dbInfo['queries'], 10)
+        finally:
+            resp = self.request(
+                method='PUT', path='/system/setting', user=self.admin, params={
+                    'key': 'database_assetstore.coalesce_size',
+                    'value': query.DEFAULT_COALESCE_SIZE})
+            self.assertStatusOk(resp)
@@ -25,10 +25,14 @@ from girder.api.v1.assetstore import Assetstore as AssetstoreResource
 from girder.constants import AccessType, AssetstoreType
 from girder.models.assetstore import Assetstore
 from girder.models.file import File
+from girder.models.setting import Setting
 from girder.utility.assetstore_utilities import setAssetstoreAdapter
 
 from . import assetstore
 from . import base
+from . import clientquery
+from . import dbs
+from . import query
 from .rest import DatabaseAssetstoreResource, fileResourceRoutes
 
 
@@ -43,17 +47,37 @@ def createAssetstore(event):
     params = event.info['params']
 
     if params.get('type') == AssetstoreType.DATABASE:
+        database = {
+            'dbtype': params.get('dbtype'),
+            'uri': params.get('dburi'),
+        }
+        updateConnectorOptions(database, params)
         event.addResponse(Assetstore().save({
             'type': AssetstoreType.DATABASE,
             'name': params.get('name'),
-            'database': {
-                'dbtype': params.get('dbtype'),
-                'uri': params.get('dburi'),
-            }
+            'database': database
         }))
         event.preventDefault()
 
 
+def updateConnectorOptions(database, params):
+    """
+    Copy optional connector settings from REST parameters to an assetstore's
+    database record.  A blank value removes a setting.
+
+    :param database: the assetstore's database record.  Modified.
+    :param params: the REST parameters.
+    """
+    for key in base.DB_CONNECTOR_OPTIONS:
+        value = params.get('db' + key)
+        if value is None:
+            continue
+        if value == '':
+            database.pop(key, None)
+        else:
+            database[key] = value
+
+
 def updateAssetstore(event):
     """
     When an assetstore is updated, make sure the result has a well-formed set
@@ -66,6 +90,9 @@ def updateAssetstore(event):
 
     if store['type'] == AssetstoreType.DATABASE:
         dbtype = params.get('dbtype', store['database']['dbtype'])
+        options = {key: store['database'][key]
+                   for key in base.DB_CONNECTOR_OPTIONS
+                   if key in store['database']}
         if dbtype == assetstore.DB_ASSETSTORE_USER_TYPE:
             store['database'] = {
                 'dbtype': dbtype
@@ -75,6 +102,8 @@ def updateAssetstore(event):
                 'dbtype': dbtype,
                 'uri': params.get('dburi', store['database']['uri'])
             }
+        store['database'].update(options)
+        updateConnectorOptions(store['database'], params)
 
 
 def validateFile(event):
@@ -87,6 +116,30 @@ def validateFile(event):
     assetstore.validateFile(event.info)
 
 
+def updateSettings(event):
+    """
+    When a plugin setting that is held in memory is changed, update it.
+
+    :param event: the setting save event.  info is the setting document.
+    """
+    if event.info.get('key') == base.PluginSettings.RESULT_CACHE_SIZE:
+        query.resultCache.maxSize = event.info['value']
+        if not event.info['value']:
+            query.resultCache.clear()
+    if event.info.get('key') == base.PluginSettings.COMPRESSION_LEVEL:
+        query.compressionLevel = event.info['value']
+    if event.info.get('key') == base.PluginSettings.COALESCE_SIZE:
+        query.inFlightQueries.maxSize = event.info['value']
+    if event.info.get('key') == base.PluginSettings.CONNECTOR_CACHE_SIZE:
+        dbs.base._connectorCache.maxSize = event.info['value']
+        dbs.base._connectorCache.prune()
+    if event.info.get('key') == base.PluginSettings.CONNECTOR_CACHE_TTL:
+        dbs.base._connectorCache.ttl = event.info['value']
+        dbs.base._connectorCache.prune()
+    if event.info.get('key') == base.PluginSettings.FAST_JSON:
+        dbs.jsonencoder.useOrjson = event.info['value']
+
+
 def load(info):
     """
     Load the plugin into Girder.
@@ -104,12 +157,49 @@ def load(info):
     events.bind('model.file.validate', 'database_assetstore', validateFile)
     events.bind('model.setting.validate', 'database_assetstore',
                 functools.partial(base.validateSettings, plugin_name=plugin_name))
+    events.bind('model.setting.save.after', 'database_assetstore', updateSettings)
+    query.resultCache.maxSize = Setting().get(base.PluginSettings.RESULT_CACHE_SIZE)
+    query.compressionLevel = Setting().get(base.PluginSettings.COMPRESSION_LEVEL)
+    query.inFlightQueries.maxSize = Setting().get(base.PluginSettings.COALESCE_SIZE)
+    dbs.base._connectorCache.maxSize = Setting().get(
+        base.PluginSettings.CONNECTOR_CACHE_SIZE)
+    dbs.base._connectorCache.ttl = Setting().get(base.PluginSettings.CONNECTOR_CACHE_TTL)
+    dbs.jsonencoder.useOrjson = Setting().get(base.PluginSettings.FAST_JSON)
+    dbs.base.clientQueryRegistry = clientquery.ClientQuery()
 
     (AssetstoreResource.createAssetstore.description
         .param('dbtype', 'The database type (for Database type).',
                required=False)
         .param('dburi', 'The database URI (for Database type).',
-               required=False))
+               required=False)
+        .param('dbbatchsize', 'The number of rows to fetch at a time when '
+               'streaming results (for Database type).', required=False,
+               dataType='int')
+        .param('dbnotifychannel', 'A Postgres notification channel that '
+               'signals changes to the data.  {table} and {schema} are '
+               'replaced by the names of the table and schema of each file '
+               '(for Database type).', required=False)
+        .param('dbmaxcost', 'The maximum estimated cost of a select.  The '
+               'units depend on the database (for Database type).',
+               required=False, dataType='float')
+        .param('dbcostaction', 'What to do with selects that cost more than '
+               'dbmaxcost: reject them or queue them to run one at a time '
+               '(for Database type).', required=False,
+               enum=list(dbs.base.CostActions))
+        .param('dbmaxtime', 'The default and longest time in seconds that a '
+               'query may run before it is cancelled (for Database type).',
+               required=False, dataType='float')
+        .param('dbpoolsize', 'The number of connections to keep open to the '
+               'database (for SQL Database type).', required=False,
+               dataType='int')
+        .param('dbmaxoverflow', 'The number of connections that can be opened '
+               'beyond the pool size when it is exhausted (for SQL Database '
+               'type).', required=False, dataType='int')
+        .param('dbpoolrecycle', 'Replace pooled connections that are older '
+               'than this many seconds (for SQL Database type).',
+               required=False, dataType='int')
+        .param('dbpoolpreping', 'Test pooled connections before using them '
+               '(for SQL Database type).', required=False, dataType='boolean'))
 
     info['apiRoot'].database_assetstore = DatabaseAssetstoreResource()
 
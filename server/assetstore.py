@@ -18,9 +18,13 @@
 #############################################################################
 
 import cherrypy
+import collections
 import json
 import re
 import six
+import tempfile
+import threading
+import time
 from bson.objectid import ObjectId
 from six.moves import urllib
 
@@ -35,8 +39,301 @@ from girder.utility.abstract_assetstore_adapter import AbstractAssetstoreAdapter
 from girder.utility import assetstore_utilities
 
 from . import dbs
-from .base import PluginSettings, DB_ASSETSTORE_USER_TYPE, DB_INFO_KEY
-from .query import dbFormatList, queryDatabase, preferredFormat
+from .base import PluginSettings, DB_ASSETSTORE_USER_TYPE, DB_INFO_KEY, \
+    DB_CONNECTOR_OPTIONS
+from .query import dbFormatList, queryDatabase, preferredFormat, \
+    compressResultFunc, preferredEncoding, OutputRelease
+
+
+class RenderedOutput(object):
+    """
+    The rendered output of a query, stored in a temporary file that is kept in
+    memory until it exceeds a threshold.  This can be read by multiple
+    threads.  Each reader holds a reference to the output; once the output is
+    discarded and no references remain, the temporary file is closed.
+    """
+
+    def __init__(self, resultFunc, mimeType=None, maxMemory=16 * 1024 * 1024):
+        """
+        Render the output of a query.
+
+        :param resultFunc: a function that produces a generator for the
+            output.
+        :param mimeType: the mime type of the output.
+        :param maxMemory: the size in bytes above which the output is written
+            to disk.
+        """
+        self.mimeType = mimeType
+        self._file = tempfile.SpooledTemporaryFile(max_size=maxMemory)
+        self._lock = threading.Lock()
+        self._refs = 0
+        self._discarded = False
+        size = 0
+        try:
+            for chunk in resultFunc():
+                if not isinstance(chunk, six.binary_type):
+                    chunk = chunk.encode('utf8')
+                self._file.write(chunk)
+                size += len(chunk)
+        except Exception:
+            self._file.close()
+            raise
+        self.size = size
+
+    @property
+    def closed(self):
+        """
+        True if the temporary file has been closed.
+        """
+        return self._file is None
+
+    def acquire(self):
+        """
+        Add a reference to the output.
+
+        :returns: the output.
+        """
+        with self._lock:
+            if self._file is None:
+                raise GirderException('The rendered output is no longer available.')
+            self._refs += 1
+        return self
+
+    def release(self):
+        """
+        Remove a reference to the output.  If the output has been discarded
+        and this was the last reference, close its temporary file.
+        """
+        with self._lock:
+            self._refs -= 1
+            self._closeIfUnused()
+
+    def discard(self):
+        """
+        Mark the output as no longer needed.  Its temporary file is closed
+        once there are no references to it.
+        """
+        with self._lock:
+            self._discarded = True
+            self._closeIfUnused()
+
+    def _closeIfUnused(self):
+        """
+        Close the temporary file if the output is discarded and unreferenced.
+        This must be called while holding the lock.
+        """
+        if self._discarded and self._refs <= 0 and self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def readFunc(self, offset=0, endByte=None):
+        """
+        Get a function that produces a generator for part of the output.  The
+        function holds a reference to the output until a generator from it
+        finishes or the function is discarded; each generator holds its own
+        reference while it is read.
+
+        :param offset: the start byte of the output.
+        :param endByte: the end byte of the output (non-inclusive).  If None
+            or 0, read to the end of the output.
+        :returns: a function that produces a generator for the output.
+        """
+        endByte = min(endByte or self.size, self.size)
+        hold = OutputRelease(self.acquire().release)
+
+        def readResults():
+            self.acquire()
+            hold()
+            try:
+                pos = offset
+                while pos < endByte:
+                    with self._lock:
+                        self._file.seek(pos)
+                        chunk = self._file.read(min(65536, endByte - pos))
+                    if not chunk:
+                        break
+                    pos += len(chunk)
+                    yield chunk
+            finally:
+                self.release()
+
+        return readResults
+
+
+class RenderCache(object):
+    """
+    A cache of rendered query output so that range requests and size checks
+    for the same file and query don't rerun the query.  Entries are discarded
+    after a time-to-live, when there are too many of them, or when their total
+    size exceeds a budget.  A discarded entry's temporary file is closed once
+    nothing holds a reference to it.  Concurrent requests for the same key
+    share a single render.
+    """
+
+    def __init__(self, maxEntries=8, ttl=300, maxMemory=16 * 1024 * 1024,
+                 maxSize=256 * 1024 * 1024, timeout=60):
+        """
+        :param maxEntries: the maximum number of cached outputs.
+        :param ttl: the number of seconds a rendered output is reused.
+        :param maxMemory: the size in bytes above which each output is written
+            to disk.
+        :param maxSize: the maximum total size in bytes of the cached outputs.
+            Larger outputs are not cached.
+        :param timeout: the maximum number of seconds to wait for another
+            thread that is rendering the same output before rendering it
+            independently.
+        """
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.maxMemory = maxMemory
+        self.maxSize = maxSize
+        self.timeout = timeout
+        self._entries = collections.OrderedDict()
+        self._rendering = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _pop(self, key):
+        """
+        Remove an entry from the cache.  This must be called while holding the
+        lock.
+
+        :param key: the cache key.
+        :returns: the removed (expires, output) entry or None.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1].size
+        return entry
+
+    def _purge(self):
+        """
+        Remove expired entries and entries over the count and size limits from
+        the cache.  This must be called while holding the lock.
+
+        :returns: a list of removed outputs.
+        """
+        now = time.time()
+        removed = [self._pop(key)[1] for key, (expires, output) in list(
+            six.iteritems(self._entries)) if expires < now]
+        while self._entries and (len(self._entries) > self.maxEntries or
+                                 self._size > self.maxSize):
+            removed.append(self._pop(next(iter(self._entries)))[1])
+        return removed
+
+    def _getEntry(self, key):
+        """
+        Get an unexpired cached output and add a reference to it.  This must
+        be called while holding the lock.
+
+        :param key: the cache key.
+        :returns: a RenderedOutput object or None.
+        :returns: a list of removed outputs.
+        """
+        entry = self._pop(key)
+        if entry is None:
+            return None, []
+        if entry[0] < time.time():
+            return None, [entry[1]]
+        self._entries[key] = entry
+        self._size += entry[1].size
+        return entry[1].acquire(), []
+
+    def _renderUncached(self, resultFunc, mimeType):
+        """
+        Render output without caching it.  It is closed once the caller's
+        reference and any readers are done with it.
+
+        :param resultFunc: a function that produces a generator for the
+            output.
+        :param mimeType: the mime type of the output.
+        :returns: a RenderedOutput object with a reference for the caller.
+        """
+        output = RenderedOutput(resultFunc, mimeType, self.maxMemory).acquire()
+        output.discard()
+        return output
+
+    def add(self, key, resultFunc, mimeType=None):
+        """
+        Render output and cache it.  If the output is already cached or
+        another thread is rendering output for the same key, use that output.
+
+        :param key: the cache key.  If None, the output is rendered but not
+            cached.
+        :param resultFunc: a function that produces a generator for the
+            output.
+        :param mimeType: the mime type of the output.
+        :returns: a RenderedOutput object.  The caller holds a reference to it
+            and must release it.
+        """
+        if key is None or self.maxEntries <= 0:
+            return self._renderUncached(resultFunc, mimeType)
+        with self._lock:
+            output, removed = self._getEntry(key)
+            rendering = self._rendering.get(key)
+            if output is None and rendering is None:
+                rendering = self._rendering[key] = threading.Event()
+                leader = True
+            else:
+                leader = False
+        for entry in removed:
+            entry.discard()
+        if output is not None:
+            return output
+        if not leader:
+            rendering.wait(self.timeout)
+            output = self.get(key)
+            return output or self._renderUncached(resultFunc, mimeType)
+        removed = []
+        try:
+            output = RenderedOutput(resultFunc, mimeType, self.maxMemory).acquire()
+            with self._lock:
+                entry = self._pop(key)
+                if entry is not None:
+                    removed.append(entry[1])
+                if output.size <= self.maxSize:
+                    self._entries[key] = (time.time() + self.ttl, output)
+                    self._size += output.size
+                else:
+                    removed.append(output)
+                removed.extend(self._purge())
+        finally:
+            with self._lock:
+                if self._rendering.get(key) is rendering:
+                    del self._rendering[key]
+            rendering.set()
+            for entry in removed:
+                entry.discard()
+        return output
+
+    def get(self, key):
+        """
+        Get cached output.
+
+        :param key: the cache key.
+        :returns: a RenderedOutput object or None.  The caller holds a
+            reference to the output and must release it.
+        """
+        with self._lock:
+            output, removed = self._getEntry(key)
+        for entry in removed:
+            entry.discard()
+        return output
+
+    def invalidate(self, fileId):
+        """
+        Discard all cached output for a file.
+
+        :param fileId: the id of the file.
+        """
+        fileId = str(fileId)
+        with self._lock:
+            removed = [self._pop(key)[1] for key in list(self._entries) if key[0] == fileId]
+        for entry in removed:
+            entry.discard()
+
+
+renderCache = RenderCache()
 
 
 class DatabaseAssetstoreFile(dict):
@@ -54,7 +351,8 @@ class DatabaseAssetstoreFile(dict):
         """
         self._file = file
         self._adapter = adapter
-        self._loaded = None
+        self._output = None
+        self._outputRelease = None
         return super(DatabaseAssetstoreFile, self).__init__(file, *args, **kwargs)
 
     def __getitem__(self, key, *args, **kwargs):
@@ -65,16 +363,27 @@ class DatabaseAssetstoreFile(dict):
 
         See the base dict class for function details.
         """
-        if key in ('size', 'mimeType') and not self._loaded:
-            self._adapter.downloadFile(self._file, offset=1, headers=False, endByte=2)
-            dbinfo = getDbInfoForFile(self._file, self._adapter.assetstore)
-            params = getQueryParamsForFile(self._file, True)
-            resultFunc, mimeType = queryDatabase(self._file.get('_id'), dbinfo, params)
-            self._file['mimeType'] = mimeType
-            resultFunc, endByte = self._adapter._getDownloadSize(self._file, resultFunc, 0, 0)
-            self._loaded = True
+        if key in ('size', 'mimeType') and self._output is None:
+            self.renderedOutput()
         return super(DatabaseAssetstoreFile, self).__getitem__(key, *args, **kwargs)
 
+    def renderedOutput(self):
+        """
+        Get the rendered output of the file's default query.  This is rendered
+        once and then reused for the size, mime type, and reading the file.
+        The file holds a reference to the output until it is discarded.
+
+        :returns: a RenderedOutput object.
+        """
+        if self._output is None:
+            output = self._adapter.renderFile(self._file)
+            for key, value in (('size', output.size), ('mimeType', output.mimeType)):
+                self._file[key] = value
+                super(DatabaseAssetstoreFile, self).__setitem__(key, value)
+            self._output = output
+            self._outputRelease = OutputRelease(output.release)
+        return self._output
+
 
 class DatabaseAssetstoreAdapter(AbstractAssetstoreAdapter):
     def __init__(self, assetstore):
@@ -88,6 +397,12 @@ class DatabaseAssetstoreAdapter(AbstractAssetstoreAdapter):
         # Ensure that the assetstore is marked read-only
         doc['readOnly'] = True
         info = doc.get('database', {})
+        for key, func in six.iteritems(DB_CONNECTOR_OPTIONS):
+            if info.get(key) is not None:
+                try:
+                    info[key] = func(info[key])
+                except ValueError:
+                    raise ValidationException('Invalid %s value.' % key)
         dbtype = info.get('dbtype')
         if dbtype == DB_ASSETSTORE_USER_TYPE:
             return
@@ -153,12 +468,13 @@ class DatabaseAssetstoreAdapter(AbstractAssetstoreAdapter):
                 cherrypy.response.headers['Content-Range'] = \
                     'bytes %d-%d/%d' % (offset, endByte - 1, file['size'])
 
-    def _getDownloadSize(self, file, resultFunc, offset, endByte):
+    def _getDownloadSize(self, file, resultFunc, offset, endByte, key=None,
+                         output=None):
         """
-        Given a file and an output generator function, generate the output to
-        determine its total length, buffering the part that is needed for the
-        final output.  Adjust the file's size and the endByte value
-        accordingly.
+        Given a file and an output generator function, render the output to
+        determine its total length.  The output is kept so that the part that
+        is needed for the final output can be read from it.  Adjust the file's
+        size and the endByte value accordingly.
 
         :param file: the file used for the original generation.  Its size value
                      is updated.
@@ -166,39 +482,42 @@ class DatabaseAssetstoreAdapter(AbstractAssetstoreAdapter):
         :param offset: offset within the file information to output.
         :param endByte: the maximum index to output (the output is
                         data[offset:endByte]).
+        :param key: if not None, cache the rendered output with this key.
+        :param output: a RenderedOutput object to use rather than rendering
+            the output of resultFunc.
         :returns: a new function that produces a generator for the output.
         :returns: a new value for endByte.
         """
-        totallen = 0
-        skipped = 0
-        output = six.BytesIO()
-        for chunk in resultFunc():
-            if not isinstance(chunk, six.binary_type):
-                chunk = chunk.encode('utf8')
-            totallen += len(chunk)
-            if skipped < offset:
-                if skipped + len(chunk) <= offset:
-                    skipped += len(chunk)
-                    continue
-                else:
-                    chunk = chunk[offset - skipped:]
-                    skipped = offset
-            if endByte and totallen > endByte:
-                chunk = chunk[:endByte - totallen]
-            output.write(chunk)
-        output.seek(0)
-        file['size'] = totallen
-
-        def bufferResults():
-            while True:
-                chunk = output.read(65536)
-                if not chunk:
-                    break
-                yield chunk
-
+        if output is None:
+            output = renderCache.add(key, resultFunc, file.get('mimeType'))
+            try:
+                resultFunc = output.readFunc(offset, endByte)
+            finally:
+                output.release()
+        else:
+            resultFunc = output.readFunc(offset, endByte)
+        file['size'] = output.size
         if endByte is None or endByte > file['size']:
             endByte = file['size']
-        return bufferResults, endByte
+        return resultFunc, endByte
+
+    def renderFile(self, file):
+        """
+        Render the output of a file's default query.  Output that was rendered
+        recently is reused.
+
+        :param file: the file document.
+        :returns: a RenderedOutput object.  The caller holds a reference to it
+            and must release it.
+        """
+        params = getQueryParamsForFile(file, True)
+        key = renderCacheKey(file, params)
+        output = renderCache.get(key)
+        if output is None:
+            dbinfo = getDbInfoForFile(file, self.assetstore)
+            resultFunc, mimeType = queryDatabase(file.get('_id'), dbinfo, params)
+            output = renderCache.add(key, reyieldBytesFunc(resultFunc), mimeType)
+        return output
 
     def downloadFile(self, file, offset=0, headers=True, endByte=None,
                      contentDisposition=None, extraParameters=None, **kwargs):
@@ -242,15 +561,6 @@ class DatabaseAssetstoreAdapter(AbstractAssetstoreAdapter):
             params.update(extraParameters)
             if params.get('limit', 'notpresent') is None:
                 params['limit'] = 'none'
-        resultFunc, mimeType = queryDatabase(file.get('_id'), dbinfo, params)
-        # If we have been asked for inline data, change some mime types so
-        # most browsers will show the data inline, even if the actual mime type
-        # should be different (csv files are the clear example).
-        if contentDisposition == 'inline' and mimeType not in (
-                'application/json', 'text/plain'):
-            mimeType = 'text/plain'
-        file['mimeType'] = mimeType
-
         # If we have been asked for headers, recheck if we should have a range
         # request
         if headers and cherrypy.request.headers.get('Range'):
@@ -260,18 +570,56 @@ class DatabaseAssetstoreAdapter(AbstractAssetstoreAdapter):
                 # Currently we only support a single range.
                 offset, endByte = rangeHeader[0]
 
-        resultFunc = reyieldBytesFunc(resultFunc)
+        # Compress the response if the client accepts it.  Range requests are
+        # not compressed, since every range would require compressing the
+        # entire output.
+        encoding = None
+        if headers and not offset and endByte is None:
+            encoding = preferredEncoding(
+                cherrypy.request.headers.get('Accept-Encoding'),
+                preferredFormat(params.get('format')))
 
         # We often have to compute the response length.  This also handles
-        # partial range requests (though not very efficiently, as each
-        # request will requery the database, which may not be consistent).
+        # partial range requests.  The rendered output is cached, so a
+        # sequence of range requests only queries the database once.
         file['size'] = None
+        key = output = None
+        release = False
         if offset or endByte is not None:
-            resultFunc, endByte = self._getDownloadSize(
-                file, resultFunc, offset, endByte)
+            if isinstance(file, DatabaseAssetstoreFile) and not extraParameters:
+                output = file.renderedOutput()
+            else:
+                key = renderCacheKey(file, params)
+                output = renderCache.get(key)
+                release = output is not None
+        try:
+            if output is None:
+                resultFunc, mimeType = queryDatabase(file.get('_id'), dbinfo, params)
+                if encoding:
+                    resultFunc = compressResultFunc(resultFunc, encoding)
+                else:
+                    resultFunc = reyieldBytesFunc(resultFunc)
+            else:
+                resultFunc, mimeType = None, output.mimeType
+            file['mimeType'] = mimeType
+            if offset or endByte is not None:
+                resultFunc, endByte = self._getDownloadSize(
+                    file, resultFunc, offset, endByte, key, output)
+        finally:
+            if release:
+                output.release()
+        # If we have been asked for inline data, change some mime types so
+        # most browsers will show the data inline, even if the actual mime type
+        # should be different (csv files are the clear example).
+        if contentDisposition == 'inline' and file['mimeType'] not in (
+                'application/json', 'text/plain'):
+            file['mimeType'] = 'text/plain'
 
         if headers:
             self.setContentHeaders(file, offset, endByte, contentDisposition)
+            cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+            if encoding:
+                cherrypy.response.headers['Content-Encoding'] = encoding
             if endByte is not None and endByte - offset <= 0:
                 return lambda: b''
 
@@ -556,9 +904,12 @@ def getDbInfoForFile(file, assetstore=None):
         'collection': file[DB_INFO_KEY]['table']
 
     }
-    for key in ('database', 'schema'):
+    for key in ('database', 'schema', 'cachettl'):
         if key in file[DB_INFO_KEY]:
             dbinfo[key] = file[DB_INFO_KEY][key]
+    for key in DB_CONNECTOR_OPTIONS:
+        if assetstore['database'].get(key) is not None:
+            dbinfo[key] = assetstore['database'][key]
     return dbinfo
 
 
@@ -604,6 +955,17 @@ def getTableList(assetstore, uri=None, internalTables=False):
         dbparams=assetstore['database'].get('dbparams', {}))
 
 
+def renderCacheKey(file, params):
+    """
+    Get the key used to cache the rendered output of a file's query.
+
+    :param file: the file document.
+    :param params: the query parameters.
+    :returns: a hashable key.
+    """
+    return (str(file.get('_id')), json.dumps(params, sort_keys=True, default=str))
+
+
 def reyieldBytesFunc(func):
     """
     Given a generator function, return a generator function that always yields
@@ -645,6 +1007,15 @@ def validateFile(file):
         raise ValidationException(
             'File database information must have a non-blank uri value on an '
             'assetstore that doesn\'t specify a single database.')
+    if file[DB_INFO_KEY].get('cachettl') is not None:
+        try:
+            cachettl = float(file[DB_INFO_KEY]['cachettl'])
+        except (TypeError, ValueError):
+            cachettl = -1
+        if cachettl < 0:
+            raise ValidationException(
+                'File database information cachettl must be a non-negative '
+                'number.')
 
 
 def checkUserImport(user, uri, validateUri=True):
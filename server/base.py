@@ -1,5 +1,6 @@
 from bson.objectid import ObjectId
 import jsonschema
+import six
 
 from girder import logger as log
 from girder.constants import AssetstoreType, SettingKey
@@ -7,6 +8,9 @@ from girder.exceptions import ValidationException
 from girder.models.assetstore import Assetstore
 from girder.utility import setting_utilities, toBool
 
+from .dbs.base import CostActions, DEFAULT_CONNECTOR_CACHE_SIZE, DEFAULT_CONNECTOR_CACHE_TTL
+from .query import DEFAULT_COALESCE_SIZE, DEFAULT_COMPRESSION_LEVEL, DEFAULT_RESULT_CACHE_SIZE
+
 
 DB_INFO_KEY = 'databaseMetadata'
 
@@ -17,6 +21,35 @@ DB_ASSETSTORE_USER_NAME = 'User-authorized Database Assetstore'
 DB_ASSETSTORE_USER_TYPE = 'USER'
 
 
+def costAction(value):
+    """
+    Validate the action taken for selects that are too expensive.
+
+    :param value: one of CostActions.
+    :returns: the value.
+    """
+    if value not in CostActions:
+        raise ValueError('Invalid cost action.')
+    return value
+
+
+# Optional assetstore database settings that are passed to the database
+# connectors.  The values are the functions used to validate and convert the
+# settings.  When creating or updating an assetstore via the REST api, these
+# are specified with a 'db' prefix (e.g., dbbatchsize).
+DB_CONNECTOR_OPTIONS = {
+    'batchsize': int,
+    'notifychannel': six.text_type,
+    'maxcost': float,
+    'costaction': costAction,
+    'maxtime': float,
+    'poolsize': int,
+    'maxoverflow': int,
+    'poolrecycle': int,
+    'poolpreping': toBool,
+}
+
+
 _userDatabaseGroupsSchema = {
     'type': 'array',
     'items': {
@@ -38,13 +71,24 @@ _userDatabaseGroupsSchema = {
 class PluginSettings(object):
     USER_DATABASES = 'database_assetstore.user_databases'
     USER_DATABASES_GROUPS = 'database_assetstore.user_databases_groups'
+    RESULT_CACHE_SIZE = 'database_assetstore.result_cache_size'
+    COMPRESSION_LEVEL = 'database_assetstore.compression_level'
+    COALESCE_SIZE = 'database_assetstore.coalesce_size'
+    CONNECTOR_CACHE_SIZE = 'database_assetstore.connector_cache_size'
+    CONNECTOR_CACHE_TTL = 'database_assetstore.connector_cache_ttl'
+    FAST_JSON = 'database_assetstore.fast_json'
 
 
-@setting_utilities.validator(PluginSettings.USER_DATABASES)
+@setting_utilities.validator({PluginSettings.USER_DATABASES, PluginSettings.FAST_JSON})
 def _validateBoolean(doc):
     doc['value'] = toBool(doc['value'])
 
 
+@setting_utilities.default(PluginSettings.FAST_JSON)
+def _defaultFastJson():
+    return False
+
+
 @setting_utilities.validator(PluginSettings.USER_DATABASES_GROUPS)
 def _validateGroup(doc):
     if doc['value']:
@@ -54,6 +98,81 @@ def _validateGroup(doc):
             raise ValidationException('Invalid user database groups rules: ' + e.message)
 
 
+@setting_utilities.validator(PluginSettings.RESULT_CACHE_SIZE)
+def _validateResultCacheSize(doc):
+    try:
+        doc['value'] = int(doc['value'])
+    except (TypeError, ValueError):
+        doc['value'] = -1
+    if doc['value'] < 0:
+        raise ValidationException('Result cache size must be a non-negative integer.')
+
+
+@setting_utilities.default(PluginSettings.RESULT_CACHE_SIZE)
+def _defaultResultCacheSize():
+    return DEFAULT_RESULT_CACHE_SIZE
+
+
+@setting_utilities.validator(PluginSettings.COALESCE_SIZE)
+def _validateCoalesceSize(doc):
+    try:
+        doc['value'] = int(doc['value'])
+    except (TypeError, ValueError):
+        doc['value'] = -1
+    if doc['value'] < 0:
+        raise ValidationException('Coalesce size must be a non-negative integer.')
+
+
+@setting_utilities.default(PluginSettings.COALESCE_SIZE)
+def _defaultCoalesceSize():
+    return DEFAULT_COALESCE_SIZE
+
+
+@setting_utilities.validator(PluginSettings.COMPRESSION_LEVEL)
+def _validateCompressionLevel(doc):
+    try:
+        doc['value'] = int(doc['value'])
+    except (TypeError, ValueError):
+        doc['value'] = -1
+    if not 0 <= doc['value'] <= 9:
+        raise ValidationException('Compression level must be an integer from 0 to 9.')
+
+
+@setting_utilities.default(PluginSettings.COMPRESSION_LEVEL)
+def _defaultCompressionLevel():
+    return DEFAULT_COMPRESSION_LEVEL
+
+
+@setting_utilities.validator(PluginSettings.CONNECTOR_CACHE_SIZE)
+def _validateConnectorCacheSize(doc):
+    try:
+        doc['value'] = int(doc['value'])
+    except (TypeError, ValueError):
+        doc['value'] = -1
+    if doc['value'] < 0:
+        raise ValidationException('Connector cache size must be a non-negative integer.')
+
+
+@setting_utilities.default(PluginSettings.CONNECTOR_CACHE_SIZE)
+def _defaultConnectorCacheSize():
+    return DEFAULT_CONNECTOR_CACHE_SIZE
+
+
+@setting_utilities.validator(PluginSettings.CONNECTOR_CACHE_TTL)
+def _validateConnectorCacheTTL(doc):
+    try:
+        doc['value'] = float(doc['value'])
+    except (TypeError, ValueError):
+        doc['value'] = -1
+    if not doc['value'] >= 0:
+        raise ValidationException('Connector cache TTL must be a non-negative number.')
+
+
+@setting_utilities.default(PluginSettings.CONNECTOR_CACHE_TTL)
+def _defaultConnectorCacheTTL():
+    return DEFAULT_CONNECTOR_CACHE_TTL
+
+
 def _createUserAssetstore():
     """
     Add a general user assetstore if it doesn't exist.  This uses a fixed ID so
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import datetime
+import os
+import socket
+
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from girder.models.model_base import Model
+
+
+# Records of queries that are never released, such as when a Girder process
+# exits while running them, expire after the query's maximum time, or after
+# this many seconds if the query has no time limit.  Connectors also check
+# that a recorded query is still running before cancelling it.
+CLIENT_QUERY_TTL = 3600
+
+# Identifies this Girder process among all of the processes that share the
+# Girder database.
+PROCESS_ID = '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class ClientQuery(Model):
+    """
+    A record of the query that each client is running, shared by all Girder
+    processes that use the same Girder database.  Each record has the
+    backend connection that runs the query, so that a later query from the
+    same client can cancel it from any process.
+    """
+
+    def initialize(self):
+        self.name = 'database_assetstore_client_query'
+        self.ensureIndices([
+            ([('scope', 1), ('client', 1)], {'unique': True}),
+            ('expires', {'expireAfterSeconds': 0}),
+        ])
+
+    def validate(self, doc):
+        return doc
+
+    def claim(self, scope, client, backend, ttl=None):
+        """
+        Record that a client is running a query, replacing its previous query.
+
+        :param scope: the database and table that the client is querying.
+        :param client: the client id.
+        :param backend: the id of the query on the database, such as a
+            Postgres backend process id and transaction start time.
+        :param ttl: the number of seconds after which the record expires.
+            This should be the query's maximum time.  If None, this is
+            CLIENT_QUERY_TTL.
+        :returns: a token to pass to release when the query is done.
+        :returns: the backend id of the client's previous query if it may
+            still be running in another process, or None.
+        """
+        token = ObjectId()
+        now = datetime.datetime.utcnow()
+        update = {'$set': {
+            'token': token,
+            'process': PROCESS_ID,
+            'backend': backend,
+            'created': now,
+            'expires': now + datetime.timedelta(seconds=ttl or CLIENT_QUERY_TTL),
+        }}
+        try:
+            previous = self.collection.find_one_and_update(
+                {'scope': scope, 'client': client}, update, upsert=True,
+                return_document=ReturnDocument.BEFORE)
+        except DuplicateKeyError:
+            # Another process inserted the record first; replace it
+            previous = self.collection.find_one_and_update(
+                {'scope': scope, 'client': client}, update,
+                return_document=ReturnDocument.BEFORE)
+        # Queries in this process are cancelled by the connector
+        # Expired records may not have been removed yet
+        if (previous is None or previous.get('process') == PROCESS_ID or
+                previous.get('backend') == backend or
+                previous.get('expires', now) < now):
+            return token, None
+        return token, previous.get('backend')
+
+    def release(self, scope, client, token):
+        """
+        Record that a client's query is done.  If another query from the same
+        client has replaced it, this does nothing.
+
+        :param scope: the database and table that the client is querying.
+        :param client: the client id.
+        :param token: the token returned by claim.
+        """
+        self.collection.delete_one(
+            {'scope': scope, 'client': client, 'token': token})
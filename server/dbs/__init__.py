@@ -21,6 +21,7 @@ from .base import (
     getDBConnectorClass, getDBConnector, getDBConnectorClassFromDialect,
     clearDBConnectorCache, FilterOperators, DatabaseConnectorException,
     databaseFromUri, DatabaseConnector)
+from . import jsonencoder
 from . import sqlalchemydb
 from . import mysql_sqlalchemy
 from . import postgres_sqlalchemy
@@ -30,6 +31,6 @@ from . import mongo
 __all__ = [
     'getDBConnectorClass', 'getDBConnector', 'getDBConnectorClassFromDialect',
     'clearDBConnectorCache', 'FilterOperators', 'DatabaseConnectorException',
-    'databaseFromUri', 'DatabaseConnector', 'sqlalchemydb', 'mysql_sqlalchemy',
-    'postgres_sqlalchemy', 'sqlite_sqlalchemy', 'mongo',
+    'databaseFromUri', 'DatabaseConnector', 'jsonencoder', 'sqlalchemydb',
+    'mysql_sqlalchemy', 'postgres_sqlalchemy', 'sqlite_sqlalchemy', 'mongo',
 ]
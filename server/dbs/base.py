@@ -17,10 +17,21 @@
 #  limitations under the License.
 ##############################################################################
 
+import collections
+import concurrent.futures
+import decimal
+import heapq
+import itertools
+import six
+import sys
+import threading
 import time
 
+from girder import logger as log
 from girder.exceptions import GirderException
 
+from . import jsonencoder
+
 
 FilterOperators = {
     'eq': 'eq',
@@ -75,9 +86,38 @@ DatatypeOperators = {
                'not_regex', 'search', 'not_search', 'is', 'not_is'},
 }
 
+# The number of rows fetched from the database at a time when results are
+# streamed.  This can be changed per connector with the batchsize parameter.
+DEFAULT_BATCH_SIZE = 1000
+
+# Counts with the capped mode stop at this many rows unless another cap is
+# specified.
+DEFAULT_COUNT_CAP = 10000
+CountModes = ('exact', 'estimate', 'capped')
+
+# What happens to a select whose estimated cost is more than the connector's
+# maxcost: it is either rejected or run once no other such select is running.
+CostActions = ('reject', 'queue')
+
+# The number of threads that run the polling queries of selects that wait for
+# data and cancel queries that run too long.  This is shared by all requests.
+# A select that waits for data stops waiting for polls this many seconds after
+# its wait time plus one poll interval, in case the threads are busy.
+DEFAULT_POLL_WORKERS = 4
+POLL_TIMEOUT_MARGIN = 10
+
+# A registry of the queries that clients are running that is shared by all
+# processes.  When set, it has claim(scope, client, backend) and
+# release(scope, client, token) methods, and lets a query with a client id
+# cancel that client's previous query even if another process is running it.
+clientQueryRegistry = None
+
+# The number of database connectors to keep and the number of seconds an
+# unused connector is kept.  These are set from plugin settings.
+DEFAULT_CONNECTOR_CACHE_SIZE = 100
+DEFAULT_CONNECTOR_CACHE_TTL = 3600
+
 _connectorClasses = {}
-_connectorCache = {}
-_connectorCacheMaxSize = 10  # Probably should make this configurable
 
 
 def getDBConnectorClass(uri):
@@ -144,11 +184,22 @@ def clearDBConnectorCache(id):
 
     :param id: key for the connector cache.
     """
-    id = str(id)
-    if id in _connectorCache:
-        _connectorCache.pop(id, None)
-        return True
-    return False
+    return _connectorCache.pop(str(id))
+
+
+def getConnectorSessionCounts():
+    """
+    Count the client sessions of each cached connector that keeps sessions.
+
+    :returns: a dictionary whose keys are the connector cache keys and whose
+        values are from the connector's getSessionCounts.
+    """
+    counts = {}
+    for id, conn in _connectorCache.items():
+        connCounts = conn.getSessionCounts()
+        if connCounts is not None:
+            counts[id] = connCounts
+    return counts
 
 
 def getDBConnector(id, dbinfo):
@@ -170,9 +221,7 @@ def getDBConnector(id, dbinfo):
         if not getattr(conn, 'initialized', None):
             return None
         if id is not None:
-            if len(_connectorCache) > _connectorCacheMaxSize:
-                _connectorCache.clear()
-            _connectorCache[id] = conn
+            conn = _connectorCache.add(id, conn)
     return conn
 
 
@@ -189,6 +238,13 @@ class DatabaseConnector(object):
             raise DatabaseConnectorException(
                 'Failed to validate database connector.')
         self.initialized = False
+        self.batchSize = int(kwargs.get('batchsize') or DEFAULT_BATCH_SIZE)
+        # Selects whose estimated cost is more than maxCost are handled based on
+        # costAction.  See estimateCost.
+        self.maxCost = float(kwargs['maxcost']) if kwargs.get('maxcost') else None
+        self.costAction = kwargs.get('costaction') or CostActions[0]
+        # The default and longest time in seconds that a query may run
+        self.maxTime = float(kwargs['maxtime']) if kwargs.get('maxtime') else None
         self.allowFieldFunctions = False
         self.allowSortFunctions = False
         self.allowFilterFunctions = False
@@ -203,6 +259,14 @@ class DatabaseConnector(object):
         """
         return uri
 
+    def close(self):
+        """
+        Release the resources this connector holds when it is discarded from
+        the connector cache.  Queries that are still running can finish.
+        Subclasses should implement this if they hold resources.
+        """
+        pass
+
     def checkOperatorDatatype(self, field, operator, fieldList=None):
         """
         Check if the specified operator is allowed on a specific field,
@@ -225,6 +289,21 @@ class DatabaseConnector(object):
             return operator in DatatypeOperators[datatype]
         return True
 
+    def estimateCost(self, fields, queryProps={}, filters=[]):
+        """
+        Estimate the cost of a select query without running it.  Connectors
+        that can ask the database for an estimate override this.  The cost is
+        in units that are specific to the database.
+
+        :param fields: the results from getFieldInfo.
+        :param queryProps: general query properties, including limit, offset,
+                           sort, fields, and group.
+        :param filters: a list of filters to apply.
+        :returns: a dictionary with the estimated cost and, if known, the
+            estimated number of rows, or None if the cost can't be estimated.
+        """
+        return None
+
     def getFieldInfo(self):
         """
         Return a list of fields that are known and can be queried.
@@ -234,6 +313,33 @@ class DatabaseConnector(object):
         """
         return []
 
+    def getPartitions(self, fields, queryProps={}, filters=[], partitions=2):
+        """
+        Split the rows that a select query would return into ranges of a key
+        so that the ranges can be fetched concurrently.  Subclasses should
+        implement this if they can select ranges of a key efficiently.
+
+        :param fields: the results from getFieldInfo.
+        :param queryProps: general query properties.
+        :param filters: a list of filters to apply.
+        :param partitions: the desired number of partitions.
+        :returns: None if the query can't be partitioned.  Otherwise, a
+            dictionary with field, the name of the key, and filters, a list
+            with the additional filters of each partition in key order.  There
+            may be fewer partitions than requested.
+        """
+        return None
+
+    def getSessionCounts(self):
+        """
+        Count the sessions that this connector keeps for clients.  Subclasses
+        should implement this if they keep sessions.
+
+        :returns: a dictionary with the number of live sessions and how many
+            of those are idle and in use, or None if sessions aren't kept.
+        """
+        return None
+
     @staticmethod
     def getTableList(uri, internalTables=False, **kwargs):
         """
@@ -321,6 +427,35 @@ class DatabaseConnector(object):
             result['param'].append(entry)
         return result
 
+    def performCount(self, fields=[], queryProps={}, filters=[], client=None):
+        """
+        Count the rows that a select query would return without a limit or
+        offset.  The results are passed back as a dictionary with the
+        following values:
+          count: the number of rows.
+          mode: 'exact' if the count is exact, 'estimate' if it is an
+        estimate, or 'capped' if the count reached the cap, in which case
+        there are at least that many rows.
+
+        This implementation walks the results of a select query.  Subclasses
+        should count in the database instead.  Connectors that can't estimate
+        a count return an exact count.
+
+        :param fields: the results from getFieldInfo.
+        :param queryProps: general query properties, including group, count,
+                           and countcap.  count is one of CountModes and
+                           countcap is the maximum count for the capped mode.
+        :param filters: a list of filters to apply.
+        :param client: if a client is specified, a previous query made by this
+                       client can be cancelled.
+        :return: the count.  See above.
+        """
+        cap = countCap(queryProps)
+        result = self.performSelect(fields, dict(
+            queryProps, limit=-1 if cap is None else cap, offset=0, sort=None,
+            fields=None, stream=True), filters, client)
+        return countResult(sum(1 for row in result['data']), cap)
+
     def performSelect(self, fields=[], queryProps={}, filters=[], client=None):
         """
         Perform a select query.  The results are passed back as a dictionary
@@ -331,11 +466,14 @@ class DatabaseConnector(object):
           fields: a list of the fields that are being returned in the order
         that they are returned.
           data: a list with one entry per row of results.  Each entry is a list
-        with one entry per column.
+        with one entry per column.  If the stream query property is True,
+        this may instead be an iterator that yields the rows as they are
+        fetched.
 
         :param fields: the results from getFieldInfo.
         :param queryProps: general query properties, including limit, offset,
-                           sort, fields, group, wait, poll, and initwait.
+                           sort, fields, group, wait, poll, initwait, and
+                           stream.
         :param filters: a list of filters to apply.
         :param client: if a client is specified, a previous query made by this
                        client can be cancelled.
@@ -359,6 +497,14 @@ class DatabaseConnector(object):
         until either at least one data item has been returned or the wait time
         has elapsed.  See performSelect for more information.
 
+        The first query is made on the calling thread unless there is an
+        initial wait.  Later queries are made by the shared poll scheduler,
+        and the calling thread only waits for the final result.  If the
+        scheduler is too busy to finish the polls in time, the last result is
+        used, or the query is made once more on the calling thread.  If the
+        connector can subscribe to changes, later queries are only made when
+        the data may have changed.
+
         :param fields: the results from getFieldInfo.  If None, this may call
                        getFieldInfo.
         :param queryProps: general query properties, including limit, offset,
@@ -371,24 +517,126 @@ class DatabaseConnector(object):
         wait = queryProps.get('wait')
         if not wait:
             return self.performSelect(fields, queryProps, *args, **kwargs)
-        if queryProps.get('initwait'):
-            time.sleep(queryProps['initwait'])
         poll = queryProps.get('poll', 10)
+        starttime = time.time() + (queryProps.get('initwait') or 0)
+        done = threading.Event()
+        lock = threading.Lock()
+        # checking is True while a query is scheduled or running.  changed is
+        # set when a change notification arrives while a query is running,
+        # since the query may have missed the change.
+        state = {'checking': True, 'changed': False, 'listening': True}
+
+        def finish(key, value):
+            with lock:
+                if not done.is_set():
+                    state[key] = value
+                    done.set()
 
-        starttime = time.time()
-        result = self.performSelect(fields, queryProps, *args, **kwargs)
-        while result is not None and not len(result['data']):
-            curtime = time.time()
-            if curtime >= starttime + wait:
+        def check(props):
+            while True:
+                with lock:
+                    state['changed'] = False
+                try:
+                    result = self.performSelect(fields, props, *args, **kwargs)
+                    curtime = time.time()
+                    if (result is None or hasData(result) or
+                            curtime >= starttime + wait):
+                        finish('result', result)
+                        return
+                except Exception:
+                    finish('error', sys.exc_info())
+                    return
+                with lock:
+                    state['last'] = result
+                    if state['changed']:
+                        continue
+                    # When listening for changes, the query is made again
+                    # when there is a change rather than at an interval.
+                    state['checking'] = not state['listening']
+                    if state['listening']:
+                        return
                 break
             # We wait the poll interval unless less than that amount of time is
             # left in our wait cycle.  If that is the case, we wait the
             # greater of the remaining time and half the poll interval.  This
             # means that the total wait time can be up to half the poll
             # internval plus the query time longer than that specified.
-            time.sleep(max(min(poll, starttime + wait - curtime), poll * 0.5))
-            result = self.performSelect(fields, queryProps, *args, **kwargs)
-        return result
+            pollScheduler.schedule(
+                curtime + max(min(poll, starttime + wait - curtime), poll * 0.5),
+                checkPolled)
+
+        def checkPolled():
+            # Polls run on the scheduler's threads, so the results are fetched
+            # there rather than streamed, since some drivers can't use a
+            # connection from a thread other than the one that created it.
+            check(dict(queryProps, stream=False))
+
+        def changed(listening):
+            with lock:
+                if not listening:
+                    state['listening'] = False
+                if done.is_set():
+                    return
+                if state['checking']:
+                    state['changed'] = True
+                    return
+                state['checking'] = True
+            pollScheduler.schedule(time.time(), checkPolled)
+
+        def expire():
+            with lock:
+                if not done.is_set() and not state['checking']:
+                    state['result'] = state['last']
+                    done.set()
+
+        filters = args[0] if args else kwargs.get('filters', [])
+        unsubscribe = self.subscribeToChanges(changed, filters)
+        if unsubscribe is None:
+            state['listening'] = False
+        else:
+            # This only checks the state, so it runs on the scheduler's own
+            # thread rather than waiting behind polls for a pool thread.
+            pollScheduler.schedule(starttime + wait, expire, inline=True)
+        try:
+            if starttime > time.time():
+                pollScheduler.schedule(starttime, checkPolled)
+            else:
+                check(queryProps)
+            if not done.wait(starttime + wait + poll + POLL_TIMEOUT_MARGIN - time.time()):
+                with lock:
+                    timedOut = not done.is_set()
+                    # Later polls see that this is done and do nothing
+                    done.set()
+                if timedOut:
+                    log.warning('Polls did not finish in time; using the last result')
+                    if state.get('last') is not None:
+                        state['result'] = state['last']
+                    else:
+                        state['result'] = self.performSelect(
+                            fields, queryProps, *args, **kwargs)
+        finally:
+            if unsubscribe is not None:
+                unsubscribe()
+        if 'error' in state:
+            six.reraise(*state['error'])
+        return state['result']
+
+    def subscribeToChanges(self, callback, filters=[]):
+        """
+        Ask to be told when the data may have changed.  Connectors whose
+        databases can send change notifications override this, so that
+        selects that wait for data are made again when there is a change
+        rather than at the polling interval.
+
+        :param callback: a function that is called from another thread each
+            time the data may have changed.  It is passed True, or False if
+            notifications have stopped and the database must be polled.
+        :param filters: the filters of the select.  Connectors can use these
+            to only report changes to matching data.
+        :returns: a function that ends the subscription, or None if change
+            notifications are not available.
+        """
+        return None
 
     @staticmethod
     def validate(*args, **kwargs):
@@ -400,10 +648,215 @@ class DatabaseConnector(object):
         """
         return False
 
-    # Enable and override to customize how data gets dumped to json
-    # @staticmethod
-    # def jsonDumps(*args, **kwargs):
-    #     return json.dumps(*args, **kwargs)
+    # Override to customize how data gets dumped to json.  This has the same
+    # signature as json.dumps and uses orjson when it is available.
+    jsonDumps = staticmethod(jsonencoder.jsonDumps)
+
+
+class PollScheduler(object):
+    """
+    Run functions at scheduled times on a small shared pool of threads.  This
+    is used to poll the database for selects that wait for data, so that
+    waiting requests don't each run their own sleep and query loop, and the
+    number of concurrent polling queries is bounded.
+    """
+
+    def __init__(self, maxWorkers=DEFAULT_POLL_WORKERS):
+        """
+        :param maxWorkers: the number of threads used to run functions.
+        """
+        self.maxWorkers = maxWorkers
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._executor = None
+        self._thread = None
+
+    def pending(self):
+        """
+        Get the number of functions that are waiting for their scheduled time.
+
+        :returns: the number of scheduled functions.
+        """
+        with self._condition:
+            return len(self._heap)
+
+    def schedule(self, when, func, inline=False):
+        """
+        Schedule a function to be run.  The thread that schedules functions
+        and the thread pool are started the first time this is called.
+
+        :param when: the time to run the function, as from time.time().
+        :param func: a function that takes no parameters.  Its return value
+            is ignored.  If it raises an exception, it is ignored.
+        :param inline: if True, run the function on the scheduling thread
+            rather than the thread pool, so that it isn't delayed when the
+            pool is busy.  This must only be used for functions that return
+            quickly.
+        """
+        with self._condition:
+            heapq.heappush(self._heap, (when, next(self._counter), func, inline))
+            if self._thread is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.maxWorkers)
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        """
+        Wait for each scheduled function's time and submit it to the thread
+        pool.
+        """
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._condition.wait(
+                        max(0, self._heap[0][0] - time.time())
+                        if self._heap else None)
+                func, inline = heapq.heappop(self._heap)[-2:]
+            if not inline:
+                self._executor.submit(func)
+                continue
+            try:
+                func()
+            except Exception:
+                log.exception('Scheduled function failed')
+
+
+pollScheduler = PollScheduler()
+
+
+def hasData(result):
+    """
+    Check if the results of a select query have any rows.  If the data is an
+    iterator, the first row is fetched to check and the data is replaced with
+    an equivalent iterator.
+
+    :param result: the results of a select query.  This may be modified.
+    :returns: True if there is at least one row of data.
+    """
+    data = result['data']
+    if isinstance(data, (list, tuple)):
+        return len(data) > 0
+    data = iter(data)
+    try:
+        first = next(data)
+    except StopIteration:
+        result['data'] = []
+        return False
+    result['data'] = itertools.chain([first], data)
+    return True
+
+
+def keysetFilter(keys):
+    """
+    Convert a keyset pagination filter into a group of basic filters that
+    selects the rows that sort after a set of key values.  For sort fields a,
+    b, and c with values x, y, and z, this is (a > x) or (a = x and b > y) or
+    (a = x and b = y and c > z).  The redundant condition a >= x is added so
+    that a database can use an index on the first sort field.
+
+    :param keys: a list of (field, direction, value) in sort order.  The
+        direction is negative for descending sorts.
+    :returns: a filter.
+    """
+    terms = []
+    for idx, (field, direction, value) in enumerate(keys):
+        term = [{
+            'field': prevField,
+            'operator': 'is' if prevValue is None else 'eq',
+            'value': prevValue,
+        } for prevField, _, prevValue in keys[:idx]]
+        term.append({
+            'field': field,
+            'operator': 'lt' if direction < 0 else 'gt',
+            'value': value,
+        })
+        terms.append({'group': 'and', 'value': term})
+    if len(keys) == 1:
+        return terms[0]['value'][0]
+    field, direction, value = keys[0]
+    bound = {
+        'field': field,
+        'operator': 'lte' if direction < 0 else 'gte',
+        'value': value,
+    }
+    return {'group': 'and', 'value': [bound, {'group': 'or', 'value': terms}]}
+
+
+def countCap(queryProps):
+    """
+    Get the maximum count of a count query.
+
+    :param queryProps: the query properties.  See performCount.
+    :returns: the cap if the mode is capped, otherwise None.
+    """
+    if queryProps.get('count') != 'capped':
+        return None
+    return int(queryProps.get('countcap') or DEFAULT_COUNT_CAP)
+
+
+def countResult(count, cap=None, mode='exact'):
+    """
+    Construct the result of a count query.
+
+    :param count: the number of rows counted.
+    :param cap: the maximum count or None.
+    :param mode: the mode of the count if it didn't reach the cap.
+    :returns: a dictionary with count and mode.  See performCount.
+    """
+    if cap is not None and count >= cap:
+        return {'count': cap, 'mode': 'capped'}
+    return {'count': int(count), 'mode': mode}
+
+
+def partitionFilters(field, boundaries):
+    """
+    Get the filters that split the values of a key into ranges.  The first
+    range also includes null values.
+
+    :param field: the name of the key.
+    :param boundaries: a sorted list of the lowest value of each range after
+        the first.
+    :returns: a list with a list of filters for each range.
+    """
+    results = []
+    for idx in range(len(boundaries) + 1):
+        filters = []
+        if idx:
+            filters.append({
+                'field': field, 'operator': 'gte', 'value': boundaries[idx - 1]})
+        if idx < len(boundaries):
+            upper = {'field': field, 'operator': 'lt', 'value': boundaries[idx]}
+            if not idx:
+                upper = {'group': 'or', 'value': [
+                    {'field': field, 'operator': 'is', 'value': None}, upper]}
+            filters.append(upper)
+        results.append(filters)
+    return results
+
+
+def rangeBoundaries(low, high, partitions):
+    """
+    Get the boundaries that split a range of numbers into equal parts.
+
+    :param low: the lowest value in the range.
+    :param high: the highest value in the range.
+    :param partitions: the number of parts.
+    :returns: a sorted list of the lowest value of each part after the first,
+        or None if the values are not numbers.
+    """
+    numberTypes = six.integer_types + (float, decimal.Decimal)
+    if (not isinstance(low, numberTypes) or not isinstance(high, numberTypes) or
+            isinstance(low, bool) or isinstance(high, bool)):
+        return None
+    if isinstance(low, six.integer_types) and isinstance(high, six.integer_types):
+        values = [low + (high - low) * idx // partitions for idx in range(1, partitions)]
+    else:
+        values = [low + (high - low) * idx / partitions for idx in range(1, partitions)]
+    return sorted(set(value for value in values if low < value <= high))
 
 
 def databaseFromUri(uri):
@@ -425,3 +878,169 @@ def databaseFromUri(uri):
     if len(parts) < 2 or not parts[1]:
         return None
     return parts[1]
+
+
+class ConnectorCache(object):
+    """
+    A least-recently-used cache of database connectors, so that connectors
+    don't have to inspect their tables for every request.  Connectors that
+    haven't been used for ttl seconds are discarded, as are the least recently
+    used connectors when there are more than maxSize.  Discarded connectors are
+    closed.
+    """
+
+    def __init__(self, maxSize=DEFAULT_CONNECTOR_CACHE_SIZE,
+                 ttl=DEFAULT_CONNECTOR_CACHE_TTL):
+        """
+        :param maxSize: the maximum number of connectors.  0 disables caching.
+        :param ttl: the number of seconds an unused connector is kept, or 0 to
+            keep connectors until they are the least recently used.
+        """
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, id):
+        with self._lock:
+            return id in self._entries
+
+    def __getitem__(self, id):
+        with self._lock:
+            return self._entries[id]['connector']
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def add(self, id, conn):
+        """
+        Add a connector to the cache.  If another connector was added with the
+        same id since it was last looked up, that connector is kept instead.
+        If caching is disabled, the connector isn't added.
+
+        :param id: key for the connector.
+        :param conn: the connector.
+        :returns: the cached connector, or conn if caching is disabled.
+        """
+        if not self.maxSize:
+            return conn
+        with self._lock:
+            entry = self._entries.get(id)
+            if entry is not None:
+                return entry['connector']
+            self._entries[id] = {'connector': conn, 'used': time.time()}
+            evicted = self._prune()
+        self._close(evicted)
+        return conn
+
+    def clear(self):
+        """
+        Discard all connectors.
+        """
+        with self._lock:
+            evicted = [entry['connector'] for entry in six.itervalues(self._entries)]
+            self._entries.clear()
+        self._close(evicted)
+
+    def get(self, id, default=None):
+        """
+        Get a connector, marking it as the most recently used.
+
+        :param id: key for the connector.
+        :param default: the value to return if the connector isn't cached.
+        :returns: the connector or the default.
+        """
+        with self._lock:
+            evicted = self._prune()
+            entry = self._entries.pop(id, None)
+            if entry is not None:
+                entry['used'] = time.time()
+                self._entries[id] = entry
+                self.hits += 1
+            elif id is not None:
+                self.misses += 1
+        self._close(evicted)
+        return entry['connector'] if entry is not None else default
+
+    def items(self):
+        """
+        Get the cached connectors.
+
+        :returns: a list of (id, connector) tuples.
+        """
+        with self._lock:
+            return [(id, entry['connector'])
+                    for id, entry in six.iteritems(self._entries)]
+
+    def pop(self, id):
+        """
+        Discard a connector.
+
+        :param id: key for the connector.
+        :returns: True if the connector was cached.
+        """
+        with self._lock:
+            entry = self._entries.pop(id, None)
+        if entry is None:
+            return False
+        self._close([entry['connector']])
+        return True
+
+    def prune(self):
+        """
+        Discard expired connectors and the least recently used connectors in
+        excess of maxSize.  Call this after changing maxSize or ttl.
+        """
+        with self._lock:
+            evicted = self._prune()
+        self._close(evicted)
+
+    def stats(self):
+        """
+        Get statistics about the cache.
+
+        :returns: a dictionary of statistics.
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'maxSize': self.maxSize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _close(self, connectors):
+        for conn in connectors:
+            try:
+                conn.close()
+            except Exception:
+                log.exception('Failed to close a database connector')
+
+    def _prune(self):
+        """
+        Remove expired and excess entries.  This must be called while holding
+        the lock.
+
+        :returns: a list of removed connectors to close once the lock is
+            released.
+        """
+        evicted = []
+        expires = time.time() - self.ttl if self.ttl else None
+        # Entries are in order of use, so expired entries are first
+        while self._entries and (
+                len(self._entries) > self.maxSize or
+                (expires is not None and
+                 next(six.itervalues(self._entries))['used'] < expires)):
+            _, entry = self._entries.popitem(last=False)
+            evicted.append(entry['connector'])
+            self.evictions += 1
+        return evicted
+
+
+_connectorCache = ConnectorCache()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+##############################################################################
+
+import base64
+import bson
+import datetime
+import decimal
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Functions used to convert values that can't be dumped to JSON directly,
+# keyed by the value's class.  See registerJsonDefault.
+_defaultHandlers = {}
+
+# If True and orjson is installed, compact JSON is dumped with orjson.  This
+# is off by default, since the output differs for some floats; see
+# _orjsonOption.  The database_assetstore.fast_json setting changes this.
+useOrjson = False
+
+_nonAsciiPattern = re.compile(u'[^\x00-\x7f]')
+
+
+def registerJsonDefault(cls, func):
+    """
+    Register a function to convert values of a class to something that can be
+    dumped to JSON.  Subclasses use the handler of their nearest registered
+    base class.
+
+    :param cls: the class of the values to convert.
+    :param func: a function that takes a value and returns a JSON-compatible
+        value, or None to remove the handler.
+    """
+    if func is None:
+        _defaultHandlers.pop(cls, None)
+    else:
+        _defaultHandlers[cls] = func
+
+
+def jsonDefault(obj):
+    """
+    Convert a value that can't be dumped to JSON directly.  If there is no
+    registered handler, the value is converted to a string.
+
+    :param obj: the value to convert.
+    :returns: a JSON-compatible value.
+    """
+    for cls in type(obj).__mro__:
+        func = _defaultHandlers.get(cls)
+        if func is not None:
+            return func(obj)
+    return str(obj)
+
+
+def _escapeNonAscii(match):
+    """
+    Escape a non-ASCII character the same way that json.dumps does with
+    ensure_ascii.
+
+    :param match: a regex match of one character.
+    :returns: the escaped character.
+    """
+    code = ord(match.group(0))
+    if code < 0x10000:
+        return '\\u%04x' % code
+    # Characters outside of the basic plane are written as surrogate pairs
+    code -= 0x10000
+    return '\\u%04x\\u%04x' % (0xd800 | (code >> 10), 0xdc00 | (code & 0x3ff))
+
+
+def _orjsonOption(kwargs):
+    """
+    Determine the orjson options that produce equivalent JSON to json.dumps
+    with a set of keyword arguments.  The output differs for floats: orjson
+    writes NaN and infinite values as null, and formats some small numbers
+    differently, such as 0.00001 or 1e-7 rather than 1e-05 or 1e-07.
+
+    :param kwargs: the keyword arguments passed to json.dumps.
+    :returns: the orjson option value, or None if orjson can't be used.
+    """
+    # orjson only produces compact output, so anything else is left to the
+    # standard library.
+    if (kwargs.get('indent') is not None or
+            tuple(kwargs.get('separators') or ()) != (',', ':') or
+            kwargs.get('cls') is not None or
+            kwargs.get('allow_nan') is False or
+            not set(kwargs).issubset({
+                'check_circular', 'separators', 'sort_keys', 'default',
+                'indent', 'ensure_ascii', 'allow_nan'})):
+        return None
+    # Datetimes are passed to the default function so that they are rendered
+    # the same as with the standard library.
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+    if kwargs.get('sort_keys'):
+        option |= orjson.OPT_SORT_KEYS
+    return option
+
+
+def makeJsonDumps(default=jsonDefault, fallback=None):
+    """
+    Make a function with the same signature as json.dumps that uses orjson
+    when useOrjson is set, orjson is installed, and the requested output is
+    compact.  Otherwise, the fallback function is used.  See _orjsonOption
+    for how the output differs.
+
+    :param default: the function used to convert values that can't be dumped
+        directly if the caller didn't specify a default or asked for str.
+    :param fallback: the function used when orjson isn't available or fails.
+        If None, json.dumps is used.
+    :returns: a function to dump objects to JSON.
+    """
+    def jsonDumps(obj, *args, **kwargs):
+        if useOrjson and orjson is not None and not args:
+            option = _orjsonOption(kwargs)
+            if option is not None:
+                orjsonDefault = default
+                if kwargs.get('default') not in (None, str):
+                    callerDefault = kwargs['default']
+
+                    def orjsonDefault(value):
+                        # The standard library dumps tuple subclasses, such
+                        # as rows, without calling default.
+                        if isinstance(value, tuple):
+                            return list(value)
+                        return callerDefault(value)
+
+                try:
+                    result = orjson.dumps(obj, default=orjsonDefault, option=option)
+                except TypeError:
+                    # orjson.JSONEncodeError is a TypeError.  This happens,
+                    # for instance, with integers larger than 64 bits.
+                    pass
+                else:
+                    result = result.decode('utf8')
+                    if kwargs.get('ensure_ascii', True):
+                        # orjson doesn't escape non-ASCII characters.  These
+                        # can only be in strings, so escaping them everywhere
+                        # matches the standard library.
+                        result = _nonAsciiPattern.sub(_escapeNonAscii, result)
+                    return result
+        if fallback is not None:
+            return fallback(obj, *args, **kwargs)
+        if kwargs.get('default') in (None, str):
+            kwargs['default'] = default
+        return json.dumps(obj, *args, **kwargs)
+
+    return jsonDumps
+
+
+jsonDumps = makeJsonDumps()
+
+
+for cls in (datetime.datetime, datetime.date, datetime.time,
+            decimal.Decimal, bson.ObjectId):
+    registerJsonDefault(cls, str)
+# Rows are often tuple subclasses, which orjson doesn't dump directly.
+registerJsonDefault(tuple, list)
+registerJsonDefault(bson.Binary, lambda value: base64.b64encode(
+    value).decode('utf8'))
@@ -18,13 +18,20 @@
 ##############################################################################
 
 import bson.json_util
+import functools
 import re
 import six
+import threading
+import time
+from bson.objectid import ObjectId
+from bson.son import SON
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError
 
 from girder import logger as log
 
 from . import base
+from . import jsonencoder
 from .base import DatabaseConnectorException
 
 
@@ -43,6 +50,88 @@ MongoOperators = {
     # is and not_is are the same as $eq and $ne unless the value is None
 }
 
+# The longest that a change stream waits for changes on the server before
+# checking if it is still needed, in milliseconds.
+CHANGE_STREAM_AWAIT_MS = 1000
+# Change streams by collection and pipeline; see ChangeStreamListener.  Waits
+# with the same filters on the same collection share a stream.  At most
+# MAX_CHANGE_STREAMS are open at once; waits beyond that poll instead.  A
+# stream is kept for CHANGE_STREAM_IDLE_TIME seconds after its last
+# subscriber leaves, and a subscriber waits at most CHANGE_STREAM_START_TIMEOUT
+# seconds for a stream to open.
+_changeStreams = {}
+_changeStreamsLock = threading.Lock()
+MAX_CHANGE_STREAMS = 16
+CHANGE_STREAM_IDLE_TIME = 60
+CHANGE_STREAM_START_TIMEOUT = 10
+
+
+def bsonJsonDefault(obj):
+    """
+    Convert a value that can't be dumped to JSON directly in the same manner
+    as bson.json_util.dumps.
+
+    :param obj: the value to convert.
+    :returns: a JSON-compatible value.
+    """
+    try:
+        return bson.json_util.default(obj)
+    except TypeError:
+        return jsonencoder.jsonDefault(obj)
+
+
+def planStages(plan):
+    """
+    List the stages of a query plan from explain.
+
+    :param plan: a plan, such as the winningPlan of the query planner.
+    :returns: a list of the names of the stages in the plan.
+    """
+    stages = [plan.get('stage')]
+    for key in ('queryPlan', 'inputStage'):
+        if isinstance(plan.get(key), dict):
+            stages.extend(planStages(plan[key]))
+    for subplan in plan.get('inputStages', []):
+        stages.extend(planStages(subplan))
+    return stages
+
+
+def planScansAll(plan):
+    """
+    Check if a query plan from explain reads every document in a collection,
+    either by scanning the collection or by scanning the full range of an
+    index, such as to sort without a filter on the index.
+
+    :param plan: a plan, such as the winningPlan of the query planner.
+    :returns: True if the plan reads every document.
+    """
+    if plan.get('stage') == 'COLLSCAN':
+        return True
+    if plan.get('stage') == 'IXSCAN' and plan.get('indexBounds') and all(
+            bounds in (['[MinKey, MaxKey]'], ['[MaxKey, MinKey]'])
+            for bounds in plan['indexBounds'].values()):
+        return True
+    subplans = [plan[key] for key in ('queryPlan', 'inputStage')
+                if isinstance(plan.get(key), dict)]
+    subplans.extend(plan.get('inputStages', []))
+    return any(planScansAll(subplan) for subplan in subplans)
+
+
+def prefixQueryFields(query, prefix):
+    """
+    Add a prefix to the field names of a query document, such as to match the
+    fullDocument of change stream events.
+
+    :param query: a query document of the form made by _filterQuery.
+    :param prefix: the prefix to add to each field name.
+    :returns: a new query document.
+    """
+    return {
+        key if key.startswith('$') else prefix + key:
+        [prefixQueryFields(clause, prefix) for clause in value]
+        if key in ('$and', '$or', '$nor') else value
+        for key, value in six.iteritems(query)}
+
 
 class MongoConnector(base.DatabaseConnector):
     name = 'mongo'
@@ -67,9 +156,11 @@ class MongoConnector(base.DatabaseConnector):
 
         :param clauses: a list which is modified.
         :param filter: the filter to add.  This needs to be a dictionary with
-            field, operator, and value or with group and value.
+            field, operator, and value, with group and value, or with after.
         :return: the list of clauses.
         """
+        if 'after' in filter:
+            filter = base.keysetFilter(filter['after'])
         if 'group' in filter:
             subclauses = []
             for subfilter in filter['value']:
@@ -105,6 +196,67 @@ class MongoConnector(base.DatabaseConnector):
         clauses.append({field: {operator: value}})
         return clauses
 
+    def _filterQuery(self, filters):
+        """
+        Convert a list of filters to a Mongo query document.
+
+        :param filters: a list of filters to apply.
+        :return: the query document, or None if there are no filters.
+        """
+        filterQueryClauses = []
+        for filt in filters:
+            filterQueryClauses = self._addFilter(filterQueryClauses, filt)
+        if len(filterQueryClauses) > 0:
+            return {'$and': filterQueryClauses}
+        return None
+
+    def _changeStreamPipeline(self, filters):
+        """
+        Get a change stream pipeline that matches the inserts, updates, and
+        replacements of documents that match a list of filters.
+
+        :param filters: a list of filters to apply.
+        :return: the pipeline.
+        """
+        match = {'operationType': {'$in': ['insert', 'replace', 'update']}}
+        filterQuery = self._filterQuery(filters)
+        if filterQuery:
+            match.update(prefixQueryFields(filterQuery, 'fullDocument.'))
+        return [{'$match': match}]
+
+    def _clientComment(self, client):
+        """
+        Get the comment used to tag the queries that a client makes.
+
+        :param client: the client making the queries.
+        :returns: the comment.
+        """
+        return 'database_assetstore:%s' % client
+
+    def _killClientQueries(self, coll, client):
+        """
+        Kill any queries a client is still running on the server so that a new
+        query replaces them.
+
+        :param coll: the collection returned by connect.
+        :param client: the client whose queries are killed.
+        """
+        comment = self._clientComment(client)
+        admin = coll.database.client.admin
+        try:
+            ops = list(admin.aggregate([
+                {'$currentOp': {'allUsers': False}},
+                {'$match': {'$or': [
+                    {'command.comment': comment},
+                    {'originatingCommand.comment': comment}]}},
+                {'$project': {'opid': True}},
+            ]))
+            for op in ops:
+                log.info('Killing query %s for client %s', op['opid'], client)
+                admin.command('killOp', op=op['opid'])
+        except PyMongoError:
+            log.exception('Failed to kill queries for client %s', client)
+
     def connect(self):
         """
         Connect to the database and get a reference to the Mongo collection.
@@ -115,12 +267,52 @@ class MongoConnector(base.DatabaseConnector):
         self.database = self.conn[self.databaseName]
         return self.database[self.collection]
 
-    def disconnect(self):
+    def disconnect(self, coll=None):
         """
         Disconnect from the database.
+
+        :param coll: the collection returned by connect.  If None, the most
+            recent connection is closed.  Pass this when queries may be made
+            concurrently.
+        """
+        conn = coll.database.client if coll is not None else self.conn
+        conn.close()
+        if conn is self.conn:
+            self.conn = None
+
+    def performCount(self, fields, queryProps={}, filters=[], client=None):
+        """
+        Count the documents that a select query would return without a limit
+        or offset.  Estimates use the collection metadata, so they are only
+        made for unfiltered queries.  See the base class for more information.
+
+        :param fields: the results from getFieldInfo.
+        :param queryProps: general query properties, including count and
+                           countcap.
+        :param filters: a list of filters to apply.
+        :param client: if a client is specified, a previous query made by this
+                       client can be cancelled.
+        :return: the count.
         """
-        self.conn.close()
-        self.conn = None
+        if queryProps.get('group'):
+            raise DatabaseConnectorException(
+                'Group unsupported by this database.')
+        filterQuery = self._filterQuery(filters)
+        cap = base.countCap(queryProps)
+        coll = self.connect()
+        try:
+            if queryProps.get('count') == 'estimate' and not filterQuery:
+                return base.countResult(
+                    coll.estimated_document_count(), mode='estimate')
+            opts = {'limit': cap} if cap is not None else {}
+            if queryProps.get('maxtime'):
+                opts['maxTimeMS'] = max(1, int(queryProps['maxtime'] * 1000))
+            log.info('Count: %s %s', bson.json_util.dumps(
+                filterQuery or {}, default=str), opts)
+            return base.countResult(
+                coll.count_documents(filterQuery or {}, **opts), cap)
+        finally:
+            self.disconnect(coll)
 
     def performSelect(self, fields, queryProps={}, filters=[], client=None):
         """
@@ -149,10 +341,6 @@ class MongoConnector(base.DatabaseConnector):
             raise DatabaseConnectorException(
                 'Group unsupported by this database.')
 
-        filterQueryClauses = []
-        for filt in filters:
-            filterQueryClauses = self._addFilter(filterQueryClauses, filt)
-
         opts = {}
         for k, v in six.iteritems(queryProps):
             target = None
@@ -170,8 +358,9 @@ class MongoConnector(base.DatabaseConnector):
             if target is not None:
                 opts[target] = v
 
-        if len(filterQueryClauses) > 0:
-            opts['filter'] = {'$and': filterQueryClauses}
+        filterQuery = self._filterQuery(filters)
+        if filterQuery:
+            opts['filter'] = filterQuery
 
         result['format'] = 'dict'
         if queryProps.get('limit') == 0:
@@ -179,17 +368,63 @@ class MongoConnector(base.DatabaseConnector):
         else:
             if queryProps.get('limit') < 0:
                 opts['limit'] = 0
+            if queryProps.get('maxtime'):
+                opts['max_time_ms'] = max(1, int(queryProps['maxtime'] * 1000))
             coll = self.connect()
+            if client:
+                opts['comment'] = self._clientComment(client)
+                self._killClientQueries(coll, client)
             log.info('Query: %s', bson.json_util.dumps(
                 opts, check_circular=False, separators=(',', ':'),
                 sort_keys=False, default=str, indent=None))
             cursor = coll.find(**opts)
             result['datacount'] = cursor.count(True)
             result['data'] = cursor
-            self.disconnect()
+            self.disconnect(coll)
 
         return result
 
+    def estimateCost(self, fields, queryProps={}, filters=[]):
+        """
+        Estimate the cost of a select query as the number of documents that it
+        examines.  If the query planner's winning plan scans the collection or
+        the full range of an index, this is the number of documents in the
+        collection from its metadata, or the offset plus the limit for
+        unfiltered queries that don't sort in memory.  Queries that scan part
+        of an index are estimated to cost nothing, since the planner doesn't
+        estimate how many documents a bounded index scan examines.  See the
+        base class for more information.
+
+        :param fields: the results from getFieldInfo.
+        :param queryProps: general query properties, including limit, offset,
+                           and sort.
+        :param filters: a list of filters to apply.
+        :returns: a dictionary with the estimated cost, or None.
+        """
+        filterQuery = self._filterQuery(filters)
+        command = SON([('find', self.collection), ('filter', filterQuery or {})])
+        if queryProps.get('sort'):
+            command['sort'] = SON([(key, dir) for key, dir in queryProps['sort']])
+        coll = self.connect()
+        try:
+            plan = coll.database.command(
+                'explain', command, verbosity='queryPlanner')
+            winningPlan = plan['queryPlanner']['winningPlan']
+            if not planScansAll(winningPlan):
+                return {'cost': 0}
+            stages = planStages(winningPlan)
+            cost = coll.estimated_document_count()
+            limit = queryProps.get('limit')
+            if (not filterQuery and 'SORT' not in stages and
+                    limit is not None and limit >= 0):
+                cost = min(cost, limit + (queryProps.get('offset') or 0))
+            return {'cost': cost}
+        except PyMongoError:
+            log.exception('Failed to explain a query')
+            return None
+        finally:
+            self.disconnect(coll)
+
     def getFieldInfo(self):
         """
         Return a list of fields that are known and can be queried.
@@ -216,6 +451,53 @@ class MongoConnector(base.DatabaseConnector):
             self.fieldInfo = fieldInfo
         return self.fieldInfo
 
+    def getPartitions(self, fields, queryProps={}, filters=[], partitions=2):
+        """
+        Split the documents that a select query would return into ranges of
+        _id.  ObjectId and numeric ids are split into equal ranges between
+        their minimum and maximum.  Other ids are split using $bucketAuto.
+        See the base class for more information.
+
+        :param fields: the results from getFieldInfo.
+        :param queryProps: general query properties.
+        :param filters: a list of filters to apply.
+        :param partitions: the desired number of partitions.
+        :returns: the partitions or None.
+        """
+        filterQuery = self._filterQuery(filters) or {}
+        coll = self.connect()
+        try:
+            ends = []
+            for direction in (1, -1):
+                doc = next(iter(coll.find(filterQuery, {'_id': True}).sort(
+                    '_id', direction).limit(1)), None)
+                if doc is None:
+                    return None
+                ends.append(doc['_id'])
+            low, high = ends
+            if isinstance(low, ObjectId) and isinstance(high, ObjectId):
+                boundaries = [ObjectId('%024x' % value) for value in base.rangeBoundaries(
+                    int(str(low), 16), int(str(high), 16), partitions)]
+            else:
+                boundaries = base.rangeBoundaries(low, high, partitions)
+            if boundaries is None:
+                # Range filters only match values of the same BSON type, so
+                # only partition ids that are all of one type.
+                if type(low) is not type(high):
+                    return None
+                boundaries = [bucket['_id']['min'] for bucket in coll.aggregate([
+                    {'$match': filterQuery},
+                    {'$bucketAuto': {'groupBy': '$_id', 'buckets': partitions}},
+                ], allowDiskUse=True)][1:]
+            log.info('Partitions: _id %s', bson.json_util.dumps(
+                boundaries, default=str))
+            return {
+                'field': '_id',
+                'filters': base.partitionFilters('_id', boundaries),
+            }
+        finally:
+            self.disconnect(coll)
+
     @staticmethod
     def getTableList(uri, internalTables=False, **kwargs):
         """
@@ -246,6 +528,40 @@ class MongoConnector(base.DatabaseConnector):
             })
         return results
 
+    def subscribeToChanges(self, callback, filters=[]):
+        """
+        Watch a change stream for documents that match the filters being
+        inserted or changed.  Subscriptions with the same filters on the same
+        collection share one stream.  Change streams require a replica set or
+        sharded cluster; if they are unavailable, or too many streams are
+        open, waiting selects poll instead.  See the base class for more
+        information.
+
+        :param callback: a function that is called from another thread each
+            time a matching document may have changed.  It is passed True, or
+            False if the change stream failed and the database must be
+            polled.
+        :param filters: the filters of the select.
+        :returns: a function that ends the subscription, or None if change
+            streams are not available.
+        """
+        pipeline = self._changeStreamPipeline(filters)
+        key = (self.databaseUri, self.databaseName, self.collection,
+               bson.json_util.dumps(pipeline, sort_keys=True))
+        with _changeStreamsLock:
+            listener = _changeStreams.get(key)
+            if listener is None:
+                if len(_changeStreams) >= MAX_CHANGE_STREAMS:
+                    log.info('Too many change streams; polling instead')
+                    return None
+                listener = ChangeStreamListener(key, self, pipeline)
+                _changeStreams[key] = listener
+            listener.callbacks.add(callback)
+        if not listener.ready.wait(CHANGE_STREAM_START_TIMEOUT) or listener.failed:
+            listener.unsubscribe(callback)
+            return None
+        return functools.partial(listener.unsubscribe, callback)
+
     @staticmethod
     def validate(uri=None, database=None, collection=None, **kwargs):
         """
@@ -256,13 +572,11 @@ class MongoConnector(base.DatabaseConnector):
         """
         return uri and collection
 
-    @staticmethod
-    def jsonDumps(*args, **kwargs):
-        """
-        Use the bson utility to dump JSON.  This handles special BSON
-        datatypes.  See json.dumps for the function paramters.
-        """
-        return bson.json_util.dumps(*args, **kwargs)
+    # Use the bson utility to dump JSON.  This handles special BSON datatypes.
+    # When orjson is available, the bson conversions are used as its default
+    # function.  See json.dumps for the function parameters.
+    jsonDumps = staticmethod(jsonencoder.makeJsonDumps(
+        bsonJsonDefault, bson.json_util.dumps))
 
 
 base.registerConnectorClass(MongoConnector.name, MongoConnector, {
@@ -273,3 +587,93 @@ base.registerConnectorClass(MongoConnector.name, MongoConnector, {
     'default_dialect': 'mongodb',
     'priority': 0,
 })
+
+
+class ChangeStreamListener(object):
+    """
+    Watch a Mongo change stream on a dedicated thread, and call the
+    subscribed functions when a change arrives.  The stream is closed once
+    there have been no subscribers for a while.
+    """
+
+    def __init__(self, key, connector, pipeline):
+        """
+        Start watching.
+
+        :param key: the key of this listener in _changeStreams.
+        :param connector: a MongoConnector used to connect to the collection.
+        :param pipeline: the change stream pipeline.
+        """
+        self.key = key
+        self.connector = connector
+        self.pipeline = pipeline
+        self.callbacks = set()
+        self.failed = False
+        # This is set once the stream is open or has failed.
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def unsubscribe(self, callback):
+        """
+        Stop calling a subscribed function.
+
+        :param callback: the subscribed function.
+        """
+        with _changeStreamsLock:
+            self.callbacks.discard(callback)
+
+    def _run(self):
+        """
+        Watch for changes until there are no subscribers or the stream fails.
+        If it fails, the subscribers are told to poll.
+        """
+        coll = stream = None
+        try:
+            coll = self.connector.connect()
+            # The stream is open before subscribers are told that it is
+            # ready, so that changes made after that are reported.
+            stream = coll.watch(
+                self.pipeline, full_document='updateLookup',
+                max_await_time_ms=CHANGE_STREAM_AWAIT_MS)
+            if not hasattr(stream, 'try_next'):
+                raise PyMongoError('pymongo 3.8 or later is required')
+            self.ready.set()
+            idleSince = None
+            while True:
+                if stream.try_next() is not None:
+                    with _changeStreamsLock:
+                        callbacks = list(self.callbacks)
+                    for callback in callbacks:
+                        callback(True)
+                with _changeStreamsLock:
+                    if self.callbacks:
+                        idleSince = None
+                    elif idleSince is None:
+                        idleSince = time.time()
+                    elif time.time() - idleSince > CHANGE_STREAM_IDLE_TIME:
+                        _changeStreams.pop(self.key, None)
+                        return
+        except Exception as exc:
+            # If the stream never opened, the subscribers poll without being
+            # told, since they see that it failed.
+            started = self.ready.is_set()
+            if started:
+                log.exception('Failed to watch for changes')
+            else:
+                log.info('Not watching for changes: %s', exc)
+            with _changeStreamsLock:
+                if _changeStreams.get(self.key) is self:
+                    _changeStreams.pop(self.key)
+                self.failed = True
+                callbacks = list(self.callbacks) if started else []
+                self.callbacks.clear()
+            self.ready.set()
+            for callback in callbacks:
+                callback(False)
+        finally:
+            if stream is not None:
+                stream.close()
+            if coll is not None:
+                self.connector.disconnect(coll)
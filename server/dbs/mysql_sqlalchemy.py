@@ -17,7 +17,10 @@
 #  limitations under the License.
 ##############################################################################
 
+import functools
+import json
 import sqlalchemy
+import uuid
 
 from girder import logger as log
 
@@ -390,8 +393,117 @@ class MysqlSAConnector(SQLAlchemyConnector):
         # The super class also validates the connector
         super(MysqlSAConnector, self).__init__(*args, **kwargs)
         self.databaseOperators = MysqlOperators
+        self.allowRowValueComparison = True
         self._allowedFunctions = MysqlFunctions
 
+    def _backendId(self, sess):
+        """
+        Get the id of the MySQL connection that a session uses and a tag that
+        is added to the query as a comment (see _markQuery).  Together, these
+        identify the query even if the connection is later used for other
+        queries.
+
+        :param sess: the session used for the query.
+        :returns: a dictionary with the connection id (id) and the tag (tag).
+        """
+        return {
+            'id': int(sess.connection().connection.thread_id()),
+            'tag': 'girder_client_query:%s' % uuid.uuid4().hex,
+        }
+
+    def _cancelBackend(self, backend):
+        """
+        Cancel the query that a MySQL connection is running if it is still
+        the tagged query.
+
+        :param backend: a dictionary with the connection id and the query's
+            tag.  See _backendId.
+        """
+        conn = self.dbEngine.connect()
+        try:
+            running = conn.execute(sqlalchemy.text(
+                'SELECT ID FROM information_schema.PROCESSLIST '
+                'WHERE ID = :id AND ID != CONNECTION_ID() AND INFO LIKE :info'),
+                id=backend['id'], info='%%%s%%' % backend['tag']).fetchone()
+            if running is not None:
+                self._killQuery(backend['id'], conn)
+        finally:
+            conn.close()
+
+    def _killQuery(self, connectionId, conn=None):
+        """
+        Kill the query that a MySQL connection is running.
+
+        :param connectionId: the connection id.
+        :param conn: an engine connection to use, or None to use a new one.
+        """
+        killConn = conn if conn is not None else self.dbEngine.connect()
+        try:
+            killConn.execute('KILL QUERY %d' % int(connectionId))
+        finally:
+            if conn is None:
+                killConn.close()
+
+    def _markQuery(self, query, backend):
+        """
+        Add a comment with the tag from _backendId to a query, so that
+        _cancelBackend can find it in the process list.
+
+        :param query: the query to run.
+        :param backend: the id from _backendId.
+        :returns: the query to run.
+        """
+        return query.prefix_with('/* %s */' % backend['tag'])
+
+    def _explainCost(self, sess, query):
+        """
+        Estimate the cost of a query using the query optimizer.  The cost is
+        in the optimizer's arbitrary units.
+
+        :param sess: the session used for the query.
+        :param query: the query to estimate.
+        :returns: a dictionary with the estimated cost and rows, or None if the
+            query couldn't be explained.
+        """
+        plan = self._explain(sess, query, 'EXPLAIN FORMAT=JSON ')
+        if plan is None:
+            return None
+        block = json.loads(plan)['query_block']
+        rows = block.get('table', {}).get('rows_produced_per_join')
+        return {
+            'cost': float(block['cost_info']['query_cost']),
+            'rows': int(rows) if rows is not None else None,
+        }
+
+    def _limitQueryTime(self, sess, query, maxTime):
+        """
+        Limit how long a query can run using an optimizer hint.  Unlike the
+        max_execution_time session variable, the hint doesn't linger on
+        pooled connections.
+
+        :param sess: the session used for the query.
+        :param query: the query to limit.
+        :param maxTime: the longest time in seconds that the query may run, or
+            None for no limit.
+        :returns: the query to run.
+        :returns: a function to call once the query is finished.
+        """
+        if maxTime:
+            query = query.prefix_with(
+                '/*+ MAX_EXECUTION_TIME(%d) */' % max(1, int(maxTime * 1000)))
+        return query, lambda: None
+
+    def _queryCanceller(self, sess):
+        """
+        Get a function that cancels the query that a session is running.  This
+        kills the query from a separate connection.
+
+        :param sess: the session used for the query.
+        :returns: a function that takes no parameters.
+        """
+        return functools.partial(
+            self._killQuery, int(sess.connection().connection.thread_id()))
+
     def setSessionReadOnly(self, sess):
         """
         Set the specified session to read only if possible.  Subclasses should
@@ -17,15 +17,22 @@
 #  limitations under the License.
 ##############################################################################
 
+import binascii
+import functools
+import json
 import re
+import select
 import six
 import sqlalchemy
 import sqlalchemy.dialects.postgresql as dialect
+import threading
+import time
 
 from girder import logger as log
 
 from . import base
-from .sqlalchemydb import SQLAlchemyConnector
+from . import jsonencoder
+from .sqlalchemydb import SQLAlchemyConnector, getEngine
 
 
 PostgresOperators = {
@@ -56,6 +63,15 @@ PostgresDatatypes = {
 
 KnownTypes = {}
 
+# Notification listeners by database uri and channel; see NotifyListener.
+_notifyListeners = {}
+_notifyListenersLock = threading.Lock()
+# The number of seconds that a listener keeps its connection after its last
+# subscriber leaves, so that consecutive waits can reuse it, and the longest
+# that a subscriber waits for a listener to start.
+NOTIFY_IDLE_TIME = 60
+NOTIFY_START_TIMEOUT = 10
+
 
 class PostgresSAConnector(SQLAlchemyConnector):
     name = 'sqlalchemy_postgres'
@@ -66,6 +82,10 @@ class PostgresSAConnector(SQLAlchemyConnector):
         # dbparams can include values in http://www.postgresql.org/docs/
         #   current/static/libpq-connect.html#LIBPQ-PARAMKEYWORDS
         self.databaseOperators = PostgresOperators
+        self.allowRowValueComparison = True
+        # If set, waiting selects listen for notifications on this channel
+        # rather than polling.
+        self.notifyChannel = kwargs.get('notifychannel') or None
         # Get a list of types and their classes so that we can cast using
         # sqlalchemy
         self.types = KnownTypes
@@ -112,6 +132,112 @@ class PostgresSAConnector(SQLAlchemyConnector):
             self._allowedFunctions['distinct'] = True
         return self._allowedFunctions.get(funcname.lower(), False)
 
+    def _backendId(self, sess):
+        """
+        Get the process id of the Postgres backend that a session uses and
+        the start time of the session's transaction, which the query runs
+        in.  Together, these identify the query even if the backend is later
+        used for other queries.
+
+        :param sess: the session used for the query.
+        :returns: a dictionary with the backend process id (pid) and the
+            transaction start time as text (xactStart).
+        """
+        pid, xactStart = sess.execute(
+            'SELECT pg_backend_pid(), CAST(now() AS text)').fetchone()
+        return {'pid': int(pid), 'xactStart': xactStart}
+
+    def _cancelBackend(self, backend):
+        """
+        Cancel the query that a Postgres backend is running if the backend is
+        still in the query's transaction.
+
+        :param backend: a dictionary with the backend process id and
+            transaction start time.  See _backendId.
+        """
+        conn = self.dbEngine.connect()
+        try:
+            conn.execute(sqlalchemy.text(
+                'SELECT pg_cancel_backend(pid) FROM pg_stat_activity '
+                'WHERE pid = :pid AND xact_start = CAST(:xactStart AS timestamptz)'),
+                pid=backend['pid'], xactStart=backend['xactStart'])
+        finally:
+            conn.close()
+
+    def _estimateCount(self, sess, query):
+        """
+        Estimate the number of rows a query will return using the query
+        planner.  The planner's estimates are based on table statistics, such
+        as pg_class.reltuples, so they are only as current as the last time
+        the table was analyzed.
+
+        :param sess: the session used for the query.
+        :param query: the query to estimate.
+        :returns: the estimated number of rows or None if the query couldn't
+            be explained.
+        """
+        plan = self._explainPlan(sess, query)
+        return int(plan['Plan Rows']) if plan is not None else None
+
+    def _explainCost(self, sess, query):
+        """
+        Estimate the cost of a query using the query planner.  The cost is in
+        the planner's arbitrary units, where reading a page sequentially costs
+        1.
+
+        :param sess: the session used for the query.
+        :param query: the query to estimate.
+        :returns: a dictionary with the estimated cost and rows, or None if the
+            query couldn't be explained.
+        """
+        plan = self._explainPlan(sess, query)
+        if plan is None:
+            return None
+        return {'cost': float(plan['Total Cost']), 'rows': int(plan['Plan Rows'])}
+
+    def _explainPlan(self, sess, query):
+        """
+        Get the query planner's plan for a query.
+
+        :param sess: the session used for the query.
+        :param query: the query to explain.
+        :returns: the top node of the plan or None if the query couldn't be
+            explained.
+        """
+        plan = self._explain(sess, query, 'EXPLAIN (FORMAT JSON) ')
+        if plan is None:
+            return None
+        if isinstance(plan, six.string_types):
+            plan = json.loads(plan)
+        return plan[0]['Plan']
+
+    def _limitQueryTime(self, sess, query, maxTime):
+        """
+        Limit how long a query can run using a statement timeout that applies
+        to the rest of the current transaction.
+
+        :param sess: the session used for the query.
+        :param query: the query to limit.
+        :param maxTime: the longest time in seconds that the query may run, or
+            None for no limit.
+        :returns: the query to run.
+        :returns: a function to call once the query is finished.
+        """
+        if not maxTime:
+            return query, lambda: None
+        sess.execute('SET LOCAL statement_timeout = %d' % max(1, int(maxTime * 1000)))
+
+        def done():
+            # Don't let the timeout affect later queries in the same
+            # transaction.  If the query timed out, the transaction has to be
+            # rolled back anyway.
+            try:
+                sess.execute('SET LOCAL statement_timeout = DEFAULT')
+            except sqlalchemy.exc.SQLAlchemyError:
+                sess.rollback()
+
+        return query, done
+
     def setSessionReadOnly(self, sess):
         """
         Set the specified session to read only if possible.  Subclasses should
@@ -146,6 +272,129 @@ class PostgresSAConnector(SQLAlchemyConnector):
                     field['datatype'] = datatype
         return self.fields
 
+    def subscribeToChanges(self, callback, filters=[]):
+        """
+        If the connector has a notification channel, listen for notifications
+        on it.  {table} and {schema} in the channel name are replaced by the
+        connector's table and schema, so that a trigger can notify a channel
+        named after the changed table.
+
+        :param callback: a function that is called from another thread each
+            time the data may have changed.  It is passed True, or False if
+            notifications have stopped and the database must be polled.
+        :param filters: the filters of the select.  These are not used, since
+            notifications are for the whole channel.
+        :returns: a function that ends the subscription, or None if change
+            notifications are not available.
+        """
+        if not self.notifyChannel:
+            return None
+        channel = self.notifyChannel.replace(
+            '{schema}', self.schema or 'public').replace('{table}', self.table)
+        key = (self.databaseUri, channel)
+        with _notifyListenersLock:
+            listener = _notifyListeners.get(key)
+            if listener is None:
+                listener = NotifyListener(
+                    key, getEngine(self.databaseUri, **self.engineParams), channel)
+                _notifyListeners[key] = listener
+            listener.callbacks.add(callback)
+        if not listener.ready.wait(NOTIFY_START_TIMEOUT) or listener.failed:
+            listener.unsubscribe(callback)
+            return None
+        return functools.partial(listener.unsubscribe, callback)
+
+
+class NotifyListener(object):
+    """
+    Listen for notifications on a Postgres channel using a dedicated
+    connection, and call the subscribed functions when one arrives.  The
+    connection is closed once there have been no subscribers for a while.
+    """
+
+    def __init__(self, key, engine, channel):
+        """
+        Start listening.
+
+        :param key: the key of this listener in _notifyListeners.
+        :param engine: the SQLAlchemy engine used to connect.
+        :param channel: the name of the notification channel.
+        """
+        self.key = key
+        self.engine = engine
+        self.channel = channel
+        self.callbacks = set()
+        self.failed = False
+        # This is set once the listener is listening or has failed.
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def unsubscribe(self, callback):
+        """
+        Stop calling a subscribed function.
+
+        :param callback: the subscribed function.
+        """
+        with _notifyListenersLock:
+            self.callbacks.discard(callback)
+
+    def _run(self):
+        """
+        Listen for notifications until there are no subscribers or the
+        connection fails.  If it fails, the subscribers are told to poll.
+        """
+        raw = None
+        try:
+            raw = self.engine.raw_connection()
+            # This connection is only used for listening, so it is closed
+            # rather than returned to the engine's pool.
+            raw.detach()
+            conn = raw.connection
+            if not hasattr(conn, 'poll') or not hasattr(conn, 'notifies'):
+                raise Exception(
+                    'The database driver does not support notifications.')
+            conn.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute('LISTEN "%s"' % self.channel.replace('"', '""'))
+            cursor.close()
+            log.info('Listening for notifications on %s', self.channel)
+            self.ready.set()
+            idleSince = None
+            while True:
+                if select.select([conn], [], [], 1)[0]:
+                    conn.poll()
+                    if conn.notifies:
+                        del conn.notifies[:]
+                        with _notifyListenersLock:
+                            callbacks = list(self.callbacks)
+                        for callback in callbacks:
+                            callback(True)
+                with _notifyListenersLock:
+                    if self.callbacks:
+                        idleSince = None
+                    elif idleSince is None:
+                        idleSince = time.time()
+                    elif time.time() - idleSince > NOTIFY_IDLE_TIME:
+                        _notifyListeners.pop(self.key, None)
+                        return
+        except Exception:
+            log.exception('Failed to listen for notifications on %s',
+                          self.channel)
+            with _notifyListenersLock:
+                if _notifyListeners.get(self.key) is self:
+                    _notifyListeners.pop(self.key)
+                self.failed = True
+                callbacks = list(self.callbacks)
+                self.callbacks.clear()
+            self.ready.set()
+            for callback in callbacks:
+                callback(False)
+        finally:
+            if raw is not None:
+                raw.close()
+
 
 # Not all types in Postgres are known to SQLAlchemy.  We want to report this
 # information so that consumers of the data know what types are involved.  For
@@ -209,6 +458,12 @@ def _get_column_info(self, name, format_type, *args, **kwargs):
 
 dialect.base.PGDialect._get_column_info = _get_column_info
 
+# psycopg2 returns binary values, such as those from bytea columns or from
+# dynamic types with a binary representation, as memoryview objects.  Dump
+# these as hex strings, which is how PostGIS presents geometries as text.
+jsonencoder.registerJsonDefault(
+    memoryview, lambda value: binascii.hexlify(value).decode('utf8'))
+
 
 base.registerConnectorClass(PostgresSAConnector.name, PostgresSAConnector, {
     'dialects': {
@@ -17,11 +17,15 @@
 #  limitations under the License.
 ##############################################################################
 
+import collections
+import hashlib
 import six
 import sqlalchemy
 import sqlalchemy.engine.reflection
 import sqlalchemy.orm
+import threading
 import time
+import weakref
 
 from six.moves import range
 
@@ -43,23 +47,476 @@ DatabaseOperators = {
 }
 
 
-_enginePool = {}
-_enginePoolMaxSize = 5
+# The number of engines, each with its own connection pool, to keep.
+DEFAULT_ENGINE_REGISTRY_SIZE = 20
+
+# Optional assetstore settings that configure the connection pool of an
+# engine.  The keys are the connector options and the values are the
+# create_engine parameters.
+PoolOptions = {
+    'poolsize': 'pool_size',
+    'maxoverflow': 'max_overflow',
+    'poolrecycle': 'pool_recycle',
+    'poolpreping': 'pool_pre_ping',
+}
 
 
-def getEngine(uri, **kwargs):
+class EngineRegistry(object):
+    """
+    A least-recently-used registry of SQLAlchemy engines, so that connectors
+    with the same database parameters share a connection pool.  Connectors
+    own the engines they use until they are closed or garbage collected.
+    When there are more than maxSize engines, the least recently used engines
+    that no connector owns are removed and disposed, closing their idle
+    connections.  Connections that are checked out are closed when they are
+    returned.
+    """
+
+    def __init__(self, maxSize=DEFAULT_ENGINE_REGISTRY_SIZE):
+        """
+        :param maxSize: the maximum number of engines that aren't owned by a
+            connector.
+        """
+        self.maxSize = maxSize
+        self.evictions = 0
+        # Each entry has the engine and a weak set of its owners
+        self._engines = collections.OrderedDict()
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._engines)
+
+    def clear(self):
+        """
+        Remove and dispose all engines.
+        """
+        with self._lock:
+            engines = [entry['engine'] for entry in six.itervalues(self._engines)]
+            self._engines.clear()
+            self._keys.clear()
+        self._dispose(engines)
+
+    def get(self, uri, owner=None, **kwargs):
+        """
+        Get an engine, creating it if needed.
+
+        :param uri: the database uri.
+        :param owner: if not None, an object, such as a connector, that uses
+            the engine.  The engine isn't disposed while it has owners.  See
+            release.
+        :param **kwargs: parameters for sqlalchemy.create_engine.
+        :returns: the engine.
+        """
+        key = (uri, frozenset(six.viewitems(kwargs)))
+        with self._lock:
+            entry = self._engines.pop(key, None)
+            if entry is None:
+                entry = {
+                    'engine': sqlalchemy.create_engine(uri, **kwargs),
+                    'owners': weakref.WeakSet(),
+                }
+                self._keys[entry['engine']] = key
+            self._engines[key] = entry
+            if owner is not None:
+                entry['owners'].add(owner)
+            evicted = self._prune(key)
+        self._dispose(evicted)
+        return entry['engine']
+
+    def prune(self):
+        """
+        Remove and dispose the least recently used engines without owners in
+        excess of maxSize.  Call this after changing maxSize.
+        """
+        with self._lock:
+            evicted = self._prune()
+        self._dispose(evicted)
+
+    def release(self, owner):
+        """
+        Stop an owner from using its engines, so that they can be disposed.
+
+        :param owner: the owner passed to get.
+        """
+        with self._lock:
+            for entry in six.itervalues(self._engines):
+                entry['owners'].discard(owner)
+            evicted = self._prune()
+        self._dispose(evicted)
+
+    def touch(self, engine):
+        """
+        Mark an engine as the most recently used.
+
+        :param engine: an engine from get.
+        """
+        with self._lock:
+            key = self._keys.get(engine)
+            if key is not None and key in self._engines:
+                self._engines[key] = self._engines.pop(key)
+
+    def stats(self):
+        """
+        Get statistics about the engines and their connection pools.  Pools
+        that don't keep connections, such as those used for SQLite files, only
+        report their class.
+
+        :returns: a dictionary of statistics.
+        """
+        with self._lock:
+            entries = [(entry['engine'], len(entry['owners']))
+                       for entry in six.itervalues(self._engines)]
+            result = {
+                'engines': len(entries),
+                'maxSize': self.maxSize,
+                'evictions': self.evictions,
+            }
+        pools = []
+        for engine, owners in entries:
+            pool = engine.pool
+            # Don't report credentials
+            entry = {
+                'dialect': engine.url.drivername,
+                'host': engine.url.host,
+                'port': engine.url.port,
+                'database': engine.url.database,
+                'pool': pool.__class__.__name__,
+                'owners': owners,
+            }
+            for key, method in (
+                    ('size', 'size'), ('checkedIn', 'checkedin'),
+                    ('checkedOut', 'checkedout'), ('overflow', 'overflow')):
+                if callable(getattr(pool, method, None)):
+                    entry[key] = getattr(pool, method)()
+            pools.append(entry)
+        result['pools'] = pools
+        return result
+
+    def _dispose(self, engines):
+        for engine in engines:
+            try:
+                engine.dispose()
+            except Exception:
+                log.exception('Failed to dispose of a database engine')
+
+    def _prune(self, keep=None):
+        """
+        Remove the least recently used engines without owners in excess of
+        maxSize.  This must be called while holding the lock.
+
+        :param keep: the key of an engine not to remove, such as one that is
+            about to be returned.
+        :returns: a list of removed engines to dispose once the lock is
+            released.
+        """
+        evicted = []
+        excess = len(self._engines) - max(self.maxSize, 1)
+        for key, entry in list(six.iteritems(self._engines)):
+            if excess <= 0:
+                break
+            if key != keep and not len(entry['owners']):
+                del self._engines[key]
+                del self._keys[entry['engine']]
+                evicted.append(entry['engine'])
+                self.evictions += 1
+                excess -= 1
+        return evicted
+
+
+_engineRegistry = EngineRegistry()
+
+
+def getEngine(uri, owner=None, **kwargs):
     """
     Get a sqlalchemy engine from a pool in case we use the same parameters for
-    multiple connections.
+    multiple connections.  See EngineRegistry.get.
+    """
+    return _engineRegistry.get(uri, owner, **kwargs)
+
+
+class SessionRegistry(object):
+    """
+    A thread-safe record of the sessions that clients are using.  Each client
+    has a dictionary with the session, whether it is in use, the last time it
+    was claimed, and a function that cancels its running query.  Sessions that
+    are idle longer than idleTime are closed by a reaper on the shared poll
+    scheduler.  A session is only used by one thread at a time, so a session
+    that is in use is never closed from another thread: when another query
+    from its client needs a session, or it is held longer than abandonTime, it
+    is dropped from the registry, and the thread using it closes it when it
+    releases it.
+    """
+
+    def __init__(self, idleTime, abandonTime):
+        """
+        :param idleTime: seconds after which an unused session is closed.
+        :param abandonTime: seconds after which a session that is in use is
+            dropped, so that it is closed when it is released.
+        """
+        self.idleTime = idleTime
+        self.abandonTime = abandonTime
+        self._sessions = {}
+        self._lock = threading.RLock()
+        self._nextReap = None
+
+    def __contains__(self, client):
+        with self._lock:
+            return client in self._sessions
+
+    def __getitem__(self, client):
+        with self._lock:
+            return self._sessions[client]
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._sessions))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def get(self, client, default=None):
+        with self._lock:
+            return self._sessions.get(client, default)
+
+    def add(self, client, sess):
+        """
+        Record a new session for a client and mark it as in use.  If the
+        client already has a session, it is replaced; it is closed when its
+        query releases it.
+
+        :param client: the client that owns the session.
+        :param sess: the session.
+        """
+        with self._lock:
+            self._sessions[client] = {
+                'session': sess, 'used': True, 'last': time.time(),
+                'cancel': None}
+            self._scheduleReap()
+
+    def claim(self, client):
+        """
+        Mark a client's idle session as in use.  If the client's session is in
+        use by another query, it is dropped, so that the query closes it when
+        it releases it, and the client needs a new session.
+
+        :param client: the client that owns the session.
+        :returns: the session or None if the client doesn't have an idle one.
+        :returns: a function that cancels the query using the dropped session,
+            or None.
+        """
+        with self._lock:
+            record = self._sessions.get(client)
+            if record is None:
+                return None, None
+            if record['used']:
+                del self._sessions[client]
+                return None, record['cancel']
+            record['used'] = True
+            record['last'] = time.time()
+            return record['session'], None
+
+    def closeAll(self):
+        """
+        Close all sessions.  Sessions that are in use are closed when they are
+        released.
+        """
+        with self._lock:
+            records = list(six.itervalues(self._sessions))
+            self._sessions.clear()
+        for record in records:
+            if not record['used']:
+                try:
+                    record['session'].close()
+                except Exception:
+                    log.exception('Failed to close a session')
+
+    def counts(self):
+        """
+        Count the sessions.
+
+        :returns: a dictionary with the number of live sessions and how many
+            of those are idle and in use.
+        """
+        with self._lock:
+            inUse = sum(1 for record in six.itervalues(self._sessions)
+                        if record['used'])
+            return {
+                'live': len(self._sessions),
+                'idle': len(self._sessions) - inUse,
+                'inUse': inUse,
+            }
+
+    def reap(self):
+        """
+        Close sessions that have been idle too long, and drop sessions that
+        have been held too long so that they are closed when they are
+        released.
+
+        :returns: the number of sessions that were closed or dropped.
+        """
+        curtime = time.time()
+        with self._lock:
+            expired = [client for client, record in six.iteritems(self._sessions)
+                       if curtime >= self._expiry(record)]
+            records = [self._sessions.pop(client) for client in expired]
+        for record in records:
+            if record['used']:
+                continue
+            # Close the session.  sqlalchemy keeps them too long otherwise
+            try:
+                record['session'].close()
+            except Exception:
+                log.exception('Failed to close an expired session')
+        return len(records)
+
+    def release(self, client, sess):
+        """
+        Mark that a client has finished with its session.
+
+        :param client: the client that owns the session.
+        :param sess: the session the client was using.
+        :returns: True if this is the client's current session, in which case
+            it is kept for the client's next query.
+        """
+        with self._lock:
+            record = self._sessions.get(client)
+            if record is None or record['session'] is not sess:
+                return False
+            record['used'] = False
+            record['cancel'] = None
+            self._scheduleReap()
+            return True
+
+    def setCanceller(self, client, sess, cancel):
+        """
+        Record the function that cancels the query that a client's session is
+        running, so that a later query from the client can cancel it without
+        using the session.
+
+        :param client: the client that owns the session.
+        :param sess: the session running the query.
+        :param cancel: a function that can be called from any thread, or None
+            once the query has finished.
+        :returns: True if this is still the client's session, or False if it
+            was dropped.
+        """
+        with self._lock:
+            record = self._sessions.get(client)
+            if record is None or record['session'] is not sess:
+                return False
+            record['cancel'] = cancel
+            return True
+
+    def _expiry(self, record):
+        return record['last'] + (
+            self.abandonTime if record['used'] else self.idleTime)
+
+    def _reapScheduled(self):
+        with self._lock:
+            self._nextReap = None
+        self.reap()
+        with self._lock:
+            self._scheduleReap()
+
+    def _scheduleReap(self):
+        """
+        Schedule the reaper for when the next session expires.  This must be
+        called while holding the lock.
+        """
+        if not self._sessions:
+            return
+        when = min(self._expiry(record)
+                   for record in six.itervalues(self._sessions))
+        if self._nextReap is None or when < self._nextReap:
+            self._nextReap = when
+            base.pollScheduler.schedule(when, self._reapScheduled)
+
+
+class QueryTimer(object):
     """
-    key = (uri, frozenset(six.viewitems(kwargs)))
-    engine = _enginePool.get(key)
-    if engine is None:
-        engine = sqlalchemy.create_engine(uri, **kwargs)
-        if len(_enginePool) >= _enginePoolMaxSize:
-            _enginePoolMaxSize.clear()
-        _enginePool[key] = engine
-    return engine
+    Cancel a query once it has spent more than a limited time executing and
+    fetching rows.  The time is measured on a thread of its own, so that
+    other scheduled work can't delay cancelling.  While the timer is paused,
+    such as while streamed rows are sent to the client, time isn't counted.
+    """
+
+    def __init__(self, maxTime, cancel):
+        """
+        :param maxTime: the longest time in seconds that the query may run.
+        :param cancel: a function that cancels the query.  It is called from
+            the timer's thread.
+        """
+        self.maxTime = maxTime
+        self._cancel = cancel
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._timer = None
+        # The seconds counted before the last resume and the time of the last
+        # resume (or None while paused).  Only the query's thread changes
+        # this, replacing the tuple so that the timer's thread reads
+        # consistent values.
+        self._state = (0, time.time())
+        with self._lock:
+            self._schedule(maxTime)
+
+    def pause(self):
+        """
+        Stop counting time until resume is called.
+        """
+        elapsed, started = self._state
+        if started is not None:
+            self._state = (elapsed + time.time() - started, None)
+
+    def resume(self):
+        """
+        Count time again after pause.
+        """
+        self._state = (self._state[0], time.time())
+        if self._timer is None:
+            with self._lock:
+                if self._timer is None and not self._stopped:
+                    self._schedule(self.maxTime - self._state[0])
+
+    def stop(self):
+        """
+        Stop the timer once the query is finished.
+        """
+        with self._lock:
+            self._stopped = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _check(self):
+        with self._lock:
+            if self._stopped:
+                return
+            # A paused timer is restarted when it is resumed.  Check the
+            # state after clearing the timer, since resume only restarts a
+            # cleared timer.
+            self._timer = None
+            elapsed, started = self._state
+            if started is None:
+                return
+            elapsed += time.time() - started
+            if elapsed < self.maxTime:
+                self._schedule(self.maxTime - elapsed)
+                return
+            self._stopped = True
+        log.info('Cancelling a query that ran for more than %g s', self.maxTime)
+        try:
+            self._cancel()
+        except Exception:
+            log.exception('Failed to cancel a query')
+
+    def _schedule(self, delay):
+        # The lock must be held
+        self._timer = threading.Timer(max(0, delay), self._check)
+        self._timer.daemon = True
+        self._timer.start()
 
 
 class SQLAlchemyConnector(base.DatabaseConnector):
@@ -70,10 +527,13 @@ class SQLAlchemyConnector(base.DatabaseConnector):
         self.table = kwargs.get('table')
         self.schema = kwargs.get('schema')
         self.dbEngine = None
-        self.sessions = {}
         # dbparams can include values in http://www.postgresql.org/docs/
         #   current/static/libpq-connect.html#LIBPQ-PARAMKEYWORDS
         self.dbparams = kwargs.get('dbparams', {})
+        # Connection pool settings are passed to the engine with the dbparams
+        self.engineParams = dict(self.dbparams, **{
+            param: kwargs[key] for key, param in six.iteritems(PoolOptions)
+            if kwargs.get(key) is not None})
         self.databaseUri = self.adjustDBUri(kwargs.get('uri'))
 
         # Additional parameters:
@@ -82,11 +542,15 @@ class SQLAlchemyConnector(base.DatabaseConnector):
         self.dbIdleTime = float(kwargs.get('idletime', 300))
         self.dbAbandonTime = float(kwargs.get('abandontime',
                                    self.dbIdleTime * 5))
+        self.sessions = SessionRegistry(self.dbIdleTime, self.dbAbandonTime)
         self.databaseOperators = DatabaseOperators
         self.fields = None
         self.allowFieldFunctions = True
         self.allowSortFunctions = True
         self.allowFilterFunctions = True
+        # Set to True if the database supports comparing row values, such as
+        # (a, b) > (x, y)
+        self.allowRowValueComparison = False
         self.initialized = True
         self.types = {type: getattr(sqlalchemy, type) for type in dir(sqlalchemy)
                       if isinstance(getattr(sqlalchemy, type),
@@ -113,6 +577,22 @@ class SQLAlchemyConnector(base.DatabaseConnector):
         :param filter: information on the filter.
         :return: the modified list.
         """
+        if 'after' in filter:
+            keys = filter['after']
+            if (self.allowRowValueComparison and len(keys) > 1 and
+                    len({key[1] for key in keys}) == 1 and
+                    all(key[2] is not None for key in keys)):
+                # A row value comparison, such as (a, b) > (x, y), can use a
+                # multicolumn index directly.
+                columns = sqlalchemy.tuple_(*[
+                    self._convertFieldOrFunction(key[0]) for key in keys])
+                values = sqlalchemy.tuple_(*[
+                    sqlalchemy.sql.expression.bindparam(None, key[2])
+                    for key in keys])
+                filterList.append(
+                    columns < values if keys[0][1] < 0 else columns > values)
+                return filterList
+            filter = base.keysetFilter(keys)
         if 'group' in filter:
             sublist = []
             for subfilter in filter['value']:
@@ -220,18 +700,31 @@ class SQLAlchemyConnector(base.DatabaseConnector):
             uri = '%s://%s' % (dialect, uri.split('://', 1)[1])
         return uri
 
+    def close(self):
+        """
+        Close the sessions that clients are using and stop owning the
+        connector's engine, so that it can be disposed.  See the base class
+        for more information.
+        """
+        self.sessions.closeAll()
+        _engineRegistry.release(self)
+
     def connect(self, client=None):
         """
         Connect to the database.
 
         :param client: if None, use a new session.  If specified, if this
                        client is currently marked in use, cancel the client's
-                       existing query and return a connection from the pool fo
-                       r the client to use.
+                       existing query and return a new session for the client
+                       to use.  The existing query's thread closes its session
+                       when it is done with it.
         :return: a SQLAlchemny session object.
         """
-        if not self.dbEngine:
-            engine = getEngine(self.databaseUri, **self.dbparams)
+        if self.dbEngine:
+            # Keep the engines that are in use from being evicted first
+            _engineRegistry.touch(self.dbEngine)
+        else:
+            engine = getEngine(self.databaseUri, self, **self.engineParams)
             metadata = sqlalchemy.MetaData(engine)
             table = sqlalchemy.Table(self.table, metadata, schema=self.schema,
                                      autoload=True)
@@ -252,25 +745,19 @@ class SQLAlchemyConnector(base.DatabaseConnector):
             sqlalchemy.orm.mapper(
                 self.tableClass, table, primary_key=fallbackPrimaryCol)
             self.dbEngine = engine
-        # If we are asking for a specific client, clean up defunct clients
-        curtime = time.time()
+        sess, cancel = None, None
         if client:
-            for oldsess in list(self.sessions):
-                idle = curtime - self.sessions[oldsess]['last']
-                if ((idle > self.dbIdleTime and
-                        not self.sessions[oldsess]['used']) or
-                        idle > self.dbAbandonTime):
-                    # Close the session.  sqlalchemy keeps them too long
-                    # otherwise
-                    self.sessions[oldsess]['session'].close()
-                    del self.sessions[oldsess]
-        # Cancel an existing query
-        if client in self.sessions and self.sessions[client]['used']:
-            self.sessions[client]['session'].connection().connection.cancel()
-            self.sessions[client]['session'].rollback()
-            self.sessions[client]['used'] = False
-        if client in self.sessions:
-            sess = self.sessions[client]['session']
+            # Clean up defunct clients so that an expired session isn't reused
+            self.sessions.reap()
+            sess, cancel = self.sessions.claim(client)
+        # Cancel an existing query.  Its session is in use by another thread,
+        # so only the canceller, which can be called from any thread, is used.
+        if cancel is not None:
+            try:
+                cancel()
+            except Exception:
+                log.exception('Failed to cancel a query')
+        if sess is not None:
             # Always ensure a fresh query
             sess.rollback()
         else:
@@ -282,12 +769,8 @@ class SQLAlchemyConnector(base.DatabaseConnector):
             # state for generating random numbers which could have
             # cryptographic implications).
             self.setSessionReadOnly(sess)
-        if client:
-            if client not in self.sessions:
-                self.sessions[client] = {}
-            self.sessions[client]['used'] = True
-            self.sessions[client]['last'] = curtime
-            self.sessions[client]['session'] = sess
+            if client:
+                self.sessions.add(client, sess)
         return sess
 
     def disconnect(self, db, client=None):
@@ -298,9 +781,7 @@ class SQLAlchemyConnector(base.DatabaseConnector):
         :param db: the database connection to mark as finished.
         :param client: the client that owned this connection.
         """
-        if client in self.sessions:
-            self.sessions[client]['used'] = False
-        else:
+        if not self.sessions.release(client, db):
             # Close the session.  sqlalchemy keeps them too long otherwise
             db.close()
 
@@ -313,6 +794,308 @@ class SQLAlchemyConnector(base.DatabaseConnector):
         """
         pass
 
+    def _estimateCount(self, sess, query):
+        """
+        Estimate the number of rows a query will return without running it.
+
+        :param sess: the session used for the query.
+        :param query: the query to estimate.
+        :returns: the estimated number of rows or None if this database can't
+            estimate it.
+        """
+        return None
+
+    def _explain(self, sess, query, prefix):
+        """
+        Explain a query without running it.
+
+        :param sess: the session used for the query.
+        :param query: the query to explain.
+        :param prefix: the database's EXPLAIN statement, such as 'EXPLAIN '.
+        :returns: the first value of the explanation or None if the query
+            couldn't be explained.
+        """
+        statement = query.statement.compile(bind=sess.get_bind())
+        params = statement.params
+        if statement.positional:
+            params = [params[key] for key in statement.positiontup]
+        cursor = sess.connection().connection.cursor()
+        try:
+            cursor.execute(prefix + str(statement), params)
+            return cursor.fetchone()[0]
+        except Exception:
+            log.exception('Failed to explain a query')
+            sess.rollback()
+            return None
+        finally:
+            cursor.close()
+
+    def _explainCost(self, sess, query):
+        """
+        Estimate the cost of a query using the database's query planner.
+
+        :param sess: the session used for the query.
+        :param query: the query to estimate.
+        :returns: a dictionary with the estimated cost and rows, or None if
+            this database can't estimate it.
+        """
+        return None
+
+    def _filteredQuery(self, sess, queryProps, filters):
+        """
+        Construct a query on the table with filters and grouping applied.
+
+        :param sess: the session to use for the query.
+        :param queryProps: general query properties, including group.
+        :param filters: a list of filters to apply.
+        :returns: the query.
+        """
+        query = sess.query(self.tableClass)
+        filterQueries = []
+        for filter in filters:
+            filterQueries = self._addFilter(filterQueries, filter)
+        if len(filterQueries):
+            query = query.filter(sqlalchemy.and_(*filterQueries))
+        if queryProps.get('group'):
+            groups = [self._convertFieldOrFunction(field)
+                      for field in queryProps['group']]
+            if len(groups):
+                query = query.group_by(*groups)
+        return query
+
+    def _backendId(self, sess):
+        """
+        Get an id for the query that a session is about to run that can be
+        used to cancel it from any process.  Since the connection may be
+        reused by other queries, the id should identify the query (or its
+        transaction) and not just the connection.  Subclasses should
+        implement this if their database can do so.
+
+        :param sess: the session used for the query.
+        :returns: the id or None.  This must be storable in Mongo.
+        """
+        return None
+
+    def _cancelBackend(self, backend):
+        """
+        Cancel a query if it is still running.  See _backendId.
+
+        :param backend: the id of the query.
+        """
+        pass
+
+    def _markQuery(self, query, backend):
+        """
+        Mark a query so that _cancelBackend can recognize it.  By default,
+        queries aren't changed.
+
+        :param query: the query to run.
+        :param backend: the id of the query from _backendId.
+        :returns: the query to run.
+        """
+        return query
+
+    def _limitQueryTime(self, sess, query, maxTime):
+        """
+        Limit how long a query can run.  By default, the query is cancelled
+        from a timer thread once it has spent the time executing and fetching
+        rows; see QueryTimer.  The timer is recorded in the session's info
+        as queryTimer, so that it can be paused while streamed rows are
+        output.  Connectors whose databases have statement timeouts override
+        this.
+
+        :param sess: the session used for the query.
+        :param query: the query to limit.
+        :param maxTime: the longest time in seconds that the query may run, or
+            None for no limit.
+        :returns: the query to run.
+        :returns: a function to call once the query is finished.
+        """
+        if not maxTime:
+            return query, lambda: None
+        # Autoflush can end the session's transaction (see
+        # SqliteSAConnector.setSessionReadOnly), so turn it off to make the
+        # query run on the connection that is cancelled.  Get the canceller on
+        # this thread, since the session can't be used from the timer's
+        # thread.
+        query = query.autoflush(False)
+        cancel = self._queryCanceller(sess)
+        if cancel is None:
+            return query, lambda: None
+        timer = QueryTimer(maxTime, cancel)
+        sess.info['queryTimer'] = timer
+
+        def done():
+            timer.stop()
+            if sess.info.get('queryTimer') is timer:
+                del sess.info['queryTimer']
+
+        return query, done
+
+    def _registerClientQuery(self, sess, query, client, maxTime=None):
+        """
+        Record a client's query in the shared client query registry,
+        cancelling the client's previous query if another process is running
+        it.
+
+        :param sess: the session used for the query.
+        :param query: the query to run.
+        :param client: the client making the query or None.
+        :param maxTime: the longest time in seconds that the query may run, or
+            None for no limit.  The record expires after this time.
+        :returns: the query to run.
+        :returns: a function to call once the query is finished.
+        """
+        registry = base.clientQueryRegistry
+        if not client or registry is None:
+            return query, lambda: None
+        # Don't record database credentials
+        scope = hashlib.sha1(repr((
+            self.databaseUri, self.schema, self.table)).encode('utf8')).hexdigest()
+        try:
+            backend = self._backendId(sess)
+            if backend is None:
+                return query, lambda: None
+            token, previous = registry.claim(scope, client, backend, maxTime)
+        except Exception:
+            log.exception('Failed to register a client query')
+            return query, lambda: None
+        if previous is not None:
+            log.info('Cancelling a query for client %s on another process', client)
+            try:
+                self._cancelBackend(previous)
+            except Exception:
+                log.exception('Failed to cancel a query')
+
+        def done():
+            try:
+                registry.release(scope, client, token)
+            except Exception:
+                log.exception('Failed to release a client query')
+
+        return self._markQuery(query, backend), done
+
+    def _queryCanceller(self, sess):
+        """
+        Get a function that cancels the query that a session is running.  The
+        function can be called from any thread.  By default, this uses the
+        database driver's cancel method (as with psycopg2) or interrupt method
+        (as with sqlite3).
+
+        :param sess: the session used for the query.
+        :returns: a function that takes no parameters, or None if queries
+            can't be cancelled.
+        """
+        dbapiConn = sess.connection().connection
+        for method in ('cancel', 'interrupt'):
+            if callable(getattr(dbapiConn, method, None)):
+                return getattr(dbapiConn, method)
+        return None
+
+    def _startQuery(self, sess, query, queryProps, client=None):
+        """
+        Prepare to run a query, limiting how long it can run and recording it
+        so that later queries from the same client can cancel it.
+
+        :param sess: the session used for the query.
+        :param query: the query to run.
+        :param queryProps: general query properties, including maxtime.
+        :param client: the client making the query or None.
+        :returns: the query to run.
+        :returns: a function to call once the query is finished.
+        """
+        query, limitDone = self._limitQueryTime(
+            sess, query, queryProps.get('maxtime'))
+        query, registryDone = self._registerClientQuery(
+            sess, query, client, queryProps.get('maxtime'))
+        if client:
+            # Record how to cancel the query for the client's next query, as
+            # with _limitQueryTime.  If a newer query from the client has
+            # already taken the session's place, don't run this one.
+            query = query.autoflush(False)
+            cancel = self._queryCanceller(sess)
+            if not self.sessions.setCanceller(client, sess, cancel):
+                limitDone()
+                registryDone()
+                raise DatabaseConnectorException(
+                    'The query was cancelled by a newer query from the same '
+                    'client.')
+
+        def done():
+            limitDone()
+            registryDone()
+            if client:
+                self.sessions.setCanceller(client, sess, None)
+
+        return query, done
+
+    def _selectQuery(self, sess, queryProps, filters):
+        """
+        Construct the query for a select.
+
+        :param sess: the session to use for the query.
+        :param queryProps: general query properties, including fields, group,
+                           sort, limit, and offset.
+        :param filters: a list of filters to apply.
+        :returns: the query.
+        """
+        query = self._filteredQuery(sess, queryProps, filters)
+        if queryProps.get('sort'):
+            sortList = []
+            for pos in range(len(queryProps['sort'])):
+                sort = queryProps['sort'][pos]
+                sortCol = self._convertFieldOrFunction(sort[0])
+                if sort[1] == -1:
+                    sortCol = sortCol.desc()
+                sortList.append(sortCol)
+            query = query.order_by(*sortList)
+        if (queryProps.get('limit') is not None and
+                int(queryProps['limit']) >= 0):
+            query = query.limit(int(queryProps['limit']))
+        if 'offset' in queryProps:
+            query = query.offset(int(queryProps['offset']))
+        columns = [self._convertFieldOrFunction(field)
+                   for field in queryProps['fields']]
+        # Clone the query and set it to return the columns we are interested
+        # in.  Using   result['data'] = list(query.values(*columns))   is more
+        # compact and skips one internal _clone call, but doesn't allow logging
+        # the actual sql used.  with_entities clears the columns we are
+        # selecting (it defaults to all of the native table columns), and
+        # add_columns puts back just what we want, including expressions.
+        query = query.with_entities(*[])
+        query = query.add_columns(*columns)
+        return query
+
+    def estimateCost(self, fields, queryProps={}, filters=[]):
+        """
+        Estimate the cost of a select query using the database's query
+        planner.  See the base class for more information.
+
+        :param fields: the results from getFieldInfo.
+        :param queryProps: general query properties, including limit, offset,
+                           sort, fields, and group.
+        :param filters: a list of filters to apply.
+        :returns: a dictionary with the estimated cost and rows, or None.
+        """
+        if queryProps.get('fields') is None:
+            queryProps = dict(queryProps, fields=[
+                field['name'] for field in fields])
+        sess = self.connect()
+        try:
+            return self._explainCost(
+                sess, self._selectQuery(sess, queryProps, filters))
+        finally:
+            self.disconnect(sess)
+
+    def getSessionCounts(self):
+        """
+        Count the sessions that this connector keeps for clients.
+
+        :returns: a dictionary with the number of live sessions and how many
+            of those are idle and in use.
+        """
+        return self.sessions.counts()
+
     def getFieldInfo(self):
         """
         Return a list of fields that are known and can be queried.
@@ -341,6 +1124,48 @@ class SQLAlchemyConnector(base.DatabaseConnector):
             self.fields = fields
         return fields
 
+    def getPartitions(self, fields, queryProps={}, filters=[], partitions=2):
+        """
+        Split the rows that a select query would return into ranges of the
+        first primary key column.  Numeric keys are split into equal ranges
+        between their minimum and maximum.  Other keys are split at evenly
+        spaced rows.  See the base class for more information.
+
+        :param fields: the results from getFieldInfo.
+        :param queryProps: general query properties.
+        :param filters: a list of filters to apply.
+        :param partitions: the desired number of partitions.
+        :returns: the partitions or None.
+        """
+        sess = self.connect()
+        try:
+            mapper = sqlalchemy.orm.class_mapper(self.tableClass)
+            column = mapper.primary_key[0]
+            field = mapper.get_property_by_column(column).key
+            query = self._filteredQuery(sess, {}, filters)
+            low, high = query.with_entities(
+                sqlalchemy.func.min(column), sqlalchemy.func.max(column)).one()
+            if low is None:
+                return None
+            boundaries = base.rangeBoundaries(low, high, partitions)
+            if boundaries is None:
+                keyQuery = query.with_entities(column).filter(
+                    column.isnot(None)).order_by(column)
+                count = keyQuery.count()
+                boundaries = [
+                    keyQuery.offset(count * idx // partitions).limit(1).scalar()
+                    for idx in range(1, partitions)]
+                boundaries = sorted(set(
+                    value for value in boundaries
+                    if value is not None and value > low))
+            log.info('Partitions: %s %r', field, boundaries)
+            return {
+                'field': field,
+                'filters': base.partitionFilters(field, boundaries),
+            }
+        finally:
+            self.disconnect(sess)
+
     @classmethod
     def getTableList(cls, uri, internalTables=False, dbparams={}, **kwargs):
         """
@@ -354,32 +1179,77 @@ class SQLAlchemyConnector(base.DatabaseConnector):
         :returns: A list of known tables.
         """
         dbEngine = sqlalchemy.create_engine(cls.adjustDBUri(uri), **dbparams)
-        insp = sqlalchemy.engine.reflection.Inspector.from_engine(dbEngine)
-        schemas = insp.get_schema_names()
-        defaultSchema = insp.default_schema_name
-
-        tables = [{'name': table, 'table': table}
-                  for table in dbEngine.table_names()]
-        tables.extend([{'name': view, 'table': view}
-                       for view in insp.get_view_names()])
-        databaseName = base.databaseFromUri(uri)
-        results = [{'database': databaseName, 'tables': tables}]
-        if len(schemas) <= MAX_SCHEMAS_IN_TABLE_LIST:
-            for schema in schemas:
-                if not internalTables and schema.lower() == 'information_schema':
-                    continue
-                if schema != defaultSchema:
-                    tables = [{'name': '%s.%s' % (schema, table),
-                               'table': table, 'schema': schema}
-                              for table in dbEngine.table_names(schema=schema)]
-                    tables.extend([{'name': '%s.%s' % (schema, view),
-                                    'table': view, 'schema': schema}
-                                   for view in insp.get_view_names(schema=schema)])
-                    results[0]['tables'].extend(tables)
-        else:
-            log.info('Not enumerating all schemas for table list (%d schemas)', len(schemas))
+        try:
+            insp = sqlalchemy.engine.reflection.Inspector.from_engine(dbEngine)
+            schemas = insp.get_schema_names()
+            defaultSchema = insp.default_schema_name
+
+            tables = [{'name': table, 'table': table}
+                      for table in dbEngine.table_names()]
+            tables.extend([{'name': view, 'table': view}
+                           for view in insp.get_view_names()])
+            databaseName = base.databaseFromUri(uri)
+            results = [{'database': databaseName, 'tables': tables}]
+            if len(schemas) <= MAX_SCHEMAS_IN_TABLE_LIST:
+                for schema in schemas:
+                    if not internalTables and schema.lower() == 'information_schema':
+                        continue
+                    if schema != defaultSchema:
+                        tables = [{'name': '%s.%s' % (schema, table),
+                                   'table': table, 'schema': schema}
+                                  for table in dbEngine.table_names(schema=schema)]
+                        tables.extend([{'name': '%s.%s' % (schema, view),
+                                        'table': view, 'schema': schema}
+                                       for view in insp.get_view_names(schema=schema)])
+                        results[0]['tables'].extend(tables)
+            else:
+                log.info('Not enumerating all schemas for table list (%d schemas)', len(schemas))
+        finally:
+            # This engine isn't shared, so close its connections
+            dbEngine.dispose()
         return results
 
+    def performCount(self, fields, queryProps={}, filters=[], client=None):
+        """
+        Count the rows that a select query would return without a limit or
+        offset.  Exact and capped counts use COUNT(*) on the filtered query.
+        See the base class for more information.
+
+        :param fields: the results from getFieldInfo.
+        :param queryProps: general query properties, including group, count,
+                           and countcap.
+        :param filters: a list of filters to apply.
+        :param client: if a client is specified, a previous query made by this
+                       client can be cancelled.
+        :return: the count.
+        """
+        sess = self.connect(client)
+        try:
+            query = self._filteredQuery(sess, queryProps, filters)
+            if queryProps.get('count') == 'estimate':
+                count = self._estimateCount(sess, query)
+                if count is not None:
+                    return base.countResult(count, mode='estimate')
+            cap = base.countCap(queryProps)
+            if cap is not None:
+                # Counting a limited subquery stops after the cap is reached
+                query = query.limit(cap)
+            # This counts the rows of the query as a subquery, so grouped
+            # queries count the groups.
+            countQuery = sess.query(sqlalchemy.func.count()).select_from(
+                query.subquery())
+            countQuery, queryDone = self._startQuery(
+                sess, countQuery, queryProps, client)
+            log.info('Query: %s', ' '.join(str(countQuery.statement.compile(
+                bind=sess.get_bind(),
+                compile_kwargs={'literal_binds': True})).split()))
+            try:
+                return base.countResult(countQuery.scalar(), cap)
+            finally:
+                queryDone()
+        finally:
+            self.disconnect(sess, client)
+
     def performSelect(self, fields, queryProps={}, filters=[], client=None):
         """
         Perform a select query.  The results are passed back as a dictionary
@@ -392,9 +1262,13 @@ class SQLAlchemyConnector(base.DatabaseConnector):
           data: a list with one entry per row of results.  Each entry is a list
         with one entry per column.
 
+        If the stream query property is True, data is an iterator that fetches
+        rows from a server-side cursor in batches, and the database session
+        is only released once the iterator is exhausted or closed.
+
         :param fields: the results from getFieldInfo.
         :param queryProps: general query properties, including limit, offset,
-                           and sort.
+                           sort, and stream.
         :param filters: a list of filters to apply.
         :param client: if a client is specified, a previous query made by this
                        client can be cancelled.
@@ -410,48 +1284,66 @@ class SQLAlchemyConnector(base.DatabaseConnector):
             'data': []
         }
         sess = self.connect(client)
-        query = sess.query(self.tableClass)
-        filterQueries = []
-        for filter in filters:
-            filterQueries = self._addFilter(filterQueries, filter)
-        if len(filterQueries):
-            query = query.filter(sqlalchemy.and_(*filterQueries))
-        if queryProps.get('group'):
-            groups = [self._convertFieldOrFunction(field)
-                      for field in queryProps['group']]
-            if len(groups):
-                query = query.group_by(*groups)
-        if queryProps.get('sort'):
-            sortList = []
-            for pos in range(len(queryProps['sort'])):
-                sort = queryProps['sort'][pos]
-                sortCol = self._convertFieldOrFunction(sort[0])
-                if sort[1] == -1:
-                    sortCol = sortCol.desc()
-                sortList.append(sortCol)
-            query = query.order_by(*sortList)
-        if (queryProps.get('limit') is not None and
-                int(queryProps['limit']) >= 0):
-            query = query.limit(int(queryProps['limit']))
-        if 'offset' in queryProps:
-            query = query.offset(int(queryProps['offset']))
-        columns = [self._convertFieldOrFunction(field)
-                   for field in queryProps['fields']]
-        # Clone the query and set it to return the columns we are interested
-        # in.  Using   result['data'] = list(query.values(*columns))   is more
-        # compact and skips one internal _clone call, but doesn't allow logging
-        # the actual sql used.  with_entities clears the columns we are
-        # selecting (it defaults to all of the native table columns), and
-        # add_columns puts back just what we want, including expressions.
-        query = query.with_entities(*[])
-        query = query.add_columns(*columns)
+        try:
+            query = self._selectQuery(sess, queryProps, filters)
+            query, queryDone = self._startQuery(sess, query, queryProps, client)
+        except Exception:
+            # Sessions are only closed by the thread using them, so release
+            # this one on failure
+            self.disconnect(sess, client)
+            raise
         log.info('Query: %s', ' '.join(str(query.statement.compile(
             bind=sess.get_bind(),
             compile_kwargs={'literal_binds': True})).split()))
-        result['data'] = list(query)
-        self.disconnect(sess, client)
+        if queryProps.get('stream'):
+            # yield_per also sets the stream_results execution option, so
+            # dialects that support it use a server-side cursor.
+            query = query.yield_per(self.batchSize)
+            # Start the query here so that errors are reported immediately
+            try:
+                rows = iter(query)
+            except Exception:
+                queryDone()
+                self.disconnect(sess, client)
+                raise
+            result['data'] = self._streamResults(
+                rows, sess, client, queryDone, sess.info.get('queryTimer'))
+        else:
+            try:
+                result['data'] = list(query)
+            finally:
+                queryDone()
+                self.disconnect(sess, client)
         return result
 
+    def _streamResults(self, rows, sess, client=None, queryDone=None, timer=None):
+        """
+        Yield rows from a query, releasing the database session when done.
+
+        :param rows: an iterator of query rows.
+        :param sess: the session used for the query.
+        :param client: the client that owns the session.
+        :param queryDone: if not None, a function to call once the query is
+            finished.  See _startQuery.
+        :param timer: if not None, a QueryTimer that is paused while each row
+            is output, so that only fetching rows counts against the query's
+            time limit.
+        :returns: a generator of rows.
+        """
+        try:
+            if timer is None:
+                for row in rows:
+                    yield row
+            else:
+                for row in rows:
+                    timer.pause()
+                    yield row
+                    timer.resume()
+        finally:
+            if queryDone is not None:
+                queryDone()
+            self.disconnect(sess, client)
+
     @staticmethod
     def validate(table=None, **kwargs):
         """
@@ -147,6 +147,9 @@ class SqliteSAConnector(SQLAlchemyConnector):
             'database', base.databaseFromUri(kwargs.get('uri')))
         self.databaseOperators = SqliteOperators
         self._allowedFunctions = SqliteFunctions
+        # SQLite files don't use a pool with a fixed number of connections
+        self.engineParams.pop('pool_size', None)
+        self.engineParams.pop('max_overflow', None)
 
     @classmethod
     def adjustDBUri(cls, uri, *args, **kwargs):
@@ -1,13 +1,37 @@
+import base64
 import bson
+import bson.tz_util
+import codecs
 import collections
+import concurrent.futures
 import csv
 import datetime
 import decimal
+import functools
+import io
+import itertools
 import json
 import six
+import tempfile
+import threading
+import time
+import zlib
 
 from six.moves import range
 
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from girder import logger as log
 from girder.exceptions import GirderException
 
 from . import dbs
@@ -23,29 +47,712 @@ dbFormatList = collections.OrderedDict([
     ('geojson', 'application/vnd.geo+json'),
     ('rawdict', ''),
     ('rawlist', ''),
+    # https://www.iana.org/assignments/media-types/application/vnd.apache.arrow.stream
+    ('arrow', 'application/vnd.apache.arrow.stream'),
+    # https://www.iana.org/assignments/media-types/application/vnd.apache.parquet
+    ('parquet', 'application/vnd.apache.parquet'),
 ])
 
+# Placeholders used when incrementally encoding JSON results
+DATA_PLACEHOLDER = '\x00data\x00'
+DATACOUNT_PLACEHOLDER = '\x00datacount\x00'
+NEXT_PLACEHOLDER = '\x00next\x00'
+
+# The default maximum total size of cached select results, and the largest
+# fraction of that which one result may use.  Output is only collected for
+# caching until it exceeds the size of one result.
+DEFAULT_RESULT_CACHE_SIZE = 64 * 1024 * 1024
+RESULT_CACHE_ENTRY_SHARE = 1.0 / 16
+
+# The default maximum size of output that is buffered so that identical
+# concurrent selects can share it
+DEFAULT_COALESCE_SIZE = 4 * 1024 * 1024
+
+# Formats that yield Python objects rather than rendered output
+dbRawFormats = {'rawdict', 'rawlist'}
+
+# Formats that require pyarrow
+dbArrowFormats = {'arrow', 'parquet'}
+# Parquet compression codecs and the default number of rows in each row group
+parquetCompressions = ('snappy', 'zstd', 'gzip', 'brotli', 'lz4', 'none')
+DEFAULT_PARQUET_ROW_GROUP_SIZE = 65536
+# Parquet output is written to a temporary file before it is sent, since the
+# file's footer is only known after the last row group.  Output larger than
+# this is written to disk.
+PARQUET_SPOOL_SIZE = 16 * 1024 * 1024
+# Database types that are stored in integer and floating point Arrow columns
+arrowIntegerTypes = {
+    'int', 'integer', 'bigint', 'smallint', 'tinyint', 'mediumint', 'int2',
+    'int4', 'int8', 'serial', 'bigserial', 'smallserial', 'serial2',
+    'serial4', 'serial8'}
+arrowFloatTypes = {
+    'real', 'float', 'float4', 'float8', 'double', 'numeric', 'decimal'}
+
+# Content encodings that responses can be compressed with in order of
+# preference, the default compression level, and formats that are already
+# compressed.  The compression level is from the
+# database_assetstore.compression_level setting; 0 disables compression, so
+# responses are only compressed if the setting is changed.
+dbContentEncodings = ('zstd', 'gzip')
+DEFAULT_COMPRESSION_LEVEL = 0
+compressionLevel = DEFAULT_COMPRESSION_LEVEL
+dbCompressedFormats = {'parquet'}
+
+# The number of threads used to run batch queries, which is shared by all
+# batch requests, the maximum number of queries in a batch, and the maximum
+# size in bytes of the output of one query in a batch
+DEFAULT_BATCH_WORKERS = 8
+MAX_BATCH_QUERIES = 100
+MAX_BATCH_ENTRY_SIZE = 16 * 1024 * 1024
+# The maximum number of partitions of one query, the number of batches of
+# rows that each partition buffers before it waits for them to be output, and
+# the number of seconds a partition waits for its output to be read before it
+# stops.  Partitions are fetched on a shared pool of threads.  Since a
+# partition holds its thread while it waits for its output to be read, a
+# partitioned query only runs if there is a free thread for each partition;
+# otherwise it is run as a single query.  See reservePartitionWorkers.
+MAX_PARTITIONS = 8
+PARTITION_QUEUE_BATCHES = 4
+PARTITION_PUT_TIMEOUT = 300
+DEFAULT_PARTITION_WORKERS = 32
+_partitionWorkers = {'reserved': 0}
+_partitionWorkersLock = threading.Lock()
+# Selects that cost more than a connector's maxcost and that are queued run
+# one at a time per database.  A queued select is rejected if it waits longer
+# than this many seconds, and a select that has held the queue for longer than
+# this is no longer waited for.  The running selects are stored by database
+# with the time that they started.  See admitQuery.
+COST_QUEUE_TIMEOUT = 300
+_costQueueRunning = {}
+_costQueueCondition = threading.Condition()
+# Thread pools by name; see getExecutor
+_executors = {}
+_executorsLock = threading.Lock()
+# The types of the sort values that an after token can contain besides None;
+# see encodeAfterToken
+AfterTokenTypes = six.string_types + six.integer_types + (
+    float, datetime.datetime, datetime.date, datetime.time, decimal.Decimal,
+    bson.ObjectId)
+
+# Query parameters that are not filters
+dbReservedParameters = {
+    'limit', 'offset', 'sort', 'sortdir', 'fields', 'wait', 'poll',
+    'initwait', 'clientid', 'filters', 'format', 'pretty', 'after', 'count',
+    'countcap', 'compression', 'rowgroupsize', 'partitions', 'ordered',
+    'maxtime'}
+
 
 class DatabaseQueryException(GirderException):
     pass
 
 
+class ResultCache(object):
+    """
+    A least-recently-used cache of rendered select results.  Entries expire
+    after a time-to-live, and the least recently used entries are discarded
+    when the total size of the cached output exceeds maxSize.  Results larger
+    than a share of maxSize aren't cached.
+    """
+
+    def __init__(self, maxSize=DEFAULT_RESULT_CACHE_SIZE,
+                 entryShare=RESULT_CACHE_ENTRY_SHARE):
+        """
+        :param maxSize: the maximum total size of the cached output in
+            characters.  0 disables caching.
+        :param entryShare: the largest fraction of maxSize that one result
+            may use.
+        """
+        self.maxSize = maxSize
+        self.entryShare = entryShare
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """
+        Discard all cached results.
+        """
+        with self._lock:
+            for fileId, _ in self._entries:
+                self._generations[fileId] = self._generations.get(fileId, 0) + 1
+            self._entries.clear()
+            self.size = 0
+
+    def maxEntrySize(self):
+        """
+        Get the size of the largest result that can be cached.
+
+        :returns: the size in characters.
+        """
+        return int(self.maxSize * self.entryShare)
+
+    def generation(self, fileId):
+        """
+        Get the current generation of a file's entries.  This changes whenever
+        the file's entries are invalidated, so results of queries that started
+        before the invalidation are not stored.
+
+        :param fileId: the id of the file.
+        :returns: the generation number.
+        """
+        with self._lock:
+            return self._generations.get(str(fileId), 0)
+
+    def get(self, key):
+        """
+        Get a cached result.
+
+        :param key: the cache key.  See resultCacheKey.
+        :returns: the cache entry with chunks and mimeType, or None if there
+            is no current entry.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                if entry['expires'] > time.time():
+                    # Reinsert the entry to mark it as most recently used
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return entry
+                self.size -= entry['size']
+            self.misses += 1
+        return None
+
+    def invalidate(self, fileId):
+        """
+        Discard all cached results for a file.
+
+        :param fileId: the id of the file.
+        :returns: the number of entries discarded.
+        """
+        fileId = str(fileId)
+        with self._lock:
+            self._generations[fileId] = self._generations.get(fileId, 0) + 1
+            keys = [key for key in self._entries if key[0] == fileId]
+            for key in keys:
+                self.size -= self._entries.pop(key)['size']
+        return len(keys)
+
+    def set(self, key, chunks, mimeType, size, ttl, generation):
+        """
+        Store a result, evicting the least recently used results as needed.
+
+        :param key: the cache key.  See resultCacheKey.
+        :param chunks: a list of the rendered output chunks.
+        :param mimeType: the mime type of the output.
+        :param size: the total length of the chunks.
+        :param ttl: the number of seconds that the result is valid.
+        :param generation: the generation of the file when the query was
+            started.  If this is no longer current, the result isn't stored.
+        :returns: True if the result was stored.
+        """
+        with self._lock:
+            if (size > self.maxEntrySize() or
+                    self._generations.get(key[0], 0) != generation):
+                return False
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old['size']
+            self._entries[key] = {
+                'chunks': chunks,
+                'mimeType': mimeType,
+                'size': size,
+                'expires': time.time() + ttl,
+            }
+            self.size += size
+            while self.size > self.maxSize:
+                _, entry = self._entries.popitem(last=False)
+                self.size -= entry['size']
+                self.evictions += 1
+        return True
+
+    def stats(self):
+        """
+        Get statistics about the cache.
+
+        :returns: a dictionary of statistics.
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'size': self.size,
+                'maxSize': self.maxSize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+resultCache = ResultCache()
+
+
+class InFlightQueries(object):
+    """
+    Track the select queries that are being executed so that identical
+    concurrent queries can wait for one execution and share its output.
+    Output is only buffered once another request is waiting for it, so
+    requests can only join a query before it has produced any output.
+    """
+
+    def __init__(self, maxSize=DEFAULT_COALESCE_SIZE, timeout=60):
+        """
+        :param maxSize: the maximum size of output in characters that is
+            buffered for sharing.  Queries with more output are rerun by each
+            waiting request.  0 disables sharing.
+        :param timeout: if a shared query makes no progress for this many
+            seconds, waiting requests stop waiting and run the query
+            themselves.
+        """
+        self.maxSize = maxSize
+        self.timeout = timeout
+        self.shared = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def add(self, flight, chunk):
+        """
+        Add a chunk of output to an in-flight query.
+
+        :param flight: the in-flight query record.
+        :param chunk: the output chunk.
+        """
+        with flight['condition']:
+            flight['updated'] = time.time()
+            if flight['chunks'] is None:
+                return
+            if not flight['followers']:
+                # Nothing is waiting, so don't buffer the output
+                flight['chunks'] = None
+                return
+            flight['chunks'].append(chunk)
+            flight['size'] += len(chunk)
+            if flight['size'] > self.maxSize:
+                # Let waiting requests run the query themselves
+                flight['chunks'] = None
+                flight['condition'].notify_all()
+
+    def finish(self, key, flight, complete):
+        """
+        Mark an in-flight query as done and wake any requests waiting on it.
+
+        :param key: the query key.
+        :param flight: the in-flight query record.
+        :param complete: True if all of the output was generated.
+        """
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        with flight['condition']:
+            flight['done'] = True
+            flight['complete'] = complete and flight['chunks'] is not None
+            flight['condition'].notify_all()
+
+    def join(self, key):
+        """
+        Join an in-flight query or start a new one.
+
+        :param key: the query key.  See resultCacheKey.
+        :returns: the in-flight query record.
+        :returns: True if the caller must execute the query, False if it
+            should wait for the output.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                with flight['condition']:
+                    if (flight['chunks'] is not None and
+                            time.time() - flight['updated'] < self.timeout):
+                        flight['followers'] += 1
+                        self.shared += 1
+                        return flight, False
+            flight = {
+                'chunks': [],
+                'size': 0,
+                'followers': 0,
+                'updated': time.time(),
+                'done': False,
+                'complete': False,
+                'condition': threading.Condition(),
+            }
+            self._flights[key] = flight
+            return flight, True
+
+    def wait(self, flight):
+        """
+        Wait for an in-flight query to finish.
+
+        :param flight: the in-flight query record.
+        :returns: the list of output chunks, or None if the query did not
+            complete or its output was too large to share.
+        """
+        with flight['condition']:
+            while not flight['done'] and flight['chunks'] is not None:
+                updated = flight['updated']
+                flight['condition'].wait(self.timeout)
+                if not flight['done'] and flight['updated'] == updated:
+                    return None
+            return flight['chunks'] if flight['complete'] else None
+
+
+inFlightQueries = InFlightQueries()
+
+
+class OutputRelease(object):
+    """
+    A function that is called once when the output of a select is no longer
+    needed.  Result function wrappers call this when their generator finishes
+    or is closed.  A generator that is never started never runs its finally
+    clause, such as for a HEAD request, when a client disconnects before the
+    response body is sent, or when there is an error after the query is
+    performed, so this is also called when it is garbage collected.  That
+    happens once nothing refers to the result function or its generator.
+    """
+
+    def __init__(self, func):
+        """
+        :param func: a function that takes no parameters.
+        """
+        self._func = func
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            func, self._func = self._func, None
+        if func is not None:
+            func()
+
+    def __del__(self):
+        try:
+            self()
+        except Exception:
+            log.exception('Failed to release select output')
+
+
 # Functions related to querying databases
 
-def convertSelectDataToCsv(result, dumpFunc=json.dumps, *args, **kargs):
+def admitQuery(conn, fields, queryProps, filters):
+    """
+    If the connector has a maximum cost, estimate the cost of a select query.
+    If it is too expensive, either reject it or, if the connector's cost
+    action is queue, wait until no other expensive query is running on the
+    same database or until the running query has held the queue for longer
+    than COST_QUEUE_TIMEOUT.
+
+    :param conn: the database connector.
+    :param fields: the fields from the connector's getFieldInfo.
+    :param queryProps: the query properties.
+    :param filters: the query filters.
+    :returns: a function to call once an expensive query has finished, or None
+        if the query isn't expensive.
+    """
+    if not getattr(conn, 'maxCost', None):
+        return None
+    estimate = conn.estimateCost(fields, queryProps, filters)
+    if estimate is None or estimate['cost'] <= conn.maxCost:
+        return None
+    message = 'The estimated cost of the query is %g%s, which is more than ' \
+        'the limit of %g' % (
+            estimate['cost'], ' (about %d rows)' % estimate['rows']
+            if estimate.get('rows') is not None else '', conn.maxCost)
+    if conn.costAction != 'queue':
+        raise DatabaseQueryException(message + '.')
+    key = getattr(conn, 'databaseUri', None)
+    deadline = time.time() + COST_QUEUE_TIMEOUT
+    with _costQueueCondition:
+        while key in _costQueueRunning:
+            now = time.time()
+            expires = _costQueueRunning[key][0] + COST_QUEUE_TIMEOUT
+            if now >= expires:
+                log.warning('An expensive query has run for more than %d '
+                            'seconds; no longer waiting for it.',
+                            COST_QUEUE_TIMEOUT)
+                break
+            if now >= deadline:
+                raise DatabaseQueryException(
+                    message + ', and other expensive queries did not finish '
+                    'in time.')
+            _costQueueCondition.wait(min(deadline, expires) - now)
+        # The entry is unique to this query, so that releasing it doesn't
+        # release a query that took over the queue after it expired.
+        entry = (time.time(), object())
+        _costQueueRunning[key] = entry
+    log.info('Running an expensive query.  %s.', message)
+
+    def release():
+        with _costQueueCondition:
+            if _costQueueRunning.get(key) is entry:
+                del _costQueueRunning[key]
+                _costQueueCondition.notify_all()
+
+    return release
+
+
+def arrowColumnType(field):
+    """
+    Get the Arrow type for a field based on the database type reported by
+    getFieldInfo.
+
+    :param field: a field entry from getFieldInfo, or None for a column that
+        isn't a plain field.
+    :returns: an Arrow data type or None if the type should be inferred from
+        the data.
+    """
+    if not field:
+        return None
+    datatype = field.get('datatype')
+    sqltype = str(field.get('type') or '').lower().split('(')[0].strip()
+    basetype = sqltype.split(' ')[0]
+    if datatype == 'boolean' or basetype in ('bool', 'boolean'):
+        return pyarrow.bool_()
+    if basetype in arrowIntegerTypes:
+        return pyarrow.int64()
+    if datatype == 'number' or basetype in arrowFloatTypes:
+        return pyarrow.float64()
+    if datatype == 'string' or 'char' in sqltype or 'text' in sqltype:
+        return pyarrow.string()
+    if sqltype.startswith('timestamp') or sqltype.startswith('datetime'):
+        return pyarrow.timestamp(
+            'us', tz='UTC' if 'with time zone' in sqltype or
+            sqltype == 'timestamptz' else None)
+    if sqltype == 'date':
+        return pyarrow.date32()
+    if sqltype.startswith('time'):
+        return pyarrow.time64('us')
+    return None
+
+
+def batchQueryDatabase(queries):
+    """
+    Query multiple databases concurrently.  All of the queries are validated
+    before any are run, then they are run on a bounded thread pool.  The
+    output is a JSON list with one entry per query in the same order as the
+    queries.  Each entry has an id, and either the mimeType and data of the
+    query's output or an error.  JSON output is included as is; other output
+    is included as a string.  Each query must have a limit and can't wait for
+    data, and its output can be at most MAX_BATCH_ENTRY_SIZE bytes.  If the
+    output is abandoned, queries that haven't started are not run.
+
+    :param queries: a list of (file id, dbinfo, params) tuples.  See
+        queryDatabase.
+    :returns: a function that returns a generator that yields the output.
+    """
+    if len(queries) > MAX_BATCH_QUERIES:
+        raise DatabaseQueryException(
+            'A batch can have at most %d queries.' % MAX_BATCH_QUERIES)
+    preparedList = []
+    for idx, (fileId, dbinfo, params) in enumerate(queries):
+        # Preparing a query connects to the database and gets the field
+        # information, so this is done serially.
+        try:
+            prepared = prepareQuery(fileId, dbinfo, params)
+        except (DatabaseQueryException, dbs.DatabaseConnectorException) as exc:
+            raise DatabaseQueryException('Query %d: %s' % (idx, exc.message))
+        if prepared['format'] in dbArrowFormats or prepared['format'] in dbRawFormats:
+            raise DatabaseQueryException(
+                'Query %d: the %s format can\'t be used in a batch.' % (
+                    idx, prepared['format']))
+        # Queries share a small pool of threads, so they can't wait for data.
+        # Their output is held until it is written, so it must be bounded.
+        if prepared['queryProps']['limit'] < 0 or prepared['queryProps']['wait']:
+            raise DatabaseQueryException(
+                'Query %d: queries in a batch must have a limit and can\'t '
+                'wait.' % idx)
+        preparedList.append(prepared)
+    cancelled = threading.Event()
+
+    def runQuery(fileId, dbinfo, params, prepared):
+        # Queries that have already started are bounded by their limit and
+        # the size cap, so they are allowed to finish.
+        if cancelled.is_set():
+            return None, None
+        resultFunc, mimeType = queryDatabase(
+            fileId, dbinfo, params, prepared=prepared)
+        if resultFunc is None:
+            raise DatabaseQueryException('Failed to query database.')
+        chunks = []
+        size = 0
+        output = resultFunc()
+        try:
+            for chunk in output:
+                if not isinstance(chunk, six.binary_type):
+                    chunk = chunk.encode('utf8')
+                size += len(chunk)
+                if size > MAX_BATCH_ENTRY_SIZE:
+                    raise DatabaseQueryException(
+                        'The output is larger than %d bytes.' % MAX_BATCH_ENTRY_SIZE)
+                chunks.append(chunk)
+        finally:
+            # If the output is too large, release the query on this thread
+            output.close()
+        return chunks, mimeType
+
+    def dataChunks(chunks, mimeType):
+        """
+        Yield the output of a query as a JSON value.  Output that isn't JSON
+        is encoded as a JSON string one chunk at a time.
+        """
+        isJson = mimeType in ('application/json', 'application/vnd.geo+json')
+        decoder = codecs.getincrementaldecoder('utf8')()
+        if not isJson:
+            yield '"'
+        for idx, chunk in enumerate(chunks):
+            text = decoder.decode(chunk, final=idx == len(chunks) - 1)
+            yield text if isJson else json.dumps(text)[1:-1]
+        if not isJson:
+            yield '"'
+
+    executor = getExecutor('batch', DEFAULT_BATCH_WORKERS)
+    futures = [executor.submit(runQuery, fileId, dbinfo, params, prepared)
+               for (fileId, dbinfo, params), prepared in zip(queries, preparedList)]
+
+    def resultFunc():
+        try:
+            for idx, future in enumerate(futures):
+                entry = '%s{"id":%s,' % ('[' if not idx else ',', json.dumps(
+                    str(queries[idx][0])))
+                try:
+                    chunks, mimeType = future.result()
+                except Exception as exc:
+                    if not isinstance(exc, (DatabaseQueryException,
+                                            dbs.DatabaseConnectorException)):
+                        log.exception('Batch query failed')
+                    yield entry + '"error":%s}' % json.dumps(
+                        getattr(exc, 'message', str(exc)))
+                    continue
+                # Release each query's output as soon as it is written
+                futures[idx] = None
+                yield entry + '"mimeType":%s,"data":' % json.dumps(mimeType)
+                for chunk in dataChunks(chunks, mimeType):
+                    yield chunk
+                yield '}'
+            yield ']'
+        finally:
+            # If the response is abandoned, don't run the remaining queries
+            cancelled.set()
+            for future in futures:
+                if future is not None:
+                    future.cancel()
+
+    return resultFunc
+
+
+def cachingResultFunc(resultFunc, key, mimeType, ttl, generation):
+    """
+    Wrap a result function so that its output is added to the result cache
+    once it has been completely generated.  Output is only collected until it
+    is larger than the cache's maximum entry size.
+
+    :param resultFunc: a function that returns a generator of output chunks.
+    :param key: the cache key.  See resultCacheKey.
+    :param mimeType: the mime type of the output.
+    :param ttl: the number of seconds that the result is valid.
+    :param generation: the generation of the file when the query was started.
+    :returns: a function that returns a generator of output chunks.
+    """
+    def wrappedResultFunc():
+        chunks = []
+        size = 0
+        maxSize = resultCache.maxEntrySize()
+        for chunk in resultFunc():
+            if chunks is not None:
+                size += len(chunk)
+                # Stop collecting output that is too large to cache
+                if size > maxSize:
+                    chunks = None
+                else:
+                    chunks.append(chunk)
+            yield chunk
+        if chunks is not None:
+            resultCache.set(key, chunks, mimeType, size, ttl, generation)
+
+    return wrappedResultFunc
+
+
+def compressResultFunc(resultFunc, encoding, level=None):
+    """
+    Wrap a result function so that its output is incrementally compressed.
+
+    :param resultFunc: a function that returns a generator of output chunks.
+    :param encoding: the content encoding.  One of dbContentEncodings.
+    :param level: the compression level.  None uses the compressionLevel
+        setting.
+    :returns: a function that returns a generator of compressed bytes.
+    """
+    level = compressionLevel if level is None else level
+
+    def resultFuncCompressed():
+        if encoding == 'zstd':
+            compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            # A window size of 16 + MAX_WBITS writes a gzip header and trailer
+            compressor = zlib.compressobj(
+                level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in resultFunc():
+            if not isinstance(chunk, six.binary_type):
+                chunk = chunk.encode('utf8')
+            chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+        yield compressor.flush()
+
+    return resultFuncCompressed
+
+
+def convertSelectDataToArrow(result, dumpFunc=json.dumps,
+                             batchSize=dbs.base.DEFAULT_BATCH_SIZE,
+                             fields=None, *args, **kargs):
+    """
+    Return a function that produces a generator for outputting an Apache
+    Arrow IPC stream.  Each batch of fetched rows is written as one record
+    batch.
+
+    :param result: the initial select results.
+    :param dumpFunc: function for dumping values that aren't Arrow types to
+        JSON.
+    :param batchSize: the number of rows in each record batch.
+    :param fields: the fields from the connector's getFieldInfo.  These are
+        used to determine the column types.
+    :returns: a function that outputs a generator.
+    """
+    batches = iterArrowBatches(result, fields, dumpFunc, batchSize)
+
+    def resultFunc():
+        sink = io.BytesIO()
+        writer = None
+        for batch in batches:
+            if writer is None:
+                writer = pyarrow.ipc.new_stream(sink, batch.schema)
+            writer.write_batch(batch)
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+        writer.close()
+        yield sink.getvalue()
+
+    return resultFunc
+
+
+def convertSelectDataToCsv(result, dumpFunc=json.dumps,
+                           batchSize=dbs.base.DEFAULT_BATCH_SIZE, *args,
+                           **kargs):
     """
     Return a function that produces a generator for outputting a CSV file.
 
     :param result: the initial select results.
     :param dumpFunc: fallback function for dumping objects and unknown data
                      types to JSON.
+    :param batchSize: the number of rows to output in each chunk.
     :returns: a function that outputs a generator.
     """
-    class Echo(object):
-        def write(self, value):
-            return value
+    class Buffer(list):
+        write = list.append
 
-    writer = csv.writer(Echo())
+    buffer = Buffer()
+    writer = csv.writer(buffer)
     # values that are of a type in allowedTypes and not in disallowedTypes
     # should be converted by the CSV writer.  All others are converted to JSON
     # first.  The integer_types include True and False.  We may need to add
@@ -53,19 +760,49 @@ def convertSelectDataToCsv(result, dumpFunc=json.dumps, *args, **kargs):
     allowedTypes = six.string_types + six.integer_types + (
         float, type(None), datetime.datetime, decimal.Decimal)
     disallowedTypes = (bson.binary.Binary, )
-    data = convertSelectDataToList(result)['data']
+    # This is unicode in Python 2 and bytes in Python 3
+    wrongType = six.text_type if str == six.binary_type else six.binary_type
+    # The conversion for each type of value is determined the first time that
+    # type is seen.  Types that need no conversion are added to passTypes, so
+    # rows that only contain those types are written without examining each
+    # value.
+    converters = {}
+    passTypes = set()
+
+    def dumpValue(value):
+        return csv_safe_unicode([dumpFunc(
+            value, check_circular=False, separators=(',', ':'),
+            sort_keys=False, default=str)])[0]
+
+    def convertValue(value):
+        valueType = type(value)
+        if valueType not in converters:
+            if (not issubclass(valueType, allowedTypes) or
+                    issubclass(valueType, disallowedTypes)):
+                converters[valueType] = dumpValue
+            elif issubclass(valueType, wrongType):
+                converters[valueType] = lambda value: csv_safe_unicode([value])[0]
+            else:
+                converters[valueType] = None
+                passTypes.add(valueType)
+        func = converters[valueType]
+        return value if func is None else func(value)
 
-    def resultFunc():
-        columns = {result['columns'][col]: col for col in result['columns']}
-        columnNames = [columns[i] for i in range(len(result['fields']))]
-        yield writer.writerow(csv_safe_unicode(columnNames))
-        for row in data:
-            row = [value if isinstance(value, allowedTypes) and
-                   not isinstance(value, disallowedTypes) else
-                   dumpFunc(value, check_circular=False, separators=(',', ':'),
-                            sort_keys=False, default=str) for value in row]
+    data = iterSelectDataAsLists(result)
 
-            yield writer.writerow(csv_safe_unicode(row))
+    def resultFunc():
+        writer.writerow(csv_safe_unicode(selectColumnNames(result)))
+        yield buffer.pop()
+        while True:
+            batch = [
+                row if passTypes.issuperset(map(type, row)) else
+                [convertValue(value) for value in row]
+                for row in itertools.islice(data, batchSize)]
+            if not batch:
+                break
+            writer.writerows(batch)
+            yield ''.join(buffer)
+            del buffer[:]
 
     return resultFunc
 
@@ -76,8 +813,8 @@ def convertSelectDataToDict(result, *args, **kargs):
     used as the keys for each row.
 
     :param result: the initial select results.  This can be altered.
-    :returns: the results with data converted from a list of lists to a list of
-              dictionaries.
+    :returns: the results with data converted from a list of lists to an
+              iterator of dictionaries.
     """
     if result['format'] != 'dict':
         result['data'] = convertSelectDataToJson(result)
@@ -95,7 +832,7 @@ def convertSelectDataToGeojson(result, dumpFunc=json.dumps, *args, **kargs):
     :param dumpFunc: function for dumping objects to JSON.
     :returns: a function that outputs a generator.
     """
-    data = convertSelectDataToList(result)['data']
+    data = iterSelectDataAsLists(result)
 
     def resultFunc():
         geometryHeader = '{"type":"GeometryCollection","geometries":[\n'
@@ -144,13 +881,11 @@ def convertSelectDataToJson(result, *args, **kargs):
 
     :param result: the initial select results.
     :returns: the results with only the data.  The data is converted from a
-              list of lists to a list of dictionaries.
+              list of lists to an iterator of dictionaries.
     """
     data = result['data']
     if result['format'] == 'list':
-        columns = {result['columns'][col]: col for col in result['columns']}
-        data = [{columns[i]: row[i] for i in range(len(row))}
-                for row in data]
+        data = iterSelectDataAsDicts(result)
     return data
 
 
@@ -164,7 +899,7 @@ def convertSelectDataToJsonlines(result, dumpFunc=json.dumps, *args, **kargs):
     :param dumpFunc: function for dumping objects to JSON.
     :returns: a function that outputs a generator.
     """
-    data = convertSelectDataToJson(result)
+    data = iterSelectDataAsDicts(result)
 
     def resultFunc():
         for row in data:
@@ -181,18 +916,80 @@ def convertSelectDataToList(result, *args, **kargs):
     used as the keys for each row.
 
     :param result: the initial select results.  This can be altered.
-    :returns: the results with data converted from a list of lists to a list of
-              dictionaries.
+    :returns: the results with data converted from dictionaries to an
+              iterator of lists.
     """
     if result['format'] == 'dict':
-        columns = [col[-1] for col in sorted(
-            [(result['columns'][col], col) for col in result['columns']])]
-        result['data'] = [[row.get(col) for col in columns]
-                          for row in result['data']]
+        result['data'] = iterSelectDataAsLists(result)
         result['format'] = 'list'
     return result
 
 
+def convertSelectDataToParquet(result, dumpFunc=json.dumps,
+                               batchSize=dbs.base.DEFAULT_BATCH_SIZE,
+                               fields=None, compression=None,
+                               rowGroupSize=None, *args, **kargs):
+    """
+    Return a function that produces a generator for outputting an Apache
+    Parquet file.  Fetched batches are collected into row groups, which are
+    written incrementally to a spooled temporary file.  Since a Parquet file
+    ends with a footer describing all of the row groups, the file is only
+    output once all of the data has been written.
+
+    :param result: the initial select results.
+    :param dumpFunc: function for dumping values that aren't Arrow types to
+        JSON.
+    :param batchSize: the number of rows fetched at a time.
+    :param fields: the fields from the connector's getFieldInfo.  These are
+        used to determine the column types.
+    :param compression: the compression codec.  One of parquetCompressions.
+        None uses snappy.
+    :param rowGroupSize: the maximum number of rows in each row group.  None
+        uses DEFAULT_PARQUET_ROW_GROUP_SIZE.
+    :returns: a function that outputs a generator.
+    """
+    compression = compression or 'snappy'
+    rowGroupSize = rowGroupSize or DEFAULT_PARQUET_ROW_GROUP_SIZE
+    batches = iterArrowBatches(result, fields, dumpFunc, batchSize)
+
+    def resultFunc():
+        spool = tempfile.SpooledTemporaryFile(max_size=PARQUET_SPOOL_SIZE)
+        try:
+            writer = None
+            pending = []
+            pendingRows = 0
+            for batch in batches:
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(
+                        spool, batch.schema, compression=compression)
+                pending.append(batch)
+                pendingRows += batch.num_rows
+                if pendingRows >= rowGroupSize:
+                    # Write complete row groups and keep any remaining rows
+                    # for the next row group.
+                    table = pyarrow.Table.from_batches(pending)
+                    fullRows = pendingRows - pendingRows % rowGroupSize
+                    writer.write_table(
+                        table.slice(0, fullRows), row_group_size=rowGroupSize)
+                    pending = table.slice(fullRows).to_batches()
+                    pendingRows -= fullRows
+            if pendingRows:
+                writer.write_table(
+                    pyarrow.Table.from_batches(pending),
+                    row_group_size=rowGroupSize)
+            writer.close()
+            spool.seek(0)
+            while True:
+                chunk = spool.read(io.DEFAULT_BUFFER_SIZE * 16)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            spool.close()
+
+    return resultFunc
+
+
 def convertSelectDataToRawdict(result, *args, **kargs):
     """
     Convert data in list format to dictionary format.  The column names are
@@ -201,12 +998,10 @@ def convertSelectDataToRawdict(result, *args, **kargs):
     :param result: the initial select results.  This can be altered.
     :returns: a function that outputs aa generator.
     """
-    if result['format'] != 'dict':
-        result['data'] = convertSelectDataToJson(result)
-        result['format'] = 'dict'
+    data = iterSelectDataAsDicts(result)
 
     def resultFunc():
-        for row in result['data']:
+        for row in data:
             yield row
 
     return resultFunc
@@ -220,15 +1015,60 @@ def convertSelectDataToRawlist(result, *args, **kargs):
     :param result: the initial select results.  This can be altered.
     :returns: a function that outputs aa generator.
     """
-    result = convertSelectDataToList(result)
+    data = iterSelectDataAsLists(result)
 
     def resultFunc():
-        for row in result['data']:
+        for row in data:
             yield row
 
     return resultFunc
 
 
+def countDatabase(idOrConnector, dbinfo, params):
+    """
+    Count the rows that a query of a database would return without a limit
+    or offset.
+
+    :param idOrConnector: either an id used to cache the DB connector, or a
+        connector that is derived from the DatabaseConnector class.
+    :param dbinfo: a dictionary of connection information for the db.  Needs
+        type, uri, and either table or connection.  Ignored if a connector is
+        provided.
+    :param params: query parameters.  See the count endpoint for
+        documentation.  count is the mode and countcap the cap of the capped
+        mode.
+    :returns: a dictionary with the count and the mode of the count.  See
+        DatabaseConnector.performCount.
+    """
+    if isinstance(idOrConnector, dbs.DatabaseConnector):
+        conn = idOrConnector
+    else:
+        conn = dbs.getDBConnector(idOrConnector, dbinfo)
+    if not conn:
+        raise dbs.DatabaseConnectorException('Failed to connect to database.')
+    fields = conn.getFieldInfo()
+    queryProps = {'count': params.get('count') or 'exact'}
+    if queryProps['count'] not in dbs.base.CountModes:
+        raise DatabaseQueryException(
+            'The count parameter must be one of %s.' % ', '.join(
+                dbs.base.CountModes))
+    if queryProps['count'] == 'capped':
+        try:
+            queryProps['countcap'] = int(
+                params.get('countcap') or dbs.base.DEFAULT_COUNT_CAP)
+        except ValueError:
+            queryProps['countcap'] = 0
+        if queryProps['countcap'] <= 0:
+            raise DatabaseQueryException(
+                'The countcap parameter must be a positive integer.')
+    if 'group' in params:
+        queryProps['group'] = getFieldsList(conn, fields, params['group'], 'group')
+    queryProps['maxtime'] = getMaxTime(conn, params)
+    filters = getFilters(conn, fields, params.get('filters'), params,
+                         dbReservedParameters)
+    return conn.performCount(fields, queryProps, filters, params.get('clientid'))
+
+
 def csv_safe_unicode(row, ignoreErrors=True):
     """
     Given an array of values, make sure all strings are unicode in Python 3 and
@@ -256,6 +1096,105 @@ def csv_safe_unicode(row, ignoreErrors=True):
     return row
 
 
+def decodeAfterToken(token, sort):
+    """
+    Decode a continuation token from a previous select query into the values
+    of the sort fields of the last row of that query.
+
+    :param token: the token.  See encodeAfterToken.
+    :param sort: the sort list of the current query.  This must match the
+        sort list used to create the token.
+    :returns: a list of sort field values.
+    """
+    def objectHook(obj):
+        if len(obj) == 1:
+            key, value = next(iter(obj.items()))
+            if key == '$datetime':
+                tzinfo = None
+                if value[-1] is not None:
+                    tzinfo = bson.tz_util.FixedOffset(value[-1], '')
+                return datetime.datetime(*value[:-1], tzinfo=tzinfo)
+            if key == '$date':
+                return datetime.date(*value)
+            if key == '$time':
+                return datetime.time(*value)
+            if key == '$decimal':
+                return decimal.Decimal(value)
+            if key == '$oid':
+                return bson.ObjectId(value)
+        return obj
+
+    try:
+        token = base64.urlsafe_b64decode(str(token) + '=' * (-len(token) % 4))
+        after = json.loads(token.decode('utf8'), object_hook=objectHook)
+        values = after['values']
+        tokenSort = after['sort']
+    except Exception:
+        raise DatabaseQueryException('Invalid after parameter.')
+    if (tokenSort != [[field, dir] for field, dir in sort] or
+            not isinstance(values, list) or len(values) != len(sort)):
+        raise DatabaseQueryException(
+            'The after parameter does not match the sort parameter.')
+    # The token comes from the client, so only allow values that
+    # encodeAfterToken can produce.  Anything else, such as a dictionary,
+    # could be interpreted as a field reference or function by a connector.
+    for value in values:
+        if value is not None and not isinstance(value, AfterTokenTypes):
+            raise DatabaseQueryException('Invalid after parameter.')
+    return values
+
+
+def encodeAfterToken(sort, values):
+    """
+    Encode the values of the sort fields of the last row of a select query
+    into an opaque continuation token.  The token is used as the after
+    parameter of another query to get the rows that follow.
+
+    :param sort: the sort list of the query.
+    :param values: a list with the values of the sort fields.
+    :returns: the token as a string.
+    """
+    def default(value):
+        if isinstance(value, datetime.datetime):
+            offset = value.utcoffset()
+            return {'$datetime': [
+                value.year, value.month, value.day, value.hour, value.minute,
+                value.second, value.microsecond,
+                None if offset is None else
+                offset.days * 1440 + offset.seconds // 60]}
+        if isinstance(value, datetime.date):
+            return {'$date': [value.year, value.month, value.day]}
+        if isinstance(value, datetime.time):
+            return {'$time': [
+                value.hour, value.minute, value.second, value.microsecond]}
+        if isinstance(value, decimal.Decimal):
+            return {'$decimal': str(value)}
+        if isinstance(value, bson.ObjectId):
+            return {'$oid': str(value)}
+        return str(value)
+
+    token = json.dumps(
+        {'sort': [[field, dir] for field, dir in sort], 'values': values},
+        separators=(',', ':'), sort_keys=True, default=default)
+    return base64.urlsafe_b64encode(token.encode('utf8')).decode(
+        'ascii').rstrip('=')
+
+
+def getExecutor(name, maxWorkers):
+    """
+    Get a shared thread pool, creating it if needed.
+
+    :param name: the name of the pool.
+    :param maxWorkers: the number of threads in the pool if it is created.
+    :returns: a concurrent.futures executor.
+    """
+    with _executorsLock:
+        if name not in _executors:
+            _executors[name] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=maxWorkers)
+        return _executors[name]
+
+
 def getFilters(conn, fields, filtersValue=None, queryParams={},
                reservedParameters=[]):
     """
@@ -339,6 +1278,27 @@ def getFieldsList(conn, fields=None, fieldsValue=None, paramName='fields'):
     return fieldsList
 
 
+def getMaxTime(conn, params):
+    """
+    Get the longest time that a query may run.  The connector's maximum time
+    is both the default and the limit of the maxtime parameter.
+
+    :param conn: the database connector.
+    :param params: query parameters, which may include maxtime in seconds.
+    :returns: the maximum time in seconds or None for no limit.
+    """
+    maxTime = getattr(conn, 'maxTime', None)
+    if params.get('maxtime') not in (None, ''):
+        try:
+            value = float(params['maxtime'])
+        except ValueError:
+            value = 0
+        if not value > 0:
+            raise DatabaseQueryException('maxtime must be a positive number.')
+        maxTime = min(value, maxTime) if maxTime else value
+    return maxTime
+
+
 def getSortList(conn, fields=None, sortValue=None, sortDir=None):
     """
     Get a list of sort fields and directions from the query parameters.
@@ -396,6 +1356,483 @@ def getSortList(conn, fields=None, sortValue=None, sortDir=None):
     return sort
 
 
+def iterArrowBatches(result, fields, dumpFunc=json.dumps,
+                     batchSize=dbs.base.DEFAULT_BATCH_SIZE):
+    """
+    Iterate through the data of select results, yielding Arrow record
+    batches.  Column types are determined from the field information where
+    possible and otherwise inferred from the first batch of data.  Values
+    that can't be stored in a column's type are converted if possible (for
+    instance, to JSON for string columns) or stored as nulls.  At least one
+    record batch is always yielded.
+
+    :param result: the initial select results.
+    :param fields: the fields from the connector's getFieldInfo or None.
+    :param dumpFunc: function for dumping values to JSON.
+    :param batchSize: the number of rows in each record batch.
+    :returns: a generator of Arrow record batches.
+    """
+    columnNames = [str(name) for name in selectColumnNames(result)]
+    fieldInfo = {field['name']: field for field in fields or []}
+    types = [arrowColumnType(fieldInfo.get(name)) for name in columnNames]
+    data = iterSelectDataAsLists(result)
+    errors = (pyarrow.ArrowException, TypeError, ValueError, OverflowError)
+
+    def stringValue(value):
+        if value is None or isinstance(value, six.text_type):
+            return value
+        if isinstance(value, six.binary_type):
+            return value.decode('utf8', 'ignore')
+        return dumpFunc(value, check_circular=False, separators=(',', ':'),
+                        sort_keys=False, default=str)
+
+    def toArray(values, arrowType):
+        if pyarrow.types.is_string(arrowType):
+            return pyarrow.array([stringValue(value) for value in values],
+                                 type=arrowType)
+        try:
+            return pyarrow.array(values, type=arrowType)
+        except errors:
+            pass
+        if pyarrow.types.is_floating(arrowType):
+            convert = float
+        elif pyarrow.types.is_integer(arrowType):
+            convert = int
+        elif pyarrow.types.is_boolean(arrowType):
+            convert = bool
+        else:
+            convert = None
+        converted = []
+        for value in values:
+            try:
+                if convert is not None and value is not None:
+                    value = convert(value)
+                pyarrow.array([value], type=arrowType)
+            except errors:
+                value = None
+            converted.append(value)
+        return pyarrow.array(converted, type=arrowType)
+
+    def inferType(values):
+        try:
+            arrowType = pyarrow.array(values).type
+        except errors:
+            return pyarrow.string()
+        if not (pyarrow.types.is_integer(arrowType) or
+                pyarrow.types.is_floating(arrowType) or
+                pyarrow.types.is_boolean(arrowType) or
+                pyarrow.types.is_string(arrowType) or
+                pyarrow.types.is_temporal(arrowType)):
+            return pyarrow.string()
+        return arrowType
+
+    schema = None
+    while True:
+        rows = list(itertools.islice(data, batchSize))
+        if not rows and schema is not None:
+            break
+        columns = list(zip(*rows)) if rows else [[] for name in columnNames]
+        if schema is None:
+            types = [arrowType or inferType(columns[idx])
+                     for idx, arrowType in enumerate(types)]
+            schema = pyarrow.schema(list(zip(columnNames, types)))
+        yield pyarrow.RecordBatch.from_arrays(
+            [toArray(columns[idx], arrowType)
+             for idx, arrowType in enumerate(types)], schema=schema)
+        if len(rows) < batchSize:
+            break
+
+
+def iterPartitionData(partitions, ordered, batchSize, executor, cancel=None,
+                      release=None):
+    """
+    Fetch the data of several partitions concurrently and yield their rows.
+    Each partition is read on a thread of the executor in batches, and a
+    limited number of batches are buffered.  The partitions start being
+    fetched when the first row is requested.  When the generator is closed,
+    or a partition's output isn't read for PARTITION_PUT_TIMEOUT seconds, the
+    partitions stop fetching data.
+
+    :param partitions: a list of functions, one per partition, each of which
+        is called on a thread of the executor and returns an iterator of
+        rows.
+    :param ordered: if True, yield the rows of each partition in order.
+        Otherwise, yield batches of rows from any partition as soon as they
+        are fetched.
+    :param batchSize: the number of rows in each batch.
+    :param executor: the executor used to fetch the partitions.  This needs
+        a free thread for each partition, since a partition's thread waits
+        while its buffered batches are full.
+    :param cancel: a threading.Event that stops fetching when set.  This is
+        also set when the generator is closed.
+    :param release: if not None, a function that is called once every
+        partition has stopped fetching, or when the generator is discarded
+        without being started.
+    :returns: a generator of rows.
+    """
+    cancel = cancel or threading.Event()
+    release = OutputRelease(release or (lambda: None))
+    running = {'count': len(partitions)}
+    runningLock = threading.Lock()
+    if ordered:
+        queues = [six.moves.queue.Queue(PARTITION_QUEUE_BATCHES)
+                  for _ in partitions]
+    else:
+        queues = [six.moves.queue.Queue(PARTITION_QUEUE_BATCHES * len(partitions))]
+
+    def put(queue, item):
+        deadline = time.time() + PARTITION_PUT_TIMEOUT
+        while not cancel.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return
+            except six.moves.queue.Full:
+                if time.time() > deadline:
+                    # Nothing is reading the output
+                    cancel.set()
+
+    def fetch(func, queue):
+        try:
+            data = None
+            # None marks the end of a partition
+            item = None
+            try:
+                data = func()
+                rows = iter(data)
+                while not cancel.is_set():
+                    batch = list(itertools.islice(rows, batchSize))
+                    if not batch:
+                        break
+                    put(queue, batch)
+            except Exception as exc:
+                item = exc
+            finally:
+                if hasattr(data, 'close'):
+                    data.close()
+            put(queue, item)
+        finally:
+            with runningLock:
+                running['count'] -= 1
+                finished = not running['count']
+            if finished:
+                release()
+
+    def iterRows():
+        try:
+            for idx, func in enumerate(partitions):
+                executor.submit(fetch, func, queues[idx if ordered else 0])
+            remaining = len(partitions)
+            idx = 0
+            while remaining:
+                try:
+                    batch = queues[idx].get(timeout=1)
+                except six.moves.queue.Empty:
+                    if cancel.is_set():
+                        raise DatabaseQueryException(
+                            'The partitions stopped fetching data because '
+                            'their output was not read.')
+                    continue
+                if batch is None:
+                    remaining -= 1
+                    if ordered:
+                        idx += 1
+                    continue
+                if isinstance(batch, Exception):
+                    raise batch
+                for row in batch:
+                    yield row
+        finally:
+            cancel.set()
+
+    return iterRows()
+
+
+def iterSelectDataAsDicts(result):
+    """
+    Iterate through the data of select results, yielding each row as a
+    dictionary.  The column names are used as the keys for each row.  The data
+    is only walked once, so this can be used with streamed results.
+
+    :param result: the initial select results.
+    :returns: an iterator of dictionaries.
+    """
+    data = result['data']
+    if result['format'] == 'dict':
+        # Rows are already dictionaries (such as Mongo documents)
+        return iter(data)
+    columnNames = selectColumnNames(result)
+    return (dict(zip(columnNames, row)) for row in data)
+
+
+def iterSelectDataAsLists(result):
+    """
+    Iterate through the data of select results, yielding each row as a list
+    or tuple with one entry per column.  The data is only walked once, so
+    this can be used with streamed results.
+
+    :param result: the initial select results.
+    :returns: an iterator of lists or tuples.
+    """
+    data = result['data']
+    if result['format'] != 'dict':
+        # Rows are already sequences (such as SQL rows)
+        return iter(data)
+    columnNames = selectColumnNames(result)
+    return ([row.get(col) for col in columnNames] for row in data)
+
+
+def jsonResultFunc(result, dumpFunc=json.dumps, pretty=False,
+                   batchSize=dbs.base.DEFAULT_BATCH_SIZE, deferred=None):
+    """
+    Return a function that produces a generator for outputting select results
+    as JSON.  Unless pretty output is requested, the data is encoded a batch
+    of rows at a time, so the whole response is never held in memory.  The
+    output is the same as dumping the entire result at once.
+
+    :param result: either the select results dictionary or an iterator or list
+        of rows.  If a dictionary and the datacount is the
+        DATACOUNT_PLACEHOLDER, the datacount is computed as the data is
+        output.
+    :param dumpFunc: function for dumping objects to JSON.
+    :param pretty: if True, indent the output.
+    :param batchSize: the number of rows to encode at a time.
+    :param deferred: if not None, a dictionary of placeholders and functions.
+        Values in a results dictionary that are one of these placeholders are
+        replaced with the value returned by the function after the data has
+        been output.
+    :returns: a function that outputs a generator.
+    """
+    dumpKwargs = {
+        'check_circular': False, 'separators': (',', ':'),
+        'sort_keys': False, 'default': str, 'indent': None}
+    isDict = isinstance(result, dict)
+    data = result['data'] if isDict else result
+    deferred = deferred or {}
+
+    if pretty:
+        # Indentation depends on nesting, so render pretty output all at once.
+        def resultFunc():
+            output = list(data)
+            if isDict:
+                output = dict(result, data=output)
+                if output.get('datacount') == DATACOUNT_PLACEHOLDER:
+                    output['datacount'] = len(output['data'])
+                for key, value in list(output.items()):
+                    if isinstance(value, six.string_types) and value in deferred:
+                        output[key] = deferred[value]()
+            yield dumpFunc(output, **dict(dumpKwargs, indent=2))
+
+        return resultFunc
+
+    def resultFunc():
+        if isDict:
+            # Deferred values must follow the data, since they aren't known
+            # until it has been output.
+            header = collections.OrderedDict()
+            held = []
+            for key, value in six.iteritems(result):
+                if key == 'data':
+                    header[key] = DATA_PLACEHOLDER
+                    header.update(held)
+                elif ('data' not in header and
+                        isinstance(value, six.string_types) and
+                        (value == DATACOUNT_PLACEHOLDER or value in deferred)):
+                    held.append((key, value))
+                else:
+                    header[key] = value
+            prefix, suffix = dumpFunc(header, **dumpKwargs).split(
+                dumpFunc(DATA_PLACEHOLDER, **dumpKwargs), 1)
+        else:
+            prefix, suffix = '', ''
+        rows = iter(data)
+        count = 0
+        yield prefix + '['
+        while True:
+            batch = [dumpFunc(row, **dumpKwargs)
+                     for row in itertools.islice(rows, batchSize)]
+            if not batch:
+                break
+            yield (',' if count else '') + ','.join(batch)
+            count += len(batch)
+        suffix = suffix.replace(
+            dumpFunc(DATACOUNT_PLACEHOLDER, **dumpKwargs), str(count), 1)
+        for placeholder, func in deferred.items():
+            suffix = suffix.replace(
+                dumpFunc(placeholder, **dumpKwargs),
+                dumpFunc(func(), **dumpKwargs), 1)
+        yield ']' + suffix
+
+    return resultFunc
+
+
+def nextAfterTokenFunc(result, sort, limit):
+    """
+    Track the last row of select results so that a continuation token for
+    the rows that follow can be produced after the data has been output.
+
+    :param result: the initial select results.  The data is replaced with an
+        iterator that tracks the rows.
+    :param sort: the sort list of the query.  The sort fields must be
+        returned columns.
+    :param limit: the limit of the query.  If fewer rows than this are
+        output, there are no more rows.
+    :returns: a function that returns the continuation token or None.
+    """
+    columns = result.get('columns', {})
+    for field, _ in sort:
+        if field not in columns:
+            raise DatabaseQueryException(
+                'The after parameter requires the sort fields to be '
+                'returned.')
+    isDict = result['format'] == 'dict'
+    if isDict:
+        keys = [field for field, _ in sort]
+    else:
+        keys = [columns[field] for field, _ in sort]
+    state = {'count': 0, 'last': None}
+
+    def trackRows(data):
+        for row in data:
+            state['count'] += 1
+            state['last'] = row
+            yield row
+
+    def tokenFunc():
+        if not limit or limit < 0 or state['count'] < limit:
+            return None
+        row = state['last']
+        if isDict:
+            values = [row.get(key) for key in keys]
+        else:
+            values = [row[key] for key in keys]
+        return encodeAfterToken(sort, values)
+
+    result['data'] = trackRows(result['data'])
+    return tokenFunc
+
+
+def reservePartitionWorkers(count):
+    """
+    Reserve threads of the shared partition pool for the partitions of a
+    query.
+
+    :param count: the number of threads needed.
+    :returns: True if the threads were reserved, False if there aren't enough
+        free threads.
+    """
+    with _partitionWorkersLock:
+        if _partitionWorkers['reserved'] + count > DEFAULT_PARTITION_WORKERS:
+            return False
+        _partitionWorkers['reserved'] += count
+        return True
+
+
+def releasePartitionWorkers(count):
+    """
+    Release threads reserved by reservePartitionWorkers.
+
+    :param count: the number of threads to release.
+    """
+    with _partitionWorkersLock:
+        _partitionWorkers['reserved'] -= count
+
+
+def performPartitionedSelect(conn, fields, queryProps, filters):
+    """
+    Perform a select query as several queries on ranges of a key that are
+    fetched concurrently.  The rows of the partitions are combined into the
+    data of a single result.  If the query is ordered, the rows are sorted by
+    the key; otherwise, rows are output as they are fetched.  If the
+    connector can't partition the query, or the shared partition pool is
+    busy, it is performed as a single query.
+
+    :param conn: the database connector.
+    :param fields: the fields from the connector's getFieldInfo.
+    :param queryProps: the query properties, including partitions and
+        ordered.
+    :param filters: the query filters.
+    :returns: the results of the query.  See performSelect.
+    """
+    props = {key: value for key, value in six.iteritems(queryProps)
+             if key not in ('partitions', 'ordered')}
+    partitions = conn.getPartitions(fields, props, filters, queryProps['partitions'])
+    if partitions is None or len(partitions['filters']) < 2:
+        return conn.performSelect(fields, props, filters)
+    key = partitions['field']
+    if props.get('sort'):
+        if not queryProps['ordered'] or [tuple(entry) for entry in props['sort']] != [(key, 1)]:
+            raise DatabaseQueryException(
+                'Partitioned queries can only be sorted by %s.' % key)
+    if queryProps['ordered']:
+        props['sort'] = [(key, 1)]
+    count = len(partitions['filters'])
+    if not reservePartitionWorkers(count):
+        log.info('Partition pool is busy; performing a single query')
+        return conn.performSelect(fields, props, filters)
+    try:
+        # Select no rows so that errors are reported before any output and
+        # to get the description of the results.  The partitions are only
+        # queried once their output is read.
+        result = conn.performSelect(
+            fields, dict(props, limit=0, stream=False), filters)
+    except Exception:
+        releasePartitionWorkers(count)
+        raise
+
+    # Each partition is queried and fetched on the same thread, since some
+    # database drivers can't share connections between threads.
+    def select(partFilters):
+        return conn.performSelect(fields, dict(props), filters + partFilters)['data']
+
+    result = dict(result)
+    result.pop('datacount', None)
+    result['limit'] = props.get('limit')
+    result['data'] = iterPartitionData(
+        [functools.partial(select, partFilters) for partFilters in partitions['filters']],
+        queryProps['ordered'],
+        getattr(conn, 'batchSize', dbs.base.DEFAULT_BATCH_SIZE),
+        getExecutor('partition', DEFAULT_PARTITION_WORKERS),
+        release=functools.partial(releasePartitionWorkers, count))
+    return result
+
+
+def preferredEncoding(acceptEncoding, format=None):
+    """
+    Given the value of an Accept-Encoding header, return the content encoding
+    that a response should be compressed with.
+
+    :param acceptEncoding: the Accept-Encoding header value or None.
+    :param format: the output format.  Formats that are already compressed
+        are not compressed again.
+    :returns: one of dbContentEncodings or None to not compress the response.
+    """
+    if (not acceptEncoding or not compressionLevel or
+            format in dbCompressedFormats or format in dbRawFormats):
+        return None
+    qualities = {}
+    for part in acceptEncoding.split(','):
+        params = part.strip().split(';')
+        coding = params[0].strip().lower()
+        coding = 'gzip' if coding == 'x-gzip' else coding
+        quality = 1
+        for param in params[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        qualities[coding] = quality
+    best = None
+    for encoding in dbContentEncodings:
+        if encoding == 'zstd' and zstandard is None:
+            continue
+        quality = qualities.get(encoding, qualities.get('*', 0))
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (encoding, quality)
+    return best[0] if best else None
+
+
 def preferredFormat(format):
     """
     Given a format value, return the canonical format value or None if it is
@@ -410,9 +1847,10 @@ def preferredFormat(format):
     return format
 
 
-def queryDatabase(idOrConnector, dbinfo, params):
+def prepareQuery(idOrConnector, dbinfo, params):
     """
-    Query a database.
+    Validate the parameters of a query and convert them to the values used to
+    perform it.
 
     :param idOrConnector: either an id used to cache the DB connector, or a
         connector that is derived from the DatabaseConnector class.
@@ -421,9 +1859,8 @@ def queryDatabase(idOrConnector, dbinfo, params):
         provided.
     :param params: query parameters.  See the select endpoint for
         documentation.
-    :returns: a result function that returns a generator that yields the
-        results, or None for failed.
-    :returns: the mime type of the results, or None for failed.
+    :returns: a dictionary with conn, fields, queryProps, filters, client,
+        format, pretty, and mimeType.
     """
     if isinstance(idOrConnector, dbs.DatabaseConnector):
         conn = idOrConnector
@@ -450,13 +1887,197 @@ def queryDatabase(idOrConnector, dbinfo, params):
     format = preferredFormat(params.get('format'))
     if not format:
         raise DatabaseQueryException('Unknown output format.')
-    filters = getFilters(conn, fields, params.get('filters'), params, {
-        'limit', 'offset', 'sort', 'sortdir', 'fields', 'wait', 'poll',
-        'initwait', 'clientid', 'filters', 'format', 'pretty'})
-    result = conn.performSelectWithPolling(fields, queryProps, filters,
-                                           client)
-    if result is None:
+    if format in dbArrowFormats and pyarrow is None:
+        raise DatabaseQueryException(
+            'The %s format requires pyarrow to be installed.' % format)
+    if format == 'parquet':
+        compression = params.get('compression') or 'snappy'
+        if compression not in parquetCompressions:
+            raise DatabaseQueryException(
+                'compression must be one of %s.' % ', '.join(parquetCompressions))
+        try:
+            rowGroupSize = int(params.get('rowgroupsize') or
+                               DEFAULT_PARQUET_ROW_GROUP_SIZE)
+        except ValueError:
+            rowGroupSize = 0
+        if rowGroupSize <= 0:
+            raise DatabaseQueryException(
+                'rowgroupsize must be a positive integer.')
+        queryProps['compression'] = compression
+        queryProps['rowgroupsize'] = rowGroupSize
+    # All output formats walk the data once, so the connectors can stream rows
+    # rather than fetching all rows first.
+    queryProps['stream'] = True
+    filters = getFilters(conn, fields, params.get('filters'), params,
+                         dbReservedParameters)
+    if params.get('after') is not None:
+        # Keyset pagination: select the rows that sort after the last row of a
+        # previous query rather than skipping rows with an offset.
+        sort = queryProps['sort']
+        if not sort or not all(
+                isinstance(field, six.string_types) for field, _ in sort):
+            raise DatabaseQueryException(
+                'The after parameter requires sorting by known fields.')
+        queryProps['after'] = params['after']
+        if params['after']:
+            values = decodeAfterToken(params['after'], sort)
+            keys = [(field, dir, value) for (field, dir), value in zip(sort, values)]
+            # Check the fields and operators as if the equivalent filters had
+            # been specified directly.
+            validateFilter(conn, fields, dbs.base.keysetFilter(keys))
+            filters.append({'after': keys})
+    if params.get('partitions') not in (None, ''):
+        try:
+            partitions = int(params['partitions'])
+        except ValueError:
+            partitions = 0
+        if not 1 <= partitions <= MAX_PARTITIONS:
+            raise DatabaseQueryException(
+                'partitions must be an integer from 1 to %d.' % MAX_PARTITIONS)
+        if partitions > 1:
+            # Partitions use separate connections, so a client id can't be
+            # used to cancel them.
+            if (queryProps['limit'] >= 0 or queryProps['offset'] or
+                    queryProps.get('group') or queryProps.get('after') is not None or
+                    queryProps['wait'] or params.get('clientid')):
+                raise DatabaseQueryException(
+                    'Partitioned queries require a limit of none and can\'t '
+                    'use offset, group, after, wait, or clientid.')
+            queryProps['partitions'] = partitions
+            queryProps['ordered'] = params.get('ordered') not in (False, 'false')
+    queryProps['maxtime'] = getMaxTime(conn, params)
+    return {
+        'conn': conn,
+        'fields': fields,
+        'queryProps': queryProps,
+        'filters': filters,
+        'client': client,
+        'format': format,
+        'pretty': params.get('pretty') == 'true',
+        'mimeType': dbFormatList.get(format, 'application/json'),
+    }
+
+
+def queryDatabase(idOrConnector, dbinfo, params, coalesce=True, prepared=None):
+    """
+    Query a database.
+
+    :param idOrConnector: either an id used to cache the DB connector, or a
+        connector that is derived from the DatabaseConnector class.
+    :param dbinfo: a dictionary of connection information for the db.  Needs
+        type, uri, and either table or connection.  Ignored if a connector is
+        provided.
+    :param params: query parameters.  See the select endpoint for
+        documentation.
+    :param coalesce: if True and an identical query for the same id is
+        already being executed, wait for it and share its output.
+    :param prepared: the result of prepareQuery for these parameters.  If
+        None, the parameters are prepared.
+    :returns: a result function that returns a generator that yields the
+        results, or None for failed.
+    :returns: the mime type of the results, or None for failed.
+    """
+    if prepared is None:
+        prepared = prepareQuery(idOrConnector, dbinfo, params)
+    conn = prepared['conn']
+    fields = prepared['fields']
+    queryProps = prepared['queryProps']
+    filters = prepared['filters']
+    client = prepared['client']
+    format = prepared['format']
+    pretty = prepared['pretty']
+    mimeType = prepared['mimeType']
+    # Results of queries on cached connectors can be shared if the query isn't
+    # waiting for data to appear.
+    queryKey = None
+    if (not queryProps['wait'] and idOrConnector is not None and
+            not isinstance(idOrConnector, dbs.DatabaseConnector) and
+            format not in dbRawFormats):
+        queryKey = resultCacheKey(
+            idOrConnector, queryProps, filters, format, pretty)
+    # Results are only cached if the file has a cache time-to-live.
+    cacheTtl = float((dbinfo or {}).get('cachettl') or 0)
+    useCache = queryKey is not None and cacheTtl > 0 and resultCache.maxSize > 0
+    if useCache:
+        entry = resultCache.get(queryKey)
+        if entry is not None:
+            return (lambda: iter(entry['chunks'])), entry['mimeType']
+        cacheGeneration = resultCache.generation(idOrConnector)
+    flight = None
+    if queryKey is not None and coalesce and inFlightQueries.maxSize > 0:
+        flight, isLeader = inFlightQueries.join(queryKey)
+        if not isLeader:
+            chunks = inFlightQueries.wait(flight)
+            if chunks is not None:
+                return (lambda: iter(chunks)), mimeType
+            # The shared query failed or its output was too large to share,
+            # so run the query independently.
+            flight = None
+    try:
+        resultFunc = selectAndRender(
+            conn, fields, queryProps, filters, client, format, pretty)
+    except Exception:
+        if flight is not None:
+            inFlightQueries.finish(queryKey, flight, False)
+        raise
+    if resultFunc is None:
+        if flight is not None:
+            inFlightQueries.finish(queryKey, flight, False)
         return None, None
+    if useCache:
+        resultFunc = cachingResultFunc(
+            resultFunc, queryKey, mimeType, cacheTtl, cacheGeneration)
+    if flight is not None:
+        resultFunc = sharingResultFunc(resultFunc, queryKey, flight)
+
+    return resultFunc, mimeType
+
+
+def releasingResultFunc(resultFunc, release):
+    """
+    Wrap a result function so that a function is called when its output is
+    finished or abandoned, even if the output is never generated.  See
+    OutputRelease.
+
+    :param resultFunc: a function that returns a generator of output chunks.
+    :param release: a function to call when the output is finished.
+    :returns: a function that returns a generator of output chunks.
+    """
+    release = OutputRelease(release)
+
+    def wrappedResultFunc():
+        try:
+            for chunk in resultFunc():
+                yield chunk
+        finally:
+            release()
+
+    return wrappedResultFunc
+
+
+def renderSelect(conn, fields, queryProps, filters, client, format,
+                 pretty=False):
+    """
+    Perform a select query and prepare to render its results.  See
+    selectAndRender.
+
+    :param conn: the database connector.
+    :param fields: the fields from the connector's getFieldInfo.
+    :param queryProps: the query properties.
+    :param filters: the query filters.
+    :param client: a client id or None.
+    :param format: the output format.
+    :param pretty: True to indent JSON output.
+    :returns: a result function that returns a generator that yields the
+        results, or None for failed.
+    """
+    if queryProps.get('partitions'):
+        result = performPartitionedSelect(conn, fields, queryProps, filters)
+    else:
+        result = conn.performSelectWithPolling(fields, queryProps, filters,
+                                               client)
+    if result is None:
+        return None
     if 'fields' in result:
         result['columns'] = {
             result['fields'][col] if not isinstance(
@@ -464,32 +2085,125 @@ def queryDatabase(idOrConnector, dbinfo, params):
             result['fields'][col].get('reference', 'column_' + str(col)):
             col for col in range(len(result['fields']))}
     if 'datacount' not in result:
-        result['datacount'] = len(result.get('data', []))
+        if isinstance(result.get('data', []), list):
+            result['datacount'] = len(result.get('data', []))
+        else:
+            # This is counted as the data is output
+            result['datacount'] = DATACOUNT_PLACEHOLDER
     if not result.get('format'):
         result['format'] = 'list'  # This is the current format
     if result.get('format') not in ('list', 'dict'):
         raise DatabaseQueryException('Unknown internal format.')
-    mimeType = dbFormatList.get(format, 'application/json')
+    deferred = None
+    if queryProps.get('after') is not None and format in ('list', 'dict'):
+        result['next'] = NEXT_PLACEHOLDER
+        deferred = {NEXT_PLACEHOLDER: nextAfterTokenFunc(
+            result, queryProps['sort'], queryProps.get('limit'))}
 
-    pretty = params.get('pretty') == 'true'
     dumpFunc = getattr(conn, 'jsonDumps', json.dumps)
+    batchSize = getattr(conn, 'batchSize', dbs.base.DEFAULT_BATCH_SIZE)
 
     convertFunc = globals().get('convertSelectDataTo%s' % format.capitalize())
     if convertFunc:
-        result = convertFunc(result, dumpFunc=dumpFunc, pretty=pretty)
+        result = convertFunc(
+            result, dumpFunc=dumpFunc, pretty=pretty, batchSize=batchSize,
+            fields=fields, compression=queryProps.get('compression'),
+            rowGroupSize=queryProps.get('rowgroupsize'))
     if callable(result):
-        resultFunc = result
-    else:
-        # We could let Girder convert the results into JSON, but it is
-        # marginally faster to dump the JSON ourselves, since we can exclude
-        # sorting and reduce whitespace.
+        return result
+    # We could let Girder convert the results into JSON, but it is marginally
+    # faster to dump the JSON ourselves, since we can exclude sorting and
+    # reduce whitespace.
+    return jsonResultFunc(result, dumpFunc, pretty, batchSize, deferred)
 
-        def resultFunc():
-            yield dumpFunc(
-                result, check_circular=False, separators=(',', ':'),
-                sort_keys=False, default=str, indent=2 if pretty else None)
 
-    return resultFunc, mimeType
+def resultCacheKey(fileId, queryProps, filters, format, pretty):
+    """
+    Get the key used to cache or share the results of a query.
+
+    :param fileId: the id of the file.
+    :param queryProps: the query properties.
+    :param filters: the query filters.
+    :param format: the output format.
+    :param pretty: True if the output is indented.
+    :returns: a hashable key.
+    """
+    query = {key: queryProps.get(key) for key in (
+        'fields', 'sort', 'group', 'limit', 'offset', 'after', 'compression',
+        'rowgroupsize', 'partitions', 'ordered')}
+    query.update({'filters': filters, 'format': format, 'pretty': pretty})
+    return (str(fileId), json.dumps(query, sort_keys=True, default=str))
+
+
+def selectAndRender(conn, fields, queryProps, filters, client, format,
+                    pretty=False):
+    """
+    Perform a select query and prepare to render its results.  If the query
+    is too expensive for the connector, it is rejected or waits for other
+    expensive queries to finish.
+
+    :param conn: the database connector.
+    :param fields: the fields from the connector's getFieldInfo.
+    :param queryProps: the query properties.
+    :param filters: the query filters.
+    :param client: a client id or None.
+    :param format: the output format.
+    :param pretty: True to indent JSON output.
+    :returns: a result function that returns a generator that yields the
+        results, or None for failed.
+    """
+    release = admitQuery(conn, fields, queryProps, filters)
+    if release is None:
+        return renderSelect(
+            conn, fields, queryProps, filters, client, format, pretty)
+    try:
+        resultFunc = renderSelect(
+            conn, fields, queryProps, filters, client, format, pretty)
+    except Exception:
+        release()
+        raise
+    if resultFunc is None:
+        release()
+        return None
+    return releasingResultFunc(resultFunc, release)
+
+
+def selectColumnNames(result):
+    """
+    Get the column names of select results in column order.
+
+    :param result: the initial select results.  This must have a columns
+        value.
+    :returns: a list of column names.
+    """
+    columns = result['columns']
+    return [col[-1] for col in sorted(
+        (columns[col], col) for col in columns)]
+
+
+def sharingResultFunc(resultFunc, key, flight):
+    """
+    Wrap a result function so that its output is shared with identical
+    queries that are waiting on it.  If the output is never generated, the
+    waiting queries are released once it is discarded; see OutputRelease.
+
+    :param resultFunc: a function that returns a generator of output chunks.
+    :param key: the query key.  See resultCacheKey.
+    :param flight: the in-flight query record from inFlightQueries.join.
+    :returns: a function that returns a generator of output chunks.
+    """
+    state = {'complete': False}
+
+    def finish():
+        inFlightQueries.finish(key, flight, state['complete'])
+
+    def sharedResultFunc():
+        for chunk in resultFunc():
+            inFlightQueries.add(flight, chunk)
+            yield chunk
+        state['complete'] = True
+
+    return releasingResultFunc(sharedResultFunc, finish)
 
 
 def validateFilter(conn, fields, filter):
@@ -34,10 +34,12 @@ from girder.utility.progress import ProgressContext
 
 from . import dbs
 from .assetstore import getTableList, checkUserImport, getDbInfoForFile, \
-    getQueryParamsForFile
+    getQueryParamsForFile, renderCache
 from .base import DB_ASSETSTORE_ID, DB_INFO_KEY
 from .query import DatabaseQueryException, dbFormatList, queryDatabase, \
-    preferredFormat
+    preferredFormat, resultCache, countDatabase, parquetCompressions, \
+    DEFAULT_PARQUET_ROW_GROUP_SIZE, compressResultFunc, preferredEncoding, \
+    batchQueryDatabase, MAX_BATCH_QUERIES, MAX_PARTITIONS
 
 
 @describeRoute(
@@ -62,7 +64,9 @@ def getDatabaseLink(self, file, params):
     .param('body', 'A JSON object containing the database information to '
            'update.  At a minimum this must include "table" or '
            '"collection".', paramType='body')
-    .notes('Set database information fields to null to delete them.')
+    .notes('Set database information fields to null to delete them.  Set '
+           '"cachettl" to a number of seconds to cache select results for '
+           'this file.')
     .errorResponse('ID was invalid.')
     .errorResponse('Invalid JSON passed in request body.')
     .errorResponse('Write access was denied for the file.', 403)
@@ -73,6 +77,8 @@ def getDatabaseLink(self, file, params):
 @filtermodel(model='file')
 def createDatabaseLink(self, file, params):
     dbs.clearDBConnectorCache(file['_id'])
+    resultCache.invalidate(file['_id'])
+    renderCache.invalidate(file['_id'])
     dbinfo = self.getBodyJson()
     if DB_INFO_KEY not in file:
         file[DB_INFO_KEY] = {}
@@ -125,6 +131,8 @@ def databaseRefresh(self, file, params):
     if not dbinfo:
         raise RestException('File is not a database link.')
     result = dbs.clearDBConnectorCache(file['_id'])
+    result = resultCache.invalidate(file['_id']) > 0 or result
+    renderCache.invalidate(file['_id'])
     return {
         'refreshed': result
     }
@@ -144,6 +152,12 @@ def databaseRefresh(self, file, params):
     .param('sortdir', '1 for ascending, -1 for descending (default=1).  '
            'Ignored if sort is unspecified or is a JSON list.', required=False,
            dataType='int')
+    .param('after', 'A continuation token from the next value of a previous '
+           'query with the same sort.  Only rows that sort after the last row '
+           'of that query are returned.  If present, even if empty, list and '
+           'dict output includes a next token.  This requires sorting by '
+           'returned fields and is more efficient than offset for deep '
+           'pages.', required=False)
     .param('fields', 'A comma-separated or JSON list of fields (column names) '
            'to return (default is all fields).  If a JSON list is used, '
            'instead of a plain string, a field may be a dictionary with a '
@@ -166,9 +180,35 @@ def databaseRefresh(self, file, params):
            required=False, enum=list(dbFormatList))
     .param('pretty', 'If true, add whitespace to JSON outputs '
            '(default=false).', required=False, dataType='boolean')
+    .param('compression', 'The compression codec for parquet output '
+           '(default=snappy).', required=False,
+           enum=list(parquetCompressions))
+    .param('rowgroupsize', 'The maximum number of rows in each row group of '
+           'parquet output (default=%d).' % DEFAULT_PARQUET_ROW_GROUP_SIZE,
+           required=False, dataType='int')
+    .param('partitions', 'If greater than 1, and limit is none, split the '
+           'query into this many ranges of a key (the primary key or _id) '
+           'that are fetched concurrently (maximum=%d).  This cannot be used '
+           'with offset, group, after, or wait, and the results can only be '
+           'sorted by the key.' % MAX_PARTITIONS, required=False,
+           dataType='int')
+    .param('ordered', 'If false, the rows of a partitioned query are returned '
+           'in the order they are fetched.  Otherwise, they are sorted by the '
+           'partition key (default=true).', required=False,
+           dataType='boolean')
+    .param('count', 'If specified, the total number of rows that the query '
+           'would return without a limit or offset is reported in the '
+           'Girder-Total-Count response header, and how it was counted in '
+           'the Girder-Total-Count-Mode header.  See the count endpoint.',
+           required=False, enum=list(dbs.base.CountModes))
+    .param('countcap', 'The maximum count when count is capped (default='
+           '%d).' % dbs.base.DEFAULT_COUNT_CAP, required=False, dataType='int')
     .param('clientid', 'A string to use for a client id.  If specified and '
            'there is an extant query to this end point from the same '
            'clientid, the extant query will be cancelled.', required=False)
+    .param('maxtime', 'The longest time in seconds that the query may run '
+           'before the database cancels it.  This can\'t exceed the '
+           'assetstore\'s maximum time.', required=False, dataType='float')
     .param('wait', 'Maximum duration in seconds to wait for data '
            '(default=0).  If a positive value is specified and the initial '
            'query returns no results, the query will be repeated every (poll) '
@@ -228,6 +268,8 @@ def databaseSelect(self, file, params):
     queryparams = getQueryParamsForFile(file)
     queryparams.update(params)
     try:
+        if queryparams.get('count'):
+            count = countDatabase(file['_id'], dbinfo, queryparams)
         resultFunc, mimeType = queryDatabase(
             file['_id'], dbinfo, queryparams)
     except DatabaseQueryException as exc:
@@ -236,9 +278,68 @@ def databaseSelect(self, file, params):
         cherrypy.response.status = 500
         return
     cherrypy.response.headers['Content-Type'] = mimeType
+    if queryparams.get('count'):
+        cherrypy.response.headers['Girder-Total-Count'] = str(count['count'])
+        cherrypy.response.headers['Girder-Total-Count-Mode'] = count['mode']
+    encoding = preferredEncoding(
+        cherrypy.request.headers.get('Accept-Encoding'),
+        preferredFormat(queryparams.get('format')))
+    cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+    if encoding:
+        cherrypy.response.headers['Content-Encoding'] = encoding
+        resultFunc = compressResultFunc(resultFunc, encoding)
     return resultFunc
 
 
+@describeRoute(
+    Description('Count the data in a database link.')
+    .param('id', 'The ID of the file.', paramType='path')
+    .param('count', 'The counting mode (default=exact).  exact counts all '
+           'rows, estimate uses database statistics if possible, and capped '
+           'stops counting at countcap rows.', required=False,
+           enum=list(dbs.base.CountModes))
+    .param('countcap', 'The maximum count when count is capped (default='
+           '%d).' % dbs.base.DEFAULT_COUNT_CAP, required=False, dataType='int')
+    .param('filters', 'A JSON list of filters to apply to the data.  See the '
+           'select endpoint.', required=False)
+    .param('group', 'A comma-separated or JSON list of fields (column names) '
+           'to use in grouping data.  If specified, the groups are counted.',
+           required=False)
+    .param('clientid', 'A string to use for a client id.  If specified and '
+           'there is an extant query to this end point from the same '
+           'clientid, the extant query will be cancelled.', required=False)
+    .param('maxtime', 'The longest time in seconds that the query may run '
+           'before the database cancels it.  This can\'t exceed the '
+           'assetstore\'s maximum time.', required=False, dataType='float')
+    .notes('This returns the number of rows that the select endpoint would '
+           'return with the same filters and no limit or offset.  The mode '
+           'of the response is exact, estimate, or capped.  Connectors that '
+           'can\'t estimate return an exact count.  A capped count means that '
+           'there are at least that many rows.  Filters can also be specified '
+           'via query parameters as with the select endpoint.')
+    .errorResponse('ID was invalid.')
+    .errorResponse('Read access was denied for the file.', 403)
+    .errorResponse('File is not a database link.')
+    .errorResponse('Failed to connect to database.')
+    .errorResponse('The count parameter must be one of exact, estimate, '
+                   'capped.')
+)
+@boundHandler()
+@access.cookie
+@access.public
+@loadmodel(model='file', map={'id': 'file'}, level=AccessType.READ)
+def databaseCount(self, file, params):
+    dbinfo = getDbInfoForFile(file)
+    if not dbinfo:
+        raise RestException('File is not a database link.')
+    queryparams = getQueryParamsForFile(file)
+    queryparams.update(params)
+    try:
+        return countDatabase(file['_id'], dbinfo, queryparams)
+    except DatabaseQueryException as exc:
+        raise RestException(exc.message)
+
+
 def fileResourceRoutes(file):
     """
     Add routes to the file resource.
@@ -250,6 +351,7 @@ def fileResourceRoutes(file):
     file.route('GET', (':id', 'database', 'fields'), getDatabaseFields)
     file.route('PUT', (':id', 'database', 'refresh'), databaseRefresh)
     file.route('GET', (':id', 'database', 'select'), databaseSelect)
+    file.route('GET', (':id', 'database', 'count'), databaseCount)
 
 
 class DatabaseAssetstoreResource(Resource):
@@ -261,6 +363,11 @@ class DatabaseAssetstoreResource(Resource):
         self.route('PUT', (':id', 'import'), self.importData)
         self.route('PUT', ('user', 'import'), self.importDataUser)
         self.route('GET', ('user', 'import', 'allowed'), self.userImportAllowed)
+        self.route('GET', ('cache', ), self.getCacheStats)
+        self.route('GET', ('connectors', ), self.getConnectorCacheStats)
+        self.route('GET', ('engines', ), self.getEngineStats)
+        self.route('GET', ('sessions', ), self.getSessionCounts)
+        self.route('POST', ('select', 'batch'), self.selectBatch)
 
     def _parseTableList(self, tables, assetstore, uri=None):
         """
@@ -501,3 +608,108 @@ class DatabaseAssetstoreResource(Resource):
         if error:
             result['reason'] = error
         return result
+
+    @access.admin
+    @describeRoute(
+        Description('Get statistics about the cache of select results.')
+        .notes('Only site administrators may use this endpoint.')
+        .errorResponse('You are not an administrator.', 403)
+    )
+    def getCacheStats(self, params):
+        return resultCache.stats()
+
+    @access.admin
+    @describeRoute(
+        Description('Get statistics about the cache of database connectors.')
+        .notes('Only site administrators may use this endpoint.')
+        .errorResponse('You are not an administrator.', 403)
+    )
+    def getConnectorCacheStats(self, params):
+        return dbs.base._connectorCache.stats()
+
+    @access.admin
+    @describeRoute(
+        Description('Get statistics about the SQL database engines and their '
+                    'connection pools.')
+        .notes('Only site administrators may use this endpoint.  Each pool '
+               'reports its size, how many connections are checked in, '
+               'checked out, and in overflow, and how many connectors use it.')
+        .errorResponse('You are not an administrator.', 403)
+    )
+    def getEngineStats(self, params):
+        return dbs.sqlalchemydb._engineRegistry.stats()
+
+    @access.admin
+    @describeRoute(
+        Description('Get the number of client sessions kept for each database '
+                    'link.')
+        .notes('Only site administrators may use this endpoint.  The result '
+               'has an entry for each recently used file whose database keeps '
+               'sessions, with the number of live sessions and how many of '
+               'those are idle and in use.')
+        .errorResponse('You are not an administrator.', 403)
+    )
+    def getSessionCounts(self, params):
+        return dbs.base.getConnectorSessionCounts()
+
+    @access.public
+    @describeRoute(
+        Description('Get data from multiple database links concurrently.')
+        .notes('The body is a JSON list of up to %d queries.  Each query is '
+               'either an object with an "id" key containing a file ID and '
+               'an optional "params" object with select parameters, or an '
+               '[id, params] list.  All queries are validated before any are '
+               'run.  The response is a JSON list in the same order as the '
+               'queries.  Each entry has an "id" and either "mimeType" and '
+               '"data" or an "error" if that query failed.  JSON output is '
+               'included directly; other output is included as a string.  '
+               'The arrow and parquet formats can\'t be used, and each query '
+               'must have a limit and can\'t wait.' % MAX_BATCH_QUERIES)
+        .param('body', 'A JSON list of queries.', paramType='body')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for a file.', 403)
+        .errorResponse('A file is not a database link.')
+        .errorResponse('Failed to connect to database.')
+    )
+    def selectBatch(self, params):
+        queries = self.getBodyJson()
+        if not isinstance(queries, list) or not queries:
+            raise RestException('The body must be a non-empty JSON list.')
+        user = self.getCurrentUser()
+        batch = []
+        for idx, entry in enumerate(queries):
+            if isinstance(entry, dict):
+                fileId, queryParams = entry.get('id'), entry.get('params')
+            elif isinstance(entry, list) and len(entry) in (1, 2):
+                fileId, queryParams = entry[0], entry[1] if len(entry) > 1 else None
+            else:
+                raise RestException(
+                    'Query %d must be an object with an id or an [id, params] '
+                    'list.' % idx)
+            if queryParams is None:
+                queryParams = {}
+            if not isinstance(queryParams, dict):
+                raise RestException('Query %d params must be an object.' % idx)
+            file = File().load(fileId, user=user, level=AccessType.READ, exc=True)
+            dbinfo = getDbInfoForFile(file)
+            if not dbinfo:
+                raise RestException('Query %d: file is not a database link.' % idx)
+            queryparams = getQueryParamsForFile(file)
+            # Values in the body can be any JSON type; convert scalars to the
+            # strings that would be used as query parameters.
+            queryparams.update({
+                key: value if value is None or isinstance(
+                    value, (six.string_types, list, dict)) else json.dumps(value)
+                for key, value in six.iteritems(queryParams)})
+            batch.append((file['_id'], dbinfo, queryparams))
+        try:
+            resultFunc = batchQueryDatabase(batch)
+        except DatabaseQueryException as exc:
+            raise RestException(exc.message)
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        encoding = preferredEncoding(cherrypy.request.headers.get('Accept-Encoding'))
+        cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+        if encoding:
+            cherrypy.response.headers['Content-Encoding'] = encoding
+            resultFunc = compressResultFunc(resultFunc, encoding)
+        return resultFunc
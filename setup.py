@@ -24,9 +24,12 @@ with open(path.join(ownDir, 'LICENSE'), encoding='utf-8') as f:
     license_str = f.read()
 
 extras_require = {
+    'arrow': ['pyarrow>=0.15; python_version >= "3.6"'],
+    'json': ['orjson>=2.0; python_version >= "3.6"'],
     'mysql': ['mysqlclient>=1.3.10'],
     'postgres': ['psycopg2>=2.7.1'],
     'sqlite': [],
+    'zstd': ['zstandard>=0.9'],
 }
 all_extras = set()
 for key in extras_require:
@@ -55,7 +58,10 @@ setup(
     ],
     keywords='girder database assetstore',
     packages=find_packages(exclude=['plugin_tests']),
-    install_requires=['sqlalchemy>=1.1.11'],
+    install_requires=[
+        'futures; python_version < "3"',
+        'sqlalchemy>=1.1.11',
+    ],
     extras_require=extras_require,
     data_files=[
         ('database_assetstore/girder', ['plugin.json']),